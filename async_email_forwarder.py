@@ -0,0 +1,365 @@
+import asyncio
+import logging
+from datetime import datetime
+from email.message import Message
+from typing import AsyncIterator, Dict, List, Tuple
+
+import aiohttp
+import aioimaplib
+import openai
+
+from email_forwarder import (MAILBOX_RESTART_DELAY, MAILBOX_SYNC_INTERVAL,
+                             EmailForwarder, create_response_cache)
+from internal.cache import ResponseCache
+from internal.chatgpt import PROJECT_PROMPT, AsyncChatGPT
+from internal.classifier import EMAIL_TOPIC_RETENTION
+from internal.db import (DEFAULT_MAILBOX, advance_mailbox_state,
+                         delete_old_email_topics, get_config_mailboxes,
+                         get_mailbox_state, save_mailbox_email_processed)
+from internal.env import Env
+from internal.imap import AsyncIMAPSession
+from internal.jobs import CLASSIFY, DONE, DRIVE, FORWARD, SHEET
+from internal.metrics import EMAILS_PENDING, EMAILS_PROCESSED, track_stage
+from internal.smtp import AsyncSMTPPool
+from internal.utils import *
+
+
+class AsyncEmailForwarder(EmailForwarder):
+    """
+    EmailForwarder running on an asyncio event loop. IMAP, SMTP and OpenAI requests are
+    async, so the emails of an iteration are all in flight at once, up to the in flight
+    limit. Google Sheets, Drive and the database have no async client and run in threads
+    """
+
+    chatgpt_class = AsyncChatGPT
+
+    def __init__(
+        self,
+        mailbox: str = DEFAULT_MAILBOX,
+        response_cache: ResponseCache | None = None,
+        in_flight: asyncio.Semaphore | None = None,
+    ) -> None:
+        super().__init__(mailbox, response_cache)
+        self.imap_session: AsyncIMAPSession | None = None
+        self.smtp_pool: AsyncSMTPPool | None = None
+        self.in_flight = in_flight or asyncio.Semaphore(max(Env.ASYNC_MAX_IN_FLIGHT, 1))
+        # sessions replaced by a config change, closed on the event loop
+        self.stale_sessions: List[AsyncIMAPSession | AsyncSMTPPool] = []
+
+    async def run_process_async(self) -> None:
+        """
+        Runs a single iteration to check for new emails and forward them concurrently
+        """
+        await asyncio.to_thread(self.load_config)
+        await self.close_stale_sessions()
+
+        tasks = []
+        async for uid, raw_email in self.get_new_raw_emails_async():
+            with track_stage("parse"):
+                email_msg = parse_email(raw_email)
+            EMAILS_PENDING.inc()
+            task = asyncio.create_task(self.handle_fetched_email_async(uid, email_msg))
+            task.add_done_callback(lambda _: EMAILS_PENDING.dec())
+            tasks.append((uid, task))
+        # every email is recorded as processed or failed on its own by its task
+        processed = await asyncio.gather(*(task for _, task in tasks))
+        for (uid, _), email_processed in zip(tasks, processed):
+            if email_processed:
+                await self.imap_session.mark_seen(uid)
+
+    async def handle_fetched_email_async(self, uid: int, email_msg: Message) -> bool:
+        """
+        Same as handle_fetched_email, with the database written in a thread
+        """
+        try:
+            await self.handle_email_async(email_msg)
+        except Exception as e:
+            await asyncio.to_thread(self.record_email_failed, uid, e)
+            return False
+        await asyncio.to_thread(
+            save_mailbox_email_processed,
+            self.imap_session.name,
+            self.imap_session.uidvalidity,
+            uid,
+        )
+        return True
+
+    async def handle_email_async(self, email_msg: Message) -> None:
+        async with self.in_flight:
+            checkpoint = {}
+            stage = CLASSIFY
+            while stage != DONE:
+                stage = await self.run_job_stage_async(stage, email_msg, checkpoint)
+        EMAILS_PROCESSED.inc()
+        logging.info("Email processing done.")
+
+    async def run_job_stage_async(
+        self, stage: str, email_msg: Message, checkpoint: dict
+    ) -> str:
+        """
+        Same as run_job_stage, awaiting chatgpt and SMTP and running the google clients in
+        a thread
+        """
+        with track_stage(stage):
+            return await self._run_job_stage_async(stage, email_msg, checkpoint)
+
+    async def _run_job_stage_async(
+        self, stage: str, email_msg: Message, checkpoint: dict
+    ) -> str:
+        if stage == CLASSIFY:
+            email_msg_text, body = self.construct_email_msg_for_chatgpt(email_msg)
+            return self.checkpoint_classification(
+                checkpoint, *await self.process_email_async(email_msg, email_msg_text)
+            )
+
+        email_details = EmailDetails.from_dict(checkpoint["email_details"])
+        if stage == SHEET:
+            email_msg_text, body = self.construct_email_msg_for_chatgpt(email_msg)
+            project_name = checkpoint["project_name"]
+            if project_name is None:
+                # asked here rather than in add_to_sheet, so the thread isn't held meanwhile
+                project_name = await self.chatgpt.request_async(
+                    self.prompt_templates.project.render(email_msg_text), PROJECT_PROMPT
+                )
+            project, project_items, item_folder = await asyncio.to_thread(
+                self.add_to_sheet, email_msg_text, email_details, project_name
+            )
+            return self.checkpoint_sheet(checkpoint, email_details, item_folder)
+        if stage == DRIVE:
+            await asyncio.to_thread(
+                self.add_to_drive, email_msg, checkpoint["item_folder"]
+            )
+            return FORWARD
+        if stage == FORWARD:
+            await self.send_email_async(
+                self.create_forward_email(
+                    ReceiverEmail.from_dict(checkpoint["reciever_email"]),
+                    email_details,
+                    email_msg,
+                )
+            )
+            await asyncio.to_thread(
+                self.save_forwarded_topic, email_msg, checkpoint["topic"]
+            )
+            return DONE
+        raise ValueError(f"Unknown job stage {stage}")
+
+    async def process_email_async(
+        self, email_msg: Message, email_msg_text: str
+    ) -> Tuple[EmailDetails, ReceiverEmail, str, str | None]:
+        """
+        Same as process_email, with the chatgpt requests awaited
+        """
+        combined_details = None
+        if self.prompt_templates.combined is not None:
+            logging.info("Getting email details, topic and project from chatgpt")
+            combined_details = await self.chatgpt.get_combined_details_async(
+                email_msg_text,
+                self.prompt_templates.combined,
+                self.config.receiver_emails,
+            )
+            if combined_details is None:
+                logging.info("Falling back to separate chatgpt requests")
+
+        local_routing = None
+        if combined_details is None:
+            # in a thread, as the topic of the thread is looked up in the database
+            local_routing = await asyncio.to_thread(
+                self.route_locally, email_msg, email_msg_text
+            )
+
+        if combined_details is not None:
+            email_details, reciever_email, topic, project_name = combined_details
+        elif local_routing is not None:
+            reciever_email, topic = local_routing
+            logging.info("Getting email details from chatgpt")
+            email_details = await self.chatgpt.get_email_details_async(
+                email_msg_text, self.prompt_templates.email_details
+            )
+            project_name = None
+        else:
+            logging.info("Getting email details and topic from chatgpt")
+            (
+                email_details,
+                reciever_email,
+                topic,
+            ) = await self.chatgpt.get_email_details_and_reciever_email_async(
+                email_msg_text,
+                self.prompt_templates.email_details,
+                self.config.receiver_emails,
+                self.prompt_templates.forward_email,
+            )
+            project_name = None
+        self.set_item_rates(email_details)
+
+        return email_details, reciever_email, topic, project_name
+
+    def update_imap_session(self) -> None:
+        """
+        Replaces the IMAP session if the IMAP settings changed. Runs in the thread loading
+        the config, so the old session is closed later on the event loop
+        """
+        imap_settings = (
+            self.config.imap_host,
+            int(self.config.imap_port),
+            self.config.email,
+            self.config.password,
+        )
+        if self.imap_session is not None:
+            if self.imap_session.matches(*imap_settings):
+                return
+            self.stale_sessions.append(self.imap_session)
+        self.imap_session = AsyncIMAPSession(*imap_settings)
+
+    def update_smtp_pool(self) -> None:
+        smtp_settings = (
+            self.config.smtp_server,
+            int(self.config.smtp_port),
+            self.config.email,
+            self.config.password,
+        )
+        if self.smtp_pool is not None:
+            if self.smtp_pool.matches(*smtp_settings):
+                return
+            self.stale_sessions.append(self.smtp_pool)
+        self.smtp_pool = AsyncSMTPPool(*smtp_settings, Env.SMTP_CONNECTIONS)
+
+    async def close_stale_sessions(self) -> None:
+        while self.stale_sessions:
+            await self.stale_sessions.pop().close()
+
+    async def get_new_raw_emails_async(self) -> AsyncIterator[Tuple[int, bytes]]:
+        last_uid = await self.get_last_processed_uid_async()
+        uids = [
+            uid
+            for uid in await self.imap_session.search_uids(f"UID {last_uid + 1}:*")
+            if uid > last_uid
+        ]
+        uids = await asyncio.to_thread(self.get_due_uids, last_uid, uids)
+        async for uid, raw_email in self.imap_session.fetch_emails(uids):
+            logging.info("Found new email")
+            yield uid, raw_email
+
+    async def get_last_processed_uid_async(self) -> int:
+        """
+        Same as get_last_processed_uid, with the mailbox state read in a thread
+        """
+        await self.imap_session.get_connection()
+        uidvalidity = self.imap_session.uidvalidity
+        mailbox_state = await asyncio.to_thread(
+            get_mailbox_state, self.imap_session.name
+        )
+        if mailbox_state is not None and mailbox_state.uidvalidity == uidvalidity:
+            return mailbox_state.last_uid
+
+        unseen_uids = await self.imap_session.search_uids("UNSEEN")
+        if unseen_uids:
+            last_uid = min(unseen_uids) - 1
+        else:
+            last_uid = await self.imap_session.get_uid_next() - 1
+        await asyncio.to_thread(
+            advance_mailbox_state, self.imap_session.name, uidvalidity, last_uid
+        )
+        return last_uid
+
+    async def run_loop_async(self) -> None:
+        """
+        Runs the Email Forwarding process in a loop, until the task is cancelled
+        """
+        await asyncio.to_thread(self.load_config)
+        logging.info(f"Logged in as {self.config.email}")
+        logging.info("Listening for new emails...")
+        while True:
+            try:
+                await self.run_process_async()
+            except (aioimaplib.Abort, aioimaplib.CommandTimeout) as e:
+                logging.error(f"IMAP connection lost: {e}. Reconnecting")
+                await self.imap_session.reconnect()
+                continue
+            await asyncio.to_thread(
+                delete_old_email_topics,
+                self.mailbox,
+                datetime.utcnow() - EMAIL_TOPIC_RETENTION,
+            )
+            # mailboxes are stopped by cancelling the task, which also ends the wait
+            await self.imap_session.wait_for_new_emails(
+                lambda: asyncio.to_thread(self.should_stop_waiting)
+            )
+
+    async def send_email_async(self, email_message: Message) -> None:
+        logging.info(f"Forwarding email to {email_message['To']}")
+        await self.smtp_pool.send(email_message)
+
+    async def aclose(self) -> None:
+        await self.close_stale_sessions()
+        if self.imap_session is not None:
+            await self.imap_session.close()
+        if self.smtp_pool is not None:
+            await self.smtp_pool.close()
+
+
+class AsyncMailboxSupervisor:
+    """
+    Runs the forwarders of all configured mailboxes as tasks on one event loop, sharing the
+    chatgpt cache, the in flight limit and the OpenAI HTTP session
+    """
+
+    def __init__(self) -> None:
+        self.response_cache = create_response_cache()
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.in_flight: asyncio.Semaphore | None = None
+
+    async def run(self) -> None:
+        await asyncio.to_thread(self.response_cache.evict)
+        self.in_flight = asyncio.Semaphore(max(Env.ASYNC_MAX_IN_FLIGHT, 1))
+        async with aiohttp.ClientSession() as session:
+            # reused by all OpenAI requests, instead of a session per request
+            openai.aiosession.set(session)
+            while True:
+                try:
+                    mailboxes = await asyncio.to_thread(get_config_mailboxes)
+                except Exception:
+                    logging.exception("Couldn't get the configured mailboxes")
+                    mailboxes = list(self.tasks)
+                self.sync_mailbox_tasks(mailboxes)
+                await asyncio.sleep(MAILBOX_SYNC_INTERVAL)
+
+    def sync_mailbox_tasks(self, mailboxes: List[str]) -> None:
+        """
+        Starts a task for new mailboxes, and cancels those of deleted mailboxes
+        """
+        for mailbox in mailboxes:
+            if mailbox in self.tasks:
+                continue
+            logging.info(f"Starting mailbox {mailbox}")
+            forwarder = AsyncEmailForwarder(
+                mailbox, self.response_cache, self.in_flight
+            )
+            self.tasks[mailbox] = asyncio.create_task(
+                self.run_mailbox_loop(forwarder), name=f"mailbox-{mailbox}"
+            )
+        for mailbox in list(self.tasks):
+            if mailbox not in mailboxes:
+                logging.info(f"Stopping mailbox {mailbox}")
+                self.tasks.pop(mailbox).cancel()
+
+    async def run_mailbox_loop(self, forwarder: AsyncEmailForwarder) -> None:
+        """
+        Runs the loop of one mailbox until it is cancelled, restarting it if it crashes so
+        one mailbox can't take the others down
+        """
+        try:
+            while True:
+                try:
+                    await forwarder.run_loop_async()
+                except Exception:
+                    logging.exception(
+                        f"Mailbox {forwarder.mailbox} crashed, restarting in {MAILBOX_RESTART_DELAY}s"
+                    )
+                    await asyncio.sleep(MAILBOX_RESTART_DELAY)
+        finally:
+            await forwarder.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(AsyncMailboxSupervisor().run())
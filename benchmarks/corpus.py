@@ -0,0 +1,162 @@
+"""
+Emails to replay through the forwarder: an mbox corpus, or a generated mix of the emails
+a construction firm gets
+"""
+
+import mailbox
+import random
+import re
+from datetime import datetime, timedelta, timezone
+from email import policy
+from email.message import EmailMessage
+from email.utils import format_datetime
+from typing import List
+
+COMPANIES = ["Acme Windows", "Oak Carpentry", "Brick & Co", "Glaze Ltd", "Timberline"]
+ORDER_ITEMS = [
+    "Supply and fit sash window",
+    "Replace door frame",
+    "Labour for second fix carpentry",
+    "Supply casement window",
+    "Skirting boards",
+]
+BENCH_DOMAIN = "bench.example"
+
+
+def load_mbox(path: str) -> List[bytes]:
+    """
+    Returns the raw emails of an mbox file, with CRLF line endings as an IMAP server
+    would send them
+    """
+    mbox = mailbox.mbox(path, create=False)
+    return [re.sub(rb"\r?\n", b"\r\n", mbox.get_bytes(key)) for key in mbox.keys()]
+
+
+def write_mbox(path: str, raw_emails: List[bytes]) -> None:
+    mbox = mailbox.mbox(path)
+    mbox.lock()
+    try:
+        for raw_email in raw_emails:
+            mbox.add(raw_email.replace(b"\r\n", b"\n"))
+        mbox.flush()
+    finally:
+        mbox.unlock()
+
+
+def generate_corpus(count: int, seed: int = 0, attachment_kb: int = 256) -> List[bytes]:
+    """
+    Returns count raw emails: orders and variations that go to the sheets, some HTML only
+    or with a long quoted reply chain, general emails and forwarded emails with attachments
+    """
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1, 8, tzinfo=timezone.utc)
+    kinds = [
+        (create_order_email, 3),
+        (create_html_variation_email, 2),
+        (create_reply_chain_email, 2),
+        (create_general_email, 2),
+        (create_forwarded_email, 1),
+    ]
+    creators = [creator for creator, weight in kinds for _ in range(weight)]
+    raw_emails = []
+    for i in range(count):
+        email_message = rng.choice(creators)(rng, attachment_kb)
+        email_message["Date"] = format_datetime(start + timedelta(minutes=7 * i))
+        email_message["Message-ID"] = f"<bench-{seed}-{i}@{BENCH_DOMAIN}>"
+        raw_emails.append(email_message.as_bytes(policy=policy.SMTP))
+    return raw_emails
+
+
+def create_email(rng: random.Random, subject: str) -> EmailMessage:
+    company = rng.choice(COMPANIES)
+    email_message = EmailMessage()
+    email_message["From"] = (
+        f"{company} <office@{company.lower().replace(' ', '').replace('&', '')}.example>"
+    )
+    email_message["To"] = f"site@{BENCH_DOMAIN}"
+    email_message["Subject"] = subject
+    return email_message
+
+
+def create_order_lines(rng: random.Random, plot: int) -> List[str]:
+    return [
+        f"- {rng.choice(ORDER_ITEMS)} for plot {plot}, quantity {rng.randint(1, 6)}"
+        for _ in range(rng.randint(1, 4))
+    ]
+
+
+def create_order_email(rng: random.Random, attachment_kb: int) -> EmailMessage:
+    plot = rng.randint(1, 120)
+    email_message = create_email(rng, f"Order for plot {plot}")
+    email_message.set_content(
+        "Hi,\n\nPlease find our order below.\n\n"
+        + "\n".join(create_order_lines(rng, plot))
+        + "\n\nThanks\n-- \nSite office\nThis email and any attachments are"
+        " confidential and intended solely for the addressee.\n"
+    )
+    return email_message
+
+
+def create_html_variation_email(rng: random.Random, attachment_kb: int) -> EmailMessage:
+    plot = rng.randint(1, 120)
+    email_message = create_email(rng, f"Variation request plot {plot}")
+    rows = "".join(
+        f"<tr><td>{line[2:]}</td><td>{rng.randint(1, 3)} days</td></tr>"
+        for line in create_order_lines(rng, plot)
+    )
+    email_message.set_content(
+        "<html><head><style>td {padding: 4px}</style></head><body>"
+        f"<p>Hello,</p><p>A variation is needed on plot {plot}:</p>"
+        f"<table>{rows}</table><p>Regards</p>"
+        '<div style="display:none">tracking pixel text</div></body></html>',
+        subtype="html",
+    )
+    return email_message
+
+
+def create_reply_chain_email(rng: random.Random, attachment_kb: int) -> EmailMessage:
+    plot = rng.randint(1, 120)
+    email_message = create_email(rng, f"RE: Order for plot {plot}")
+    history = []
+    for depth in range(rng.randint(5, 30), 0, -1):
+        history.append(f"On Mon, 1 Jan 2024 at 09:{depth:02d}, Someone wrote:")
+        history.extend(
+            "> " * depth + line
+            for line in ["Can you confirm the delivery date?", "Thanks"]
+        )
+    email_message.set_content(
+        "Confirmed, add one more:\n"
+        + "\n".join(create_order_lines(rng, plot))
+        + "\n\n"
+        + "\n".join(history)
+        + "\n"
+    )
+    return email_message
+
+
+def create_general_email(rng: random.Random, attachment_kb: int) -> EmailMessage:
+    email_message = create_email(
+        rng, rng.choice(["Site meeting on Friday", "Invoice query", "Holiday cover"])
+    )
+    email_message.set_content(
+        "Hi all,\n\nJust a quick note about next week, let me know if you have any"
+        " questions.\n\nSent from my iPhone\n"
+    )
+    return email_message
+
+
+def create_forwarded_email(rng: random.Random, attachment_kb: int) -> EmailMessage:
+    email_message = create_email(rng, "Fwd: Drawings for the new phase")
+    email_message.set_content(
+        "See the drawings attached.\n\n---------- Forwarded message ---------\n"
+        "From: Architect <arch@example.com>\nDate: Mon, 1 Jan 2024\n\n"
+        "Updated drawings for the new phase attached.\n"
+    )
+    if attachment_kb:
+        email_message.add_attachment(
+            rng.randbytes(attachment_kb * 1024),
+            maintype="application",
+            subtype="pdf",
+            filename="drawings.pdf",
+        )
+    return email_message
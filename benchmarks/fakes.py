@@ -0,0 +1,567 @@
+"""
+Local stand-ins for the services the forwarder talks to: an IMAP server, an SMTP sink, an
+OpenAI compatible HTTP endpoint and in-memory gspread and Drive backends. They count the
+calls they get and can add latency or simulate quota errors
+"""
+
+import base64
+import imaplib
+import json
+import re
+import smtplib
+import socketserver
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List
+
+import aioimaplib
+import aiosmtplib
+import httplib2
+import openai
+import requests
+from googleapiclient.errors import HttpError
+from gspread.exceptions import APIError
+
+LOCALHOST = "127.0.0.1"
+# Retry-After sent with simulated quota errors, in seconds
+QUOTA_RETRY_AFTER = 1
+# listen backlog of the fake servers. The socketserver default of 5 refuses connections
+# when the async forwarder opens many at once
+REQUEST_QUEUE_SIZE = 128
+
+
+class CallCounter:
+    def __init__(self) -> None:
+        self.calls: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.calls[name] += 1
+
+    def total(self) -> int:
+        with self._lock:
+            return sum(self.calls.values())
+
+
+class Quota:
+    """
+    Sliding window of the requests of the last minute. A requests_per_minute of None
+    disables the quota
+    """
+
+    def __init__(self, requests_per_minute: int | None) -> None:
+        self.requests_per_minute = requests_per_minute
+        self.requests: deque = deque()
+        self.exceeded = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        if self.requests_per_minute is None:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            while self.requests and now - self.requests[0] > 60:
+                self.requests.popleft()
+            if len(self.requests) >= self.requests_per_minute:
+                self.exceeded += 1
+                return False
+            self.requests.append(now)
+            return True
+
+
+class ThreadedServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+    def start(self) -> "ThreadedServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks the subset of IMAP4rev1 used by IMAPSession and AsyncIMAPSession
+    """
+
+    server: "FakeIMAPServer"
+
+    def write(self, line: bytes | str) -> None:
+        if isinstance(line, str):
+            line = line.encode()
+        self.wfile.write(line + b"\r\n")
+
+    def handle(self) -> None:
+        self.write("* OK [CAPABILITY IMAP4rev1 IDLE] fake IMAP server ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, command, arguments = (line.decode().strip().split(" ", 2) + ["", ""])[
+                :3
+            ]
+            command = command.upper()
+            if command == "UID":
+                command, _, arguments = arguments.partition(" ")
+                command = f"UID {command.upper()}"
+            self.server.counter.count(command)
+            if command == "LOGOUT":
+                self.write("* BYE logging out")
+                self.write(f"{tag} OK LOGOUT completed")
+                self.wfile.flush()
+                return
+            self.handle_command(tag, command, arguments)
+            self.wfile.flush()
+
+    def handle_command(self, tag: str, command: str, arguments: str) -> None:
+        server = self.server
+        if command == "CAPABILITY":
+            self.write("* CAPABILITY IMAP4rev1 IDLE")
+        elif command in ("SELECT", "EXAMINE"):
+            self.write(f"* {len(server.emails)} EXISTS")
+            self.write(f"* OK [UIDVALIDITY {server.uidvalidity}] UIDs valid")
+            self.write(f"* OK [UIDNEXT {server.get_uid_next()}] next UID")
+        elif command == "STATUS":
+            mailbox = arguments.split(" ")[0]
+            self.write(f"* STATUS {mailbox} (UIDNEXT {server.get_uid_next()})")
+        elif command == "UID SEARCH":
+            self.write("* SEARCH " + " ".join(map(str, server.search(arguments))))
+        elif command == "UID FETCH":
+            uid_set = arguments.split(" ")[0]
+            for uid in server.resolve_uid_set(uid_set):
+                raw_email = server.emails[uid]
+                self.write(
+                    f"* {server.get_sequence_number(uid)} FETCH (UID {uid} BODY[] "
+                    f"{{{len(raw_email)}}}"
+                )
+                self.wfile.write(raw_email)
+                self.write(")")
+        elif command == "UID STORE":
+            uid_set, _, flags = arguments.partition(" ")
+            if "\\Seen" in flags:
+                server.seen.update(server.resolve_uid_set(uid_set))
+        elif command == "IDLE":
+            self.write("+ idling")
+            self.wfile.flush()
+            self.rfile.readline()
+        elif command not in ("LOGIN", "NOOP", "CHECK"):
+            self.write(f"{tag} BAD unknown command {command}")
+            return
+        self.write(f"{tag} OK {command} completed")
+
+
+class FakeIMAPServer(ThreadedServer):
+    """
+    IMAP server with a single mailbox seeded with the given raw emails, all unseen
+    """
+
+    def __init__(self, raw_emails: List[bytes], first_uid: int = 1) -> None:
+        super().__init__((LOCALHOST, 0), FakeIMAPHandler)
+        self.emails: Dict[int, bytes] = {
+            first_uid + i: raw_email for i, raw_email in enumerate(raw_emails)
+        }
+        self.seen: set = set()
+        self.uidvalidity = 1
+        self.counter = CallCounter()
+
+    def get_uid_next(self) -> int:
+        return max(self.emails, default=0) + 1
+
+    def get_sequence_number(self, uid: int) -> int:
+        return sorted(self.emails).index(uid) + 1
+
+    def resolve_uid_set(self, uid_set: str) -> List[int]:
+        uids = set()
+        last_uid = max(self.emails, default=0)
+        for uid_range in uid_set.split(","):
+            start, _, end = uid_range.partition(":")
+            start = last_uid if start == "*" else int(start)
+            end = start if end == "" else last_uid if end == "*" else int(end)
+            # like a real server, n:* includes the last UID even if it is below n
+            if uid_range.endswith("*") and self.emails:
+                uids.add(last_uid)
+            uids.update(
+                uid for uid in self.emails if min(start, end) <= uid <= max(start, end)
+            )
+        return sorted(uids)
+
+    def search(self, criteria: str) -> List[int]:
+        criteria = criteria.upper()
+        if "UNSEEN" in criteria:
+            return [uid for uid in sorted(self.emails) if uid not in self.seen]
+        match = re.search(r"UID (\S+)", criteria)
+        if match is not None:
+            return self.resolve_uid_set(match.group(1))
+        return sorted(self.emails)
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    server: "FakeSMTPServer"
+
+    def write(self, line: str) -> None:
+        self.wfile.write(line.encode() + b"\r\n")
+        self.wfile.flush()
+
+    def handle(self) -> None:
+        self.write("220 fake SMTP sink ready")
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors="replace").strip().split(" ")[0].upper()
+            self.server.counter.count(command)
+            if command in ("EHLO", "HELO"):
+                self.write("250-fake SMTP sink")
+                self.write("250-AUTH PLAIN")
+                self.write("250-8BITMIME")
+                self.write("250 SMTPUTF8")
+            elif command == "AUTH":
+                self.write("235 authenticated")
+            elif command == "MAIL":
+                recipients = []
+                self.write("250 OK")
+            elif command == "RCPT":
+                recipients.append(line.decode().split(":", 1)[1].strip())
+                self.write("250 OK")
+            elif command == "DATA":
+                self.write("354 end data with <CR><LF>.<CR><LF>")
+                size = 0
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line == b".\r\n":
+                        break
+                    size += len(data_line)
+                time.sleep(self.server.latency)
+                self.server.record(recipients, size)
+                self.write("250 OK queued")
+            elif command == "QUIT":
+                self.write("221 bye")
+                return
+            else:
+                self.write("250 OK")
+
+
+class FakeSMTPServer(ThreadedServer):
+    """
+    SMTP sink accepting any login and recording the emails it gets
+    """
+
+    def __init__(self, latency: float = 0) -> None:
+        super().__init__((LOCALHOST, 0), FakeSMTPHandler)
+        self.latency = latency
+        self.counter = CallCounter()
+        self.messages: List[List[str]] = []
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+
+    def record(self, recipients: List[str], size: int) -> None:
+        with self._lock:
+            self.messages.append(recipients)
+            self.bytes_received += size
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    """
+    OpenAI compatible chat completions endpoint. The completion of each prompt comes from
+    the responder, after the configured latency. Every throttle_every-th request is
+    rejected with a 429
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        responder: Callable[[str], str],
+        latency: float = 0,
+        throttle_every: int = 0,
+        request_queue_size: int = REQUEST_QUEUE_SIZE,
+    ) -> None:
+        # read by listen() in the constructor, so it must be set before
+        self.request_queue_size = request_queue_size
+        super().__init__((LOCALHOST, 0), FakeOpenAIHandler)
+        self.responder = responder
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.counter = CallCounter()
+        self.prompt_chars = 0
+        self._lock = threading.Lock()
+
+    def start(self) -> "FakeOpenAIServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def api_base(self) -> str:
+        return f"http://{LOCALHOST}:{self.server_address[1]}/v1"
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    server: FakeOpenAIServer
+    # keeps connections alive, like the real API
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def send_json(
+        self, status: int, body: dict, headers: Dict[str, str] | None = None
+    ) -> None:
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self) -> None:
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+        server.counter.count("chat.completions")
+        prompt = request["messages"][-1]["content"]
+        with server._lock:
+            server.prompt_chars += len(prompt)
+            request_number = server.counter.calls["chat.completions"]
+        time.sleep(server.latency)
+        if server.throttle_every and request_number % server.throttle_every == 0:
+            server.counter.count("throttled")
+            self.send_json(
+                429,
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                {"Retry-After": str(QUOTA_RETRY_AFTER)},
+            )
+            return
+        content = server.responder(prompt)
+        self.send_json(
+            200,
+            {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {
+                            "role": "assistant",
+                            "content": content,
+                        },
+                        "finish_reason": "stop",
+                    }
+                ],
+                # roughly 4 characters per token
+                "usage": {
+                    "prompt_tokens": len(prompt) // 4,
+                    "completion_tokens": len(content) // 4,
+                    "total_tokens": (len(prompt) + len(content)) // 4,
+                },
+            },
+        )
+
+
+class GoogleBackend:
+    """
+    Latency, quota and call counts shared by the fake Google clients of one API
+    """
+
+    def __init__(self, latency: float = 0, requests_per_minute: int | None = None):
+        self.latency = latency
+        self.quota = Quota(requests_per_minute)
+        self.counter = CallCounter()
+
+    def call(self, name: str, quota_error: Callable[[], Exception]) -> None:
+        self.counter.count(name)
+        time.sleep(self.latency)
+        if not self.quota.allow():
+            raise quota_error()
+
+
+def sheets_quota_error() -> APIError:
+    response = requests.Response()
+    response.status_code = 429
+    response.headers["Retry-After"] = str(QUOTA_RETRY_AFTER)
+    response._content = json.dumps(
+        {
+            "error": {
+                "code": 429,
+                "message": "Quota exceeded",
+                "status": "RESOURCE_EXHAUSTED",
+            }
+        }
+    ).encode()
+    return APIError(response)
+
+
+def drive_quota_error() -> HttpError:
+    return HttpError(
+        httplib2.Response({"status": 429, "retry-after": str(QUOTA_RETRY_AFTER)}),
+        b'{"error": {"code": 429, "message": "User Rate Limit Exceeded"}}',
+    )
+
+
+class FakeSpreadsheet:
+    def __init__(
+        self, backend: GoogleBackend, drive_backend: GoogleBackend, url: str
+    ) -> None:
+        self.backend = backend
+        # gspread reads the last update time from the Drive API
+        self.drive_backend = drive_backend
+        self.url = url
+        self.revision = 0
+        self.sheet1 = FakeWorksheet(self)
+
+    def get_lastUpdateTime(self) -> str:
+        self.drive_backend.call("get_lastUpdateTime", sheets_quota_error)
+        return str(self.revision)
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet: FakeSpreadsheet) -> None:
+        self.spreadsheet = spreadsheet
+        self.rows: List[list] = [["Ref", "Date", "Plot", "Description"]]
+
+    def get_all_values(self) -> List[list]:
+        self.spreadsheet.backend.call("get_all_values", sheets_quota_error)
+        return [list(row) for row in self.rows]
+
+    def insert_rows(self, values: List[list], row: int = 1, **kwargs) -> None:
+        self.spreadsheet.backend.call("insert_rows", sheets_quota_error)
+        self.rows[row - 1 : row - 1] = [list(value) for value in values]
+        self.spreadsheet.revision += 1
+
+
+class FakeGspreadClient:
+    def __init__(self, backend: GoogleBackend, drive_backend: GoogleBackend) -> None:
+        self.backend = backend
+        self.drive_backend = drive_backend
+        self.spreadsheets: Dict[str, FakeSpreadsheet] = {}
+        self._lock = threading.Lock()
+
+    def open_by_url(self, url: str) -> FakeSpreadsheet:
+        self.backend.call("open_by_url", sheets_quota_error)
+        with self._lock:
+            if url not in self.spreadsheets:
+                self.spreadsheets[url] = FakeSpreadsheet(
+                    self.backend, self.drive_backend, url
+                )
+            return self.spreadsheets[url]
+
+
+class FakeDriveRequest:
+    def __init__(self, backend: GoogleBackend, name: str, result: Callable[[], dict]):
+        self.backend = backend
+        self.name = name
+        self.result = result
+
+    def execute(self) -> dict:
+        self.backend.call(self.name, drive_quota_error)
+        return self.result()
+
+
+class FakeDriveFiles:
+    def __init__(self, service: "FakeDriveService") -> None:
+        self.service = service
+
+    def list(self, q: str = "", fields: str = "", **kwargs) -> FakeDriveRequest:
+        name = re.search(r"name='((?:[^'\\]|\\.)*)'", q)
+        return FakeDriveRequest(
+            self.service.backend,
+            "files.list",
+            lambda: {"files": self.service.find_folders(name.group(1) if name else "")},
+        )
+
+    def create(self, body: dict, fields: str = "", media_body=None, **kwargs):
+        def create() -> dict:
+            if media_body is not None:
+                self.service.record_upload(media_body.getbytes(0, media_body.size()))
+            return self.service.create_file(body)
+
+        name = "files.create" if media_body is None else "files.upload"
+        return FakeDriveRequest(self.service.backend, name, create)
+
+
+class FakeDriveService:
+    def __init__(self, backend: GoogleBackend) -> None:
+        self.backend = backend
+        self.files_by_id: Dict[str, dict] = {}
+        self.bytes_uploaded = 0
+        self._lock = threading.Lock()
+
+    def files(self) -> FakeDriveFiles:
+        return FakeDriveFiles(self)
+
+    def find_folders(self, name: str) -> List[dict]:
+        with self._lock:
+            return [
+                file
+                for file in self.files_by_id.values()
+                if file["name"] == name
+                and file.get("mimeType") == "application/vnd.google-apps.folder"
+            ]
+
+    def create_file(self, body: dict) -> dict:
+        file_id = uuid.uuid4().hex
+        file = dict(body, id=file_id, webViewLink=f"https://drive.fake/{file_id}")
+        with self._lock:
+            self.files_by_id[file_id] = file
+        return {"id": file_id, "webViewLink": file["webViewLink"]}
+
+    def record_upload(self, content: bytes) -> None:
+        with self._lock:
+            self.bytes_uploaded += len(content)
+
+
+class PlainIMAP4(imaplib.IMAP4):
+    """
+    IMAP4_SSL replacement connecting without TLS, to the fake server
+    """
+
+    def __init__(self, host: str = "", port: int = 0, ssl_context=None, **kwargs):
+        super().__init__(host, port, **kwargs)
+
+
+class PlainSMTP(smtplib.SMTP):
+    def __init__(self, host: str = "", port: int = 0, context=None, **kwargs):
+        super().__init__(host, port, **kwargs)
+
+
+class PlainAsyncSMTP(aiosmtplib.SMTP):
+    def __init__(self, *args, use_tls: bool = False, tls_context=None, **kwargs):
+        super().__init__(*args, use_tls=False, **kwargs)
+
+
+def use_plain_connections() -> None:
+    """
+    Makes the IMAP and SMTP clients connect without TLS, as the fake servers don't have
+    certificates
+    """
+    imaplib.IMAP4_SSL = PlainIMAP4
+    smtplib.SMTP_SSL = PlainSMTP
+    aioimaplib.IMAP4_SSL = aioimaplib.IMAP4
+    aiosmtplib.SMTP = PlainAsyncSMTP
+
+
+def use_fake_openai(server: FakeOpenAIServer) -> None:
+    openai.api_base = server.api_base
+
+
+def use_fake_google(
+    gspread_client: FakeGspreadClient, drive_service: FakeDriveService
+) -> None:
+    """
+    Points the gspread and Drive clients of the forwarder at the fakes
+    """
+    from internal import gclient, gdrive
+
+    gclient.get_gspread_client = lambda: gspread_client
+    gdrive.get_drive_service = lambda: drive_service
@@ -0,0 +1,460 @@
+"""
+Replays emails through the forwarder end to end against local fakes of IMAP, SMTP, OpenAI,
+Google Sheets and Drive, and reports throughput, stage latencies and API calls per email.
+
+    python -m benchmarks.run --emails 200 --openai-latency 500 --workers 8
+    python -m benchmarks.run --mbox corpus.mbox --async
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+from benchmarks.corpus import BENCH_DOMAIN, generate_corpus, load_mbox, write_mbox
+from benchmarks.fakes import (
+    REQUEST_QUEUE_SIZE,
+    FakeDriveService,
+    FakeGspreadClient,
+    FakeIMAPServer,
+    FakeOpenAIServer,
+    FakeSMTPServer,
+    GoogleBackend,
+    use_fake_google,
+    use_fake_openai,
+    use_plain_connections,
+)
+
+BENCH_MAILBOX = "benchmark"
+BENCH_PROJECT = "Bench Project"
+SHEET_URLS = {
+    "windows": "https://sheets.fake/windows",
+    "carpentry": "https://sheets.fake/carpentry",
+    "misc": "https://sheets.fake/misc",
+}
+# the stub completion is picked by the first line of the prompt
+DETAILS_PROMPT = "EXTRACT_DETAILS"
+TOPIC_PROMPT = "CHOOSE_TOPIC"
+PROJECT_PROMPT = "CHOOSE_PROJECT"
+COMBINED_PROMPT = "EXTRACT_ALL"
+ITEM_REGEX = re.compile(r"^- (.+?) for plot (\d+), quantity (\d+)", re.MULTILINE)
+HTML_ITEM_REGEX = re.compile(r"^(.+?) for plot (\d+) \| (\d+) days", re.MULTILINE)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    corpus = parser.add_mutually_exclusive_group()
+    corpus.add_argument("--emails", type=int, default=100, help="emails to generate")
+    corpus.add_argument("--mbox", help="replay the emails of this mbox file instead")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--attachment-kb", type=int, default=256)
+    parser.add_argument("--write-mbox", help="save the generated emails to this mbox")
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="run AsyncEmailForwarder instead of EmailForwarder",
+    )
+    parser.add_argument("--workers", type=int, default=1, help="EMAIL_WORKERS")
+    parser.add_argument("--max-in-flight", type=int, default=100)
+    parser.add_argument("--smtp-connections", type=int, default=1)
+    parser.add_argument("--combined", action="store_true", help="use prompt_combined")
+    parser.add_argument("--openai-latency", type=float, default=200, help="ms")
+    parser.add_argument(
+        "--openai-throttle-every",
+        type=int,
+        default=0,
+        help="reject every n-th OpenAI request with a 429",
+    )
+    parser.add_argument("--google-latency", type=float, default=50, help="ms")
+    parser.add_argument("--sheets-quota", type=int, help="requests per minute")
+    parser.add_argument("--drive-quota", type=int, help="requests per minute")
+    parser.add_argument("--smtp-latency", type=float, default=20, help="ms")
+    parser.add_argument(
+        "--rate-limits",
+        action="store_true",
+        help="keep the client side rate limits of the env, they are disabled by default",
+    )
+    parser.add_argument(
+        "--database-url",
+        help="database to use, a temporary SQLite database by default",
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    return parser.parse_args()
+
+
+def configure_env(args: argparse.Namespace, tmp_dir: str) -> None:
+    """
+    Sets the env before anything reads it, ignoring .env so a real database or key is
+    never used by accident
+    """
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{tmp_dir}/bench.db"
+    os.environ["GOOGLE_SERVICE_ACCOUNT_KEY_JSON"] = "{}"
+    os.environ["EMAIL_WORKERS"] = str(args.workers)
+    os.environ["ASYNC_MAX_IN_FLIGHT"] = str(args.max_in_flight)
+    os.environ["SMTP_CONNECTIONS"] = str(args.smtp_connections)
+    if not args.rate_limits:
+        for name in [
+            "OPENAI_REQUESTS_PER_MINUTE",
+            "OPENAI_TOKENS_PER_MINUTE",
+            "SHEETS_REQUESTS_PER_MINUTE",
+            "DRIVE_REQUESTS_PER_MINUTE",
+        ]:
+            os.environ[name] = "0"
+
+
+def create_config(imap_port: int, smtp_port: int, combined: bool) -> dict:
+    return {
+        "imap_host": "127.0.0.1",
+        "imap_port": imap_port,
+        "email": f"site@{BENCH_DOMAIN}",
+        "password": "password",
+        "openai_api_key": "sk-bench",
+        "smtp_server": "127.0.0.1",
+        "smtp_port": smtp_port,
+        "prompt_subject_line": f"{DETAILS_PROMPT}\nRates: {{windows_day_rate}}\n{{email_message}}",
+        "prompt_forward_email": f"{TOPIC_PROMPT}\n{{topics}}\n{{email_message}}",
+        "prompt_project": f"{PROJECT_PROMPT}\n{{projects}}\n{{email_message}}",
+        "prompt_combined": (
+            f"{COMBINED_PROMPT}\n{{topics}}\n{{projects}}\n{{email_message}}"
+            if combined
+            else None
+        ),
+        "receiver_emails": [
+            {"name": "order", "email": f"orders@{BENCH_DOMAIN}", "header": "New order"},
+            {"name": "variation", "email": f"variations@{BENCH_DOMAIN}", "header": ""},
+            {"name": "general", "email": f"office@{BENCH_DOMAIN}", "header": ""},
+        ],
+        "projects": [
+            {
+                "name": BENCH_PROJECT,
+                "phase": 1,
+                "plot_range": {"start": 1, "end": 200},
+                "linked_contacts": None,
+                "google_sheet_url_windows": SHEET_URLS["windows"],
+                "google_sheet_url_carpentry": SHEET_URLS["carpentry"],
+            }
+        ],
+        "misc_sheet_url": SHEET_URLS["misc"],
+        "project_types": [
+            {"name": "windows", "day_rate": 200, "hour_rate": 25, "keywords": ""},
+            {"name": "carpentry", "day_rate": 180, "hour_rate": 22, "keywords": ""},
+        ],
+    }
+
+
+def respond(prompt: str) -> str:
+    """
+    Stub completion for the benchmark prompts, derived from the email in the prompt
+    """
+    subject = re.search(r"^Subject: (.*)$", prompt, re.MULTILINE)
+    subject = subject.group(1).lower() if subject else ""
+    topic = "general"
+    if "variation" in subject:
+        topic = "variation"
+    elif "order" in subject:
+        topic = "order"
+    if prompt.startswith(TOPIC_PROMPT):
+        return topic
+    if prompt.startswith(PROJECT_PROMPT):
+        return BENCH_PROJECT
+    items = [
+        {
+            "item_description": description,
+            "plot_no": int(plot),
+            "quantity": int(quantity),
+            "rate": None,
+            "item_type": "windows" if "window" in description else "carpentry",
+            "no_of_days_or_hours": None,
+            "unit_time": None,
+        }
+        for description, plot, quantity in ITEM_REGEX.findall(prompt)
+    ] + [
+        {
+            "item_description": description,
+            "plot_no": int(plot),
+            "quantity": None,
+            "rate": None,
+            "item_type": "windows" if "window" in description else "carpentry",
+            "no_of_days_or_hours": int(days),
+            "unit_time": "day",
+        }
+        for description, plot, days in HTML_ITEM_REGEX.findall(prompt)
+    ]
+    email_details = {
+        "company": "Bench Supplier",
+        "topic": topic,
+        "project_name": BENCH_PROJECT,
+        "project_location": None,
+        "items": items,
+    }
+    if prompt.startswith(COMBINED_PROMPT):
+        return json.dumps(
+            {
+                "email_details": email_details,
+                "topic": topic,
+                "project_name": BENCH_PROJECT,
+            }
+        )
+    return json.dumps(email_details)
+
+
+class StageTimings:
+    def __init__(self) -> None:
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+        self.failed_emails = 0
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.durations[stage].append(seconds)
+
+
+def create_forwarders(timings: StageTimings):
+    """
+    Returns forwarder classes timing every stage and email. Imported here, once the env
+    is configured
+    """
+    from async_email_forwarder import AsyncEmailForwarder
+    from email_forwarder import EmailForwarder
+
+    class BenchmarkForwarder(EmailForwarder):
+        def handle_email(self, email_msg) -> None:
+            start = time.perf_counter()
+            try:
+                super().handle_email(email_msg)
+            except Exception:
+                timings.failed_emails += 1
+                raise
+            timings.record("email", time.perf_counter() - start)
+
+        def run_job_stage(self, stage: str, email_msg, checkpoint: dict) -> str:
+            start = time.perf_counter()
+            try:
+                return super().run_job_stage(stage, email_msg, checkpoint)
+            finally:
+                timings.record(stage, time.perf_counter() - start)
+
+    class BenchmarkAsyncForwarder(AsyncEmailForwarder):
+        async def handle_email_async(self, email_msg) -> None:
+            start = time.perf_counter()
+            try:
+                await super().handle_email_async(email_msg)
+            except Exception:
+                timings.failed_emails += 1
+                raise
+            timings.record("email", time.perf_counter() - start)
+
+        async def run_job_stage_async(
+            self, stage: str, email_msg, checkpoint: dict
+        ) -> str:
+            start = time.perf_counter()
+            try:
+                return await super().run_job_stage_async(stage, email_msg, checkpoint)
+            finally:
+                timings.record(stage, time.perf_counter() - start)
+
+    return BenchmarkForwarder, BenchmarkAsyncForwarder
+
+
+def run_forwarder(args: argparse.Namespace, timings: StageTimings) -> str | None:
+    """
+    Runs one iteration of the forwarder over the whole mailbox. Returns the error that
+    stopped it, if any
+    """
+    import asyncio
+
+    import aiohttp
+    import openai
+
+    BenchmarkForwarder, BenchmarkAsyncForwarder = create_forwarders(timings)
+    try:
+        if args.use_async:
+
+            async def run() -> None:
+                forwarder = BenchmarkAsyncForwarder(BENCH_MAILBOX)
+                async with aiohttp.ClientSession() as session:
+                    openai.aiosession.set(session)
+                    try:
+                        await forwarder.run_process_async()
+                    finally:
+                        await forwarder.aclose()
+
+            asyncio.run(run())
+        else:
+            forwarder = BenchmarkForwarder(BENCH_MAILBOX)
+            try:
+                forwarder.run_process()
+            finally:
+                forwarder.close()
+    except Exception as e:
+        return repr(e)
+    return None
+
+
+def check_tiktoken_encoding() -> None:
+    """
+    Exits with a clear message if the tiktoken encoding can't be loaded, as otherwise
+    every email fails on its first prompt when there is no network
+    """
+    from internal.prompt_budget import ENCODING_NAME, get_encoding
+
+    try:
+        get_encoding()
+    except Exception as e:
+        sys.exit(
+            f"Could not load the tiktoken encoding {ENCODING_NAME} ({e}). Download it once "
+            "with network access into TIKTOKEN_CACHE_DIR, see the README"
+        )
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, round(fraction * (len(values) - 1)))]
+
+
+def main() -> None:
+    args = parse_args()
+    tmp_dir = tempfile.mkdtemp(prefix="forwarder-bench-")
+    configure_env(args, tmp_dir)
+
+    raw_emails = (
+        load_mbox(args.mbox)
+        if args.mbox
+        else generate_corpus(args.emails, args.seed, args.attachment_kb)
+    )
+    if not raw_emails:
+        sys.exit("No emails to replay")
+    if args.write_mbox:
+        write_mbox(args.write_mbox, raw_emails)
+
+    check_tiktoken_encoding()
+
+    imap_server = FakeIMAPServer(raw_emails).start()
+    # a new UIDVALIDITY, so mailbox state left in the database by earlier runs is reset
+    imap_server.uidvalidity = int(time.time())
+    smtp_server = FakeSMTPServer(args.smtp_latency / 1000).start()
+    openai_server = FakeOpenAIServer(
+        respond,
+        args.openai_latency / 1000,
+        args.openai_throttle_every,
+        max(REQUEST_QUEUE_SIZE, args.max_in_flight),
+    ).start()
+    sheets = GoogleBackend(args.google_latency / 1000, args.sheets_quota)
+    drive = GoogleBackend(args.google_latency / 1000, args.drive_quota)
+    gspread_client = FakeGspreadClient(sheets, drive)
+    drive_service = FakeDriveService(drive)
+
+    use_plain_connections()
+    use_fake_openai(openai_server)
+    use_fake_google(gspread_client, drive_service)
+
+    from internal.db import update_or_create_config
+    from internal.ratelimit import drive_limiter, openai_limiter, sheets_limiter
+
+    update_or_create_config(
+        create_config(imap_server.port, smtp_server.port, args.combined),
+        BENCH_MAILBOX,
+    )
+
+    timings = StageTimings()
+    start = time.perf_counter()
+    error = run_forwarder(args, timings)
+    elapsed = time.perf_counter() - start
+
+    emails = len(raw_emails)
+    # no stage has samples if the forwarder failed before processing any email
+    processed = len(timings.durations.get("email", []))
+    results = {
+        "mode": "async" if args.use_async else f"threads x{args.workers}",
+        "emails": emails,
+        "processed": processed,
+        "failed": timings.failed_emails,
+        "error": error,
+        "elapsed_seconds": elapsed,
+        "emails_per_second": processed / elapsed if elapsed else 0,
+        "stages": {
+            stage: {
+                "count": len(durations),
+                "p50_ms": percentile(durations, 0.5) * 1000,
+                "p99_ms": percentile(durations, 0.99) * 1000,
+            }
+            for stage, durations in timings.durations.items()
+            if durations
+        },
+        "calls_per_email": {
+            **{
+                f"openai.{name}": count / emails
+                for name, count in openai_server.counter.calls.items()
+            },
+            **{
+                f"sheets.{name}": count / emails
+                for name, count in sheets.counter.calls.items()
+            },
+            **{
+                f"drive.{name}": count / emails
+                for name, count in drive.counter.calls.items()
+            },
+            "smtp.messages": len(smtp_server.messages) / emails,
+            "imap.commands": imap_server.counter.total() / emails,
+        },
+        "prompt_chars_per_email": openai_server.prompt_chars / emails,
+        "smtp_bytes_per_email": smtp_server.bytes_received / emails,
+        "drive_bytes_per_email": drive_service.bytes_uploaded / emails,
+        "quota_errors": {
+            "sheets": sheets.quota.exceeded,
+            "drive": drive.quota.exceeded,
+        },
+        "rate_limiters": {
+            limiter.name: limiter.get_stats()
+            for limiter in [openai_limiter, sheets_limiter, drive_limiter]
+        },
+    }
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if error else 0)
+
+
+def print_results(results: dict) -> None:
+    print()
+    print(f"mode                {results['mode']}")
+    print(
+        f"emails              {results['processed']}/{results['emails']} processed, "
+        f"{results['failed']} failed"
+    )
+    if results["error"]:
+        print(f"error               {results['error']}")
+    print(f"elapsed             {results['elapsed_seconds']:.2f} s")
+    print(f"throughput          {results['emails_per_second']:.2f} emails/s")
+    print()
+    print(f"{'stage':<20}{'count':>8}{'p50 ms':>12}{'p99 ms':>12}")
+    for stage, stats in results["stages"].items():
+        print(
+            f"{stage:<20}{stats['count']:>8}{stats['p50_ms']:>12.1f}{stats['p99_ms']:>12.1f}"
+        )
+    print()
+    print("per email")
+    for name, value in sorted(results["calls_per_email"].items()):
+        print(f"  {name:<28}{value:>10.2f}")
+    for name in [
+        "prompt_chars_per_email",
+        "smtp_bytes_per_email",
+        "drive_bytes_per_email",
+    ]:
+        print(f"  {name.replace('_per_email', ''):<28}{results[name]:>10.0f}")
+    print()
+    print(f"quota errors        {results['quota_errors']}")
+    for name, stats in results["rate_limiters"].items():
+        print(f"{name:<20}{stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,146 @@
-import email
 import imaplib
 import logging
-import smtplib
-import ssl
+import sys
+import threading
 import time
-from datetime import date
-from email import policy
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
+from datetime import date, datetime, timedelta
 from email.message import EmailMessage, Message
-from typing import Iterator, Tuple
+from typing import Dict, Iterator, List, Tuple
 
+from internal.cache import ResponseCache
 from internal.chatgpt import ChatGPT
+from internal.classifier import (
+    EMAIL_TOPIC_RETENTION,
+    SHEET_TOPICS,
+    PreClassifier,
+    RoutingStats,
+)
 from internal.data_types import Configuration, ProjectItemGSheet
-from internal.db import get_config_from_db
+from internal.db import (
+    DEFAULT_MAILBOX,
+    ConfigListener,
+    advance_mailbox_state,
+    claim_email_job,
+    delete_done_email_jobs,
+    delete_old_email_topics,
+    enqueue_email_job,
+    extend_email_job_lease,
+    fail_email_job,
+    fail_mailbox_email,
+    get_config_from_db,
+    get_config_mailboxes,
+    get_config_version,
+    get_mailbox_emails,
+    get_mailbox_state,
+    get_unseen_done_email_job_uids,
+    listen_for_config_updates,
+    retry_email_job,
+    save_email_job_stage,
+    save_email_jobs_seen,
+    save_email_topic,
+    save_mailbox_email_processed,
+)
+from internal.env import Env
 from internal.gdrive import GoogleDrive
 from internal.gsheet import GoogleSheet
+from internal.imap import IMAPSession
+from internal.jobs import (
+    CLASSIFY,
+    DONE,
+    DRIVE,
+    FORWARD,
+    JOB_LEASE,
+    JOB_LEASE_RENEW_INTERVAL,
+    JOB_POLL_INTERVAL,
+    JOB_RETENTION,
+    SHEET,
+    get_retry_delay,
+)
+from internal.metrics import EMAILS_PENDING, EMAILS_PROCESSED, track_stage
+from internal.models import EmailJob
+from internal.prompt_budget import MAX_EMAIL_BODY_TOKENS, fit_to_token_budget
+from internal.prompts import PromptTemplates
+from internal.smtp import SMTPPool
 from internal.utils import *
 
 logging.basicConfig(
-    format="%(asctime)s %(message)s", datefmt="%m/%d/%Y %H:%M:%S", level=logging.INFO
+    format="%(asctime)s [%(threadName)s] %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
 )
 
+# how often the mailboxes to run are synced with the configs in the db
+MAILBOX_SYNC_INTERVAL = 30
+# wait before restarting the loop of a mailbox that crashed
+MAILBOX_RESTART_DELAY = 60
+
+# shared by all mailboxes, threads are only started once emails are submitted
+_email_executor = ThreadPoolExecutor(
+    max_workers=max(Env.EMAIL_WORKERS, 1), thread_name_prefix="email"
+)
+
+
+def create_response_cache() -> ResponseCache:
+    return ResponseCache(
+        ttl=timedelta(hours=Env.CHATGPT_CACHE_TTL_HOURS),
+        max_entries=Env.CHATGPT_CACHE_MAX_ENTRIES,
+    )
+
+
+@contextmanager
+def keep_job_leased(job_id: int, claim_token: str) -> Iterator[None]:
+    """
+    Renews the lease of the job every JOB_LEASE_RENEW_INTERVAL while the block runs, so the
+    job isn't claimed by another worker during a slow stage
+    """
+    done = threading.Event()
+
+    def renew() -> None:
+        while not done.wait(JOB_LEASE_RENEW_INTERVAL.total_seconds()):
+            try:
+                if not extend_email_job_lease(
+                    job_id, claim_token, datetime.utcnow() + JOB_LEASE
+                ):
+                    return
+            except Exception:
+                logging.exception(f"Couldn't renew the lease of email job {job_id}")
+
+    renewer = threading.Thread(target=renew, name=f"lease-{job_id}", daemon=True)
+    renewer.start()
+    try:
+        yield
+    finally:
+        done.set()
+
+
+def log_job_claim_lost(job_id: int) -> None:
+    logging.warning(
+        f"Email job {job_id} was claimed by another worker after its lease ran out, leaving it to that worker"
+    )
+
 
 class EmailForwarder:
+    chatgpt_class = ChatGPT
+
+    def __init__(
+        self,
+        mailbox: str = DEFAULT_MAILBOX,
+        response_cache: ResponseCache | None = None,
+    ) -> None:
+        self.mailbox = mailbox
+        self.response_cache = response_cache or create_response_cache()
+        self.config_lock = threading.Lock()
+        self.imap_session: IMAPSession | None = None
+        self.smtp_pool: SMTPPool | None = None
+        self.routing_stats = RoutingStats()
+        self.config_version: int | None = None
+        self.config_listener: ConfigListener | None = None
+        # set when a config update was seen outside of load_config, e.g. while waiting for
+        # new emails, so the next load still picks it up
+        self.config_update_pending = False
+
     def run_process(self) -> None:
         """
         Runs a single iteration to check for new emails and forward
@@ -29,46 +148,199 @@ class EmailForwarder:
 
         self.load_config()
 
-        for email_msg in self.get_new_emails():
+        if Env.EMAIL_WORKERS <= 1:
+            for uid, email_msg in self.get_new_emails():
+                if self.handle_fetched_email(uid, email_msg):
+                    self.imap_session.mark_seen(uid)
+            return
+
+        # Emails are fetched on this thread, since the IMAP connection can't be
+        # shared, and processed by the pool. Every email is recorded as processed or
+        # failed on its own, only marking them as seen waits for the whole batch.
+        futures = []
+        for uid, email_msg in self.get_new_emails():
+            EMAILS_PENDING.inc()
+            future = _email_executor.submit(self.handle_fetched_email, uid, email_msg)
+            future.add_done_callback(lambda _: EMAILS_PENDING.dec())
+            futures.append((uid, future))
+        wait([future for _, future in futures])
+        for uid, future in futures:
+            if future.result():
+                self.imap_session.mark_seen(uid)
+
+    def handle_fetched_email(self, uid: int, email_msg: Message) -> bool:
+        """
+        Handles the email and records it as processed, or as failed to be retried later.
+        Returns whether it was processed
+        """
+        try:
+            self.handle_email(email_msg)
+        except Exception as e:
+            self.record_email_failed(uid, e)
+            return False
+        save_mailbox_email_processed(
+            self.imap_session.name, self.imap_session.uidvalidity, uid
+        )
+        return True
+
+    def handle_email(self, email_msg: Message) -> None:
+        """
+        Processes a single email end to end: chatgpt, gsheet, gdrive and forwarding
+        """
+        checkpoint = {}
+        stage = CLASSIFY
+        while stage != DONE:
+            stage = self.run_job_stage(stage, email_msg, checkpoint)
+        EMAILS_PROCESSED.inc()
+        logging.info("Email processing done.")
+
+    def run_job_stage(self, stage: str, email_msg: Message, checkpoint: dict) -> str:
+        """
+        Runs one stage of processing an email, adding its results to the checkpoint for the
+        later stages. Returns the next stage
+        """
+        with track_stage(stage):
+            return self._run_job_stage(stage, email_msg, checkpoint)
+
+    def _run_job_stage(self, stage: str, email_msg: Message, checkpoint: dict) -> str:
+        if stage == CLASSIFY:
             email_msg_text, body = self.construct_email_msg_for_chatgpt(email_msg)
-            email_details = self.process_email(email_msg_text)
-            (
-                reciever_email,
-                topic,
-            ) = self.chatgpt.get_reciever_email_and_topic_to_forward_to(
-                email_msg_text,
-                self.config.receiver_emails,
-                self.config.prompt_forward_email,
+            return self.checkpoint_classification(
+                checkpoint, *self.process_email(email_msg, email_msg_text)
             )
-            if topic in ["order", "variation"]:
-                project, project_items = self.add_to_sheet(
-                    email_msg_text, email_details
-                )
-                gdrive_url = self.add_to_drive(email_msg, project_items, project)
-                self.add_gdrive_url_to_sheet(gdrive_url, project, project_items)
-            self.forward_email(reciever_email, email_details, email_msg)
-            logging.info("Email processing done.")
 
-    def add_to_drive(
-        self,
-        email_message: EmailMessage,
-        project_items: List[ProjectItemGSheet],
-        project: Project,
+        email_details = EmailDetails.from_dict(checkpoint["email_details"])
+        if stage == SHEET:
+            email_msg_text, body = self.construct_email_msg_for_chatgpt(email_msg)
+            project, project_items, item_folder = self.add_to_sheet(
+                email_msg_text, email_details, checkpoint["project_name"]
+            )
+            return self.checkpoint_sheet(checkpoint, email_details, item_folder)
+        if stage == DRIVE:
+            self.add_to_drive(email_msg, checkpoint["item_folder"])
+            return FORWARD
+        if stage == FORWARD:
+            self.forward_email(
+                ReceiverEmail.from_dict(checkpoint["reciever_email"]),
+                email_details,
+                email_msg,
+            )
+            self.save_forwarded_topic(email_msg, checkpoint["topic"])
+            return DONE
+        raise ValueError(f"Unknown job stage {stage}")
+
+    @staticmethod
+    def checkpoint_classification(
+        checkpoint: dict,
+        email_details: EmailDetails,
+        reciever_email: ReceiverEmail | None,
+        topic: str,
+        project_name: str | None,
+    ) -> str:
+        """
+        Adds the results of the classify stage to the checkpoint and returns the next stage
+        """
+        if reciever_email is None:
+            raise Exception(f"No reciever email for topic {topic}")
+        checkpoint["email_details"] = email_details.to_dict()
+        checkpoint["reciever_email"] = reciever_email.to_dict()
+        checkpoint["topic"] = topic
+        checkpoint["project_name"] = project_name
+        return SHEET if topic in SHEET_TOPICS else FORWARD
+
+    @staticmethod
+    def checkpoint_sheet(
+        checkpoint: dict, email_details: EmailDetails, item_folder: dict
     ) -> str:
+        # add_to_sheet sets the matched project name on the email details
+        checkpoint["email_details"] = email_details.to_dict()
+        checkpoint["item_folder"] = item_folder
+        return DRIVE
+
+    def save_forwarded_topic(self, email_msg: Message, topic: str) -> None:
+        """
+        Saves the topic of the forwarded email, so replies to it are routed the same way
+        """
+        message_id = email_msg["Message-ID"]
+        if message_id:
+            save_email_topic(self.mailbox, str(message_id).strip(), topic)
+
+    def process_job(self, job: EmailJob) -> None:
+        """
+        Runs the remaining stages of a claimed job, checkpointing after each one so a retry
+        continues from the stage that failed. Stops if another worker claimed the job since
+        """
+        with track_stage("parse"):
+            email_msg = parse_email(job.raw_message)
+        checkpoint = dict(job.checkpoint or {})
+        stage = job.stage
+        with keep_job_leased(job.id, job.claim_token):
+            try:
+                self.load_config()
+                while stage != DONE:
+                    stage = self.run_job_stage(stage, email_msg, checkpoint)
+                    # the lease is renewed with every checkpoint
+                    if not save_email_job_stage(
+                        job.id,
+                        job.claim_token,
+                        stage,
+                        checkpoint,
+                        datetime.utcnow() + JOB_LEASE,
+                    ):
+                        log_job_claim_lost(job.id)
+                        return
+            except Exception as e:
+                attempts = job.attempts + 1 if stage == job.stage else 1
+                retry_delay = get_retry_delay(stage, attempts)
+                if retry_delay is None:
+                    logging.exception(
+                        f"Email job {job.id} failed at stage {stage} after {attempts} attempts"
+                    )
+                    saved = fail_email_job(job.id, job.claim_token, attempts, repr(e))
+                else:
+                    logging.exception(
+                        f"Email job {job.id} failed at stage {stage}, retrying in {retry_delay}"
+                    )
+                    saved = retry_email_job(
+                        job.id,
+                        job.claim_token,
+                        attempts,
+                        repr(e),
+                        datetime.utcnow() + retry_delay,
+                    )
+                if not saved:
+                    log_job_claim_lost(job.id)
+                return
+        EMAILS_PROCESSED.inc()
+        logging.info(f"Email job {job.id} done")
+
+    def add_to_drive(self, email_message: EmailMessage, item_folder: dict) -> None:
         logging.info("Saving email and it's attachements to google drive")
         gdrive = GoogleDrive()
-        return gdrive.add_email(email_message, project_items, project)
+        gdrive.add_email(email_message, item_folder)
 
     def add_to_sheet(
-        self, email_message_text: str, email_details: EmailDetails
-    ) -> Tuple[Project, List[ProjectItemGSheet]]:
+        self,
+        email_message_text: str,
+        email_details: EmailDetails,
+        project_name: str | None = None,
+    ) -> Tuple[Project, List[ProjectItemGSheet], dict]:
+        """
+        Adds the email items to the project gsheets along with a link to a new gdrive
+        folder for the email. Returns the project, items and the gdrive folder
+        """
         logging.info("Finding project based on name, plot and/or linked contacts")
-        project = self.chatgpt.get_project_to_add_to(
-            email_message_text,
-            email_details,
-            self.config.projects,
-            self.config.prompt_project,
-        )
+        if project_name is None:
+            project = self.chatgpt.get_project_to_add_to(
+                email_message_text,
+                email_details,
+                self.project_matcher,
+                self.prompt_templates.project,
+            )
+        else:
+            project = get_project_for_email_details(
+                self.project_matcher, project_name, email_details, email_message_text
+            )
         if project is None:
             project = Project(
                 name="Misc",
@@ -78,6 +350,9 @@ class EmailForwarder:
                 google_sheet_url_windows=self.config.misc_sheet_url,
                 google_sheet_url_carpentry=None,
             )
+        logging.info(f"Project matched: {project.name}")
+        email_details.project_name = project.name
+
         if (
             not project.google_sheet_url_windows
             and not project.google_sheet_url_carpentry
@@ -85,17 +360,19 @@ class EmailForwarder:
             logging.error(
                 "No matching project and misc sheet url not set. Can't add project item to gsheet."
             )
-            return
-        logging.info(f"Project matched: {project.name}")
-        email_details.project_name = project.name
+            available_gsheet = None
+        else:
+            (
+                available_gsheet,
+                gsheet_windows,
+                gsheet_carpentry,
+            ) = self.get_google_sheets_for_project(project)
+        if available_gsheet is None:
+            return project, [], GoogleDrive().create_item_folder([], project)
 
-        (
-            available_gsheet,
-            gsheet_windows,
-            gsheet_carpentry,
-        ) = self.get_google_sheets_for_project(project)
-        if available_gsheet == None:
-            return project, []
+        # items are grouped by sheet url as both project sheets can be the same
+        gsheets: Dict[str, GoogleSheet] = {}
+        items_by_gsheet: Dict[str, List[ProjectItemGSheet]] = {}
         project_items = []
         for item in email_details.items:
             project_item = ProjectItemGSheet(
@@ -108,37 +385,35 @@ class EmailForwarder:
                 item_type=item.item_type,
             )
             if item.item_type == "windows" and gsheet_windows:
-                gsheet_windows.insert_project_item(project_item)
+                gsheet = gsheet_windows
             elif item.item_type == "carpentry" and gsheet_carpentry:
-                gsheet_carpentry.insert_project_item(project_item)
+                gsheet = gsheet_carpentry
             else:
-                available_gsheet.insert_project_item(project_item)
-            logging.info(
-                f"Added project item with description {project_item.item_description} to gsheet for project {project.name}"
-            )
+                gsheet = available_gsheet
+            gsheets[gsheet.sheet_url] = gsheet
+            items_by_gsheet.setdefault(gsheet.sheet_url, []).append(project_item)
             project_items.append(project_item)
-        return project, project_items
 
-    def add_gdrive_url_to_sheet(
-        self, gdrive_url: str, project: Project, project_items: List[ProjectItemGSheet]
-    ) -> None:
-        (
-            available_gsheet,
-            gsheet_windows,
-            gsheet_carpentry,
-        ) = self.get_google_sheets_for_project(project)
-        for project_item in project_items:
-            try:
-                if project_item.item_type == "windows" and gsheet_windows:
-                    gsheet_windows.insert_gdrive_link(gdrive_url, project_item)
-                elif project_item.item_type == "carpentry" and gsheet_carpentry:
-                    gsheet_carpentry.insert_gdrive_link(gdrive_url, project_item)
-                else:
-                    available_gsheet.insert_gdrive_link(gdrive_url, project_item)
-            except ValueError:
-                logging.error(
-                    f"Error insert gdrive url for project item {project_item.item_ref}. Item does not exist"
+        # The gdrive folder is named after the item refs and its link goes into the
+        # new rows, so refs, folder and rows are all done under the sheet locks.
+        # Locks are taken in url order so two emails can't deadlock, also across workers.
+        with ExitStack() as stack:
+            for sheet_url in sorted(gsheets):
+                stack.enter_context(gsheets[sheet_url].lock())
+            new_items_by_gsheet = {
+                sheet_url: gsheets[sheet_url].assign_item_refs(items)
+                for sheet_url, items in items_by_gsheet.items()
+            }
+            item_folder = GoogleDrive().create_item_folder(project_items, project)
+            for sheet_url, new_items in new_items_by_gsheet.items():
+                gsheets[sheet_url].insert_project_items(
+                    new_items, item_folder["webViewLink"]
                 )
+                for project_item in new_items:
+                    logging.info(
+                        f"Added project item with description {project_item.item_description} to gsheet for project {project.name}"
+                    )
+        return project, project_items, item_folder
 
     def get_google_sheets_for_project(
         self, project: Project
@@ -170,15 +445,73 @@ class EmailForwarder:
             available_gsheet = gsheet_carpentry
         return available_gsheet, gsheet_windows, gsheet_carpentry
 
-    def process_email(self, email_msg_text: str) -> EmailDetails:
+    def process_email(
+        self, email_msg: Message, email_msg_text: str
+    ) -> Tuple[EmailDetails, ReceiverEmail, str, str | None]:
         """
-        Processes and extracts details from email using chatgpt
+        Processes and extracts details from email using chatgpt. Also returns the
+        reciever email and topic to forward to, and the project name if it was
+        requested in the same completion (None otherwise)
         """
-        logging.info("Getting email details from chatgpt")
-        email_details = self.chatgpt.get_email_details(
-            email_msg_text, self.config.prompt_subject_line, self.config.project_types
-        )
-        project_type_dict = create_project_type_dict(self.config.project_types)
+        combined_details = None
+        if self.prompt_templates.combined is not None:
+            logging.info("Getting email details, topic and project from chatgpt")
+            combined_details = self.chatgpt.get_combined_details(
+                email_msg_text,
+                self.prompt_templates.combined,
+                self.config.receiver_emails,
+            )
+            if combined_details is None:
+                logging.info("Falling back to separate chatgpt requests")
+
+        local_routing = None
+        if combined_details is None:
+            local_routing = self.route_locally(email_msg, email_msg_text)
+
+        if combined_details is not None:
+            email_details, reciever_email, topic, project_name = combined_details
+        elif local_routing is not None:
+            reciever_email, topic = local_routing
+            logging.info("Getting email details from chatgpt")
+            email_details = self.chatgpt.get_email_details(
+                email_msg_text, self.prompt_templates.email_details
+            )
+            project_name = None
+        else:
+            logging.info("Getting email details and topic from chatgpt")
+            (
+                email_details,
+                reciever_email,
+                topic,
+            ) = self.chatgpt.get_email_details_and_reciever_email(
+                email_msg_text,
+                self.prompt_templates.email_details,
+                self.config.receiver_emails,
+                self.prompt_templates.forward_email,
+            )
+            project_name = None
+        self.set_item_rates(email_details)
+
+        return email_details, reciever_email, topic, project_name
+
+    def route_locally(
+        self, email_msg: Message, email_msg_text: str
+    ) -> Tuple[ReceiverEmail, str] | None:
+        """
+        Returns the reciever email and topic of emails that can be routed without chatgpt,
+        None otherwise. Looks up the topic of earlier emails of the thread in the database
+        """
+        local_routing = self.pre_classifier.classify(email_msg, email_msg_text)
+        self.routing_stats.record(routed_locally=local_routing is not None)
+        if local_routing is not None:
+            logging.info(f"Routed email to topic {local_routing[1]} without chatgpt")
+        return local_routing
+
+    def set_item_rates(self, email_details: EmailDetails) -> None:
+        """
+        Sets the day or hour rate of the project type on the items charged by time
+        """
+        project_type_dict = self.prompt_templates.project_type_dict
         for item in email_details.items:
             if item.item_type and item.unit_time:
                 if item.unit_time == "day":
@@ -186,8 +519,6 @@ class EmailForwarder:
                 else:
                     item.rate = project_type_dict[item.item_type]["hourly_rate"]
 
-        return email_details
-
     def forward_email(
         self,
         reciever_email: ReceiverEmail,
@@ -197,7 +528,16 @@ class EmailForwarder:
         """
         Forwards the email to the given reciever. Modifies subject based on email details.
         """
+        self.send_email(
+            self.create_forward_email(reciever_email, email_details, email_message)
+        )
 
+    def create_forward_email(
+        self,
+        reciever_email: ReceiverEmail,
+        email_details: EmailDetails,
+        email_message: EmailMessage,
+    ) -> Message:
         subject_line = create_subject_line(email_details)
         logging.info(f"Got subject line from chatgpt {subject_line}")
 
@@ -212,7 +552,7 @@ class EmailForwarder:
             email_message = append_html_at_start_of_email(
                 reciever_email.header, email_message
             )
-        self.send_email(email_message)
+        return email_message
 
     def construct_email_msg_for_chatgpt(self, email_msg: Message) -> Tuple[str, str]:
         email_message = "From: %s\nTo: %s\nDate: %s\nSubject: %s\n\n" % (
@@ -222,64 +562,416 @@ class EmailForwarder:
             str(email_msg["Subject"]),
         )
 
-        body = get_body_from_email_msg(email_msg)
+        body = fit_to_token_budget(
+            get_clean_body_from_email_msg(email_msg), MAX_EMAIL_BODY_TOKENS
+        )
         email_message += body
         return email_message, body
 
     def load_config(self) -> None:
         """
-        Loads the configuration JSON from DB
+        Loads the configuration JSON of the mailbox from DB. The configuration, prompt
+        templates and indexes derived from it are only rebuilt if the config version changed
+        since the last load
         """
-        config = get_config_from_db()
+        with self.config_lock:
+            self._load_config()
+
+    def _load_config(self) -> None:
+        if self.config_version is not None and not self.has_config_update():
+            return
+        self.config_update_pending = False
+        if self.config_listener is None:
+            # listen before reading, so no update after the read is missed
+            self.config_listener = listen_for_config_updates()
+        config = get_config_from_db(self.mailbox)
         if not config:
-            raise Exception("Config not set!")
+            raise Exception(f"Config not set for mailbox {self.mailbox}!")
+        if config.version == self.config_version:
+            return
         config_json = config.config_json
         self.config: Configuration = Configuration.from_dict(config_json)
-        self.chatgpt = ChatGPT(self.config.openai_api_key)
+        self.prompt_templates = PromptTemplates(self.config)
+        self.project_matcher = ProjectMatcher(self.config.projects)
+        self.pre_classifier = PreClassifier(
+            self.mailbox,
+            self.config.receiver_emails,
+            self.config.project_types,
+            self.config.automated_email_topic,
+        )
+        self.chatgpt = self.chatgpt_class(
+            self.config.openai_api_key, self.response_cache
+        )
+        self.update_imap_session()
+        self.update_smtp_pool()
+        self.config_version = config.version
+        logging.info(
+            f"Loaded config version {config.version} of mailbox {self.mailbox}"
+        )
+
+    def has_config_update(self) -> bool:
+        """
+        Returns whether the config was updated since it was loaded. Must be called with the
+        config lock held
+        """
+        if not self.config_update_pending:
+            self.config_update_pending = self.config_changed()
+        return self.config_update_pending
+
+    def should_stop_waiting(self, stop_event: threading.Event | None = None) -> bool:
+        """
+        Returns whether waiting for new emails should end early, as the mailbox is stopped or
+        its config was updated
+        """
+        if stop_event is not None and stop_event.is_set():
+            return True
+        try:
+            with self.config_lock:
+                return self.has_config_update()
+        except Exception as e:
+            logging.warning(f"Couldn't check for config updates: {e}")
+            return False
+
+    def config_changed(self) -> bool:
+        """
+        Cheap check for config updates: a notification on postgres, a query of the config
+        version otherwise
+        """
+        if self.config_listener is not None:
+            try:
+                return self.config_listener.has_changed(self.mailbox)
+            except Exception as e:
+                logging.warning(f"Config listener failed: {e}")
+                self.config_listener.close()
+                self.config_listener = None
+                # updates may have been missed while the connection was down
+                return True
+        return get_config_version(self.mailbox) != self.config_version
+
+    def update_imap_session(self) -> None:
+        """
+        Keeps the IMAP session open across iterations, replacing it only if the IMAP settings changed
+        """
+        imap_settings = (
+            self.config.imap_host,
+            int(self.config.imap_port),
+            self.config.email,
+            self.config.password,
+        )
+        if self.imap_session is not None:
+            if self.imap_session.matches(*imap_settings):
+                return
+            self.imap_session.close()
+        self.imap_session = IMAPSession(*imap_settings)
+
+    def update_smtp_pool(self) -> None:
+        """
+        Keeps SMTP sessions open across emails, replacing them only if the SMTP settings changed
+        """
+        smtp_settings = (
+            self.config.smtp_server,
+            int(self.config.smtp_port),
+            self.config.email,
+            self.config.password,
+        )
+        if self.smtp_pool is not None:
+            if self.smtp_pool.matches(*smtp_settings):
+                return
+            self.smtp_pool.close()
+        self.smtp_pool = SMTPPool(*smtp_settings, Env.SMTP_CONNECTIONS)
 
-    def get_new_emails(self) -> Iterator[Message]:
+    def get_new_emails(self) -> Iterator[Tuple[int, Message]]:
         """
-        An iterator to login to IMAP, yield new emails and logout
+        An iterator to yield the UID and message of emails received since the last processed one
         """
-        mail = imaplib.IMAP4_SSL(self.config.imap_host, int(self.config.imap_port))
-        rc, resp = mail.login(self.config.email, self.config.password)
-        mail.select("Inbox")
-        status, data = mail.search(None, "(UNSEEN)")
+        for uid, raw_email in self.get_new_raw_emails():
+            with track_stage("parse"):
+                email_msg = parse_email(raw_email)
+            yield uid, email_msg
 
-        for num in data[0].split():
+    def get_new_raw_emails(self) -> Iterator[Tuple[int, bytes]]:
+        """
+        An iterator to yield the UID and raw bytes of emails received since the last processed one
+        """
+        last_uid = self.get_last_processed_uid()
+        uids = [
+            uid
+            for uid in self.imap_session.search_uids(f"UID {last_uid + 1}:*")
+            if uid > last_uid
+        ]
+        uids = self.get_due_uids(last_uid, uids)
+
+        for uid, raw_email in self.imap_session.fetch_emails(uids):
             logging.info("Found new email")
-            status, data = mail.fetch(num, "(RFC822)")
-            email_msg = data[0][1]
-            yield email.message_from_bytes(email_msg, policy=policy.SMTP)
+            yield uid, raw_email
 
-        mail.logout()
+    def get_last_processed_uid(self) -> int:
+        """
+        Returns the UID high-water mark persisted for the mailbox. On first run, or if the mailbox
+        UIDVALIDITY changed, it starts just before the oldest unseen email
+        """
+        self.imap_session.get_connection()
+        uidvalidity = self.imap_session.uidvalidity
+        mailbox_state = get_mailbox_state(self.imap_session.name)
+        if mailbox_state is not None and mailbox_state.uidvalidity == uidvalidity:
+            return mailbox_state.last_uid
 
-    def run_loop(self) -> None:
+        unseen_uids = self.imap_session.search_uids("UNSEEN")
+        if unseen_uids:
+            last_uid = min(unseen_uids) - 1
+        else:
+            last_uid = self.imap_session.get_uid_next() - 1
+        advance_mailbox_state(self.imap_session.name, uidvalidity, last_uid)
+        return last_uid
+
+    def get_due_uids(self, last_uid: int, uids: List[int]) -> List[int]:
         """
-        Runs the Email Forwarding process in a loop
+        Returns the given UIDs above the high-water mark, except those of emails already
+        processed, set aside or waiting for a retry. Emails finish out of order, so the mark
+        is moved here past the emails finished since, in UID order
+        """
+        mailbox_emails = get_mailbox_emails(
+            self.imap_session.name, self.imap_session.uidvalidity
+        )
+        finished_uid = last_uid
+        for uid in uids:
+            mailbox_email = mailbox_emails.get(uid)
+            if mailbox_email is None or mailbox_email.next_attempt_at is not None:
+                break
+            finished_uid = uid
+        if finished_uid != last_uid:
+            advance_mailbox_state(
+                self.imap_session.name, self.imap_session.uidvalidity, finished_uid
+            )
+
+        now = datetime.utcnow()
+        due_uids = []
+        for uid in uids:
+            if uid <= finished_uid:
+                continue
+            mailbox_email = mailbox_emails.get(uid)
+            # processed and set aside emails have no next attempt
+            if mailbox_email is None or (
+                mailbox_email.next_attempt_at is not None
+                and mailbox_email.next_attempt_at <= now
+            ):
+                due_uids.append(uid)
+        return due_uids
+
+    def record_email_failed(self, uid: int, error: Exception) -> None:
+        """
+        Logs the failure and records it, so the email is retried with backoff and set aside
+        after too many attempts
+        """
+        mailbox_email = fail_mailbox_email(
+            self.imap_session.name, self.imap_session.uidvalidity, uid, repr(error)
+        )
+        if mailbox_email.next_attempt_at is None:
+            logging.error(
+                f"Setting email {uid} of {self.imap_session.name} aside after {mailbox_email.attempts} failed attempts: {error!r}",
+                exc_info=error,
+            )
+        else:
+            logging.error(
+                f"Processing email {uid} of {self.imap_session.name} failed, retrying after {mailbox_email.next_attempt_at}: {error!r}",
+                exc_info=error,
+            )
+
+    def run_loop(self, stop_event: threading.Event | None = None) -> None:
+        """
+        Runs the Email Forwarding process in a loop, until the stop event is set
         """
 
         self.load_config()
         logging.info(f"Logged in as {self.config.email}")
         logging.info("Listening for new emails...")
-        while True:
-            self.run_process()
-            time.sleep(5)
+        while stop_event is None or not stop_event.is_set():
+            try:
+                self.run_process()
+            except imaplib.IMAP4.abort as e:
+                logging.error(f"IMAP connection lost: {e}. Reconnecting")
+                self.imap_session.reconnect()
+                continue
+            delete_old_email_topics(
+                self.mailbox, datetime.utcnow() - EMAIL_TOPIC_RETENTION
+            )
+            self.imap_session.wait_for_new_emails(
+                lambda: self.should_stop_waiting(stop_event)
+            )
+
+    def run_ingest_loop(self, stop_event: threading.Event | None = None) -> None:
+        """
+        Queues new emails for the job workers in a loop, until the stop event is set. Nothing
+        slow runs while the IMAP connection is in use
+        """
+        self.load_config()
+        logging.info(f"Logged in as {self.config.email}")
+        logging.info("Queueing new emails...")
+        while stop_event is None or not stop_event.is_set():
+            try:
+                self.load_config()
+                self.enqueue_new_emails()
+                self.mark_done_jobs_seen()
+            except imaplib.IMAP4.abort as e:
+                logging.error(f"IMAP connection lost: {e}. Reconnecting")
+                self.imap_session.reconnect()
+                continue
+            delete_done_email_jobs(datetime.utcnow() - JOB_RETENTION)
+            delete_old_email_topics(
+                self.mailbox, datetime.utcnow() - EMAIL_TOPIC_RETENTION
+            )
+            self.imap_session.wait_for_new_emails(
+                lambda: self.should_stop_waiting(stop_event)
+            )
+
+    def enqueue_new_emails(self) -> None:
+        """
+        Queues new emails as jobs. They are only recorded as processed here, the worker has
+        no IMAP connection so they are marked as seen once their job is done
+        """
+        for uid, raw_email in self.get_new_raw_emails():
+            enqueue_email_job(
+                self.mailbox,
+                self.imap_session.uidvalidity,
+                uid,
+                raw_email,
+                CLASSIFY,
+            )
+            save_mailbox_email_processed(
+                self.imap_session.name, self.imap_session.uidvalidity, uid
+            )
+
+    def mark_done_jobs_seen(self) -> None:
+        """
+        Marks the emails of done jobs as seen. Emails of failed jobs are left unseen
+        """
+        uidvalidity = self.imap_session.uidvalidity
+        uids = get_unseen_done_email_job_uids(self.mailbox, uidvalidity)
+        for uid in uids:
+            self.imap_session.mark_seen(uid)
+        if uids:
+            save_email_jobs_seen(self.mailbox, uidvalidity, uids)
+
+    def close(self) -> None:
+        if self.imap_session is not None:
+            self.imap_session.close()
+        if self.smtp_pool is not None:
+            self.smtp_pool.close()
 
     def send_email(self, email_message: Message) -> None:
         """
         Send email to given reciever
         """
+        logging.info(f"Forwarding email to {email_message['To']}")
+        self.smtp_pool.send(email_message)
+
+
+class MailboxSupervisor:
+    """
+    Runs the forwarders of all configured mailboxes in one process, each on its own schedule.
+    The chatgpt cache, google clients and thread pools are shared between mailboxes.
+    Mailboxes are started and stopped as their configs are added and deleted
+    """
+
+    def __init__(self) -> None:
+        self.response_cache = create_response_cache()
+        self.forwarders: Dict[str, EmailForwarder] = {}
+        self.stop_events: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def get_forwarder(self, mailbox: str) -> EmailForwarder:
+        with self._lock:
+            if mailbox not in self.forwarders:
+                self.forwarders[mailbox] = EmailForwarder(mailbox, self.response_cache)
+            return self.forwarders[mailbox]
+
+    def run(self, mode: str | None = None) -> None:
+        """
+        Runs the forwarding loop of every mailbox, or with the "ingest" mode only queues their
+        emails. The "worker" mode processes the queued emails of all mailboxes
+        """
+        self.response_cache.evict()
+        if mode == "worker":
+            logging.info("Waiting for queued emails...")
+            for i in range(max(Env.EMAIL_WORKERS, 1)):
+                threading.Thread(
+                    target=self.run_job_worker, name=f"email-job-{i}", daemon=True
+                ).start()
+        while True:
+            try:
+                mailboxes = get_config_mailboxes()
+            except Exception:
+                logging.exception("Couldn't get the configured mailboxes")
+                mailboxes = list(self.stop_events)
+            if mode == "worker":
+                self.drop_forwarders(mailboxes)
+            else:
+                self.sync_mailbox_loops(mailboxes, mode == "ingest")
+            time.sleep(MAILBOX_SYNC_INTERVAL)
+
+    def sync_mailbox_loops(self, mailboxes: List[str], ingest: bool) -> None:
+        """
+        Starts a loop for new mailboxes, and stops those of deleted mailboxes
+        """
+        for mailbox in mailboxes:
+            if mailbox in self.stop_events:
+                continue
+            logging.info(f"Starting mailbox {mailbox}")
+            stop_event = threading.Event()
+            self.stop_events[mailbox] = stop_event
+            threading.Thread(
+                target=self.run_mailbox_loop,
+                args=(self.get_forwarder(mailbox), stop_event, ingest),
+                name=f"mailbox-{mailbox}",
+                daemon=True,
+            ).start()
+        for mailbox in list(self.stop_events):
+            if mailbox not in mailboxes:
+                logging.info(f"Stopping mailbox {mailbox}")
+                self.stop_events.pop(mailbox).set()
+                # the stopping loop closes its forwarder, a re-added mailbox gets a new one
+                with self._lock:
+                    self.forwarders.pop(mailbox, None)
+
+    def run_mailbox_loop(
+        self, forwarder: EmailForwarder, stop_event: threading.Event, ingest: bool
+    ) -> None:
+        """
+        Runs the loop of one mailbox until it is stopped, restarting it if it crashes so one
+        mailbox can't take the others down
+        """
+        while not stop_event.is_set():
+            try:
+                if ingest:
+                    forwarder.run_ingest_loop(stop_event)
+                else:
+                    forwarder.run_loop(stop_event)
+            except Exception:
+                logging.exception(
+                    f"Mailbox {forwarder.mailbox} crashed, restarting in {MAILBOX_RESTART_DELAY}s"
+                )
+                stop_event.wait(MAILBOX_RESTART_DELAY)
+        forwarder.close()
 
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL(
-            self.config.smtp_server, int(self.config.smtp_port), context=context
-        ) as server:
-            logging.info(f"Forwarding email to {email_message['To']}")
-            server.login(self.config.email, self.config.password)
-            server.send_message(email_message)
+    def drop_forwarders(self, mailboxes: List[str]) -> None:
+        with self._lock:
+            for mailbox in list(self.forwarders):
+                if mailbox not in mailboxes:
+                    self.forwarders.pop(mailbox).close()
+
+    def run_job_worker(self) -> None:
+        while True:
+            try:
+                job = claim_email_job(JOB_LEASE)
+            except Exception:
+                logging.exception("Couldn't claim email job")
+                job = None
+            if job is None:
+                time.sleep(JOB_POLL_INTERVAL)
+                continue
+            self.get_forwarder(job.mailbox).process_job(job)
 
 
 if __name__ == "__main__":
-    email_forwarder = EmailForwarder()
-    email_forwarder.run_loop()
+    mode = sys.argv[1] if len(sys.argv) > 1 else None
+    MailboxSupervisor().run(mode)
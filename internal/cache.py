@@ -0,0 +1,56 @@
+import hashlib
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from internal.db import (evict_cached_responses, get_cached_response,
+                         save_cached_response)
+from internal.metrics import LLM_CACHE_REQUESTS
+
+EVICT_EVERY_N_SAVES = 100
+
+
+class ResponseCache:
+    """
+    Persistent cache of chatgpt responses keyed on a hash of model, prompt and temperature
+    """
+
+    def __init__(self, ttl: timedelta, max_entries: int) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._saves = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, prompt: str, temperature: float) -> str:
+        key = json.dumps([model, prompt, temperature])
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        response = get_cached_response(key, datetime.utcnow() - self.ttl)
+        with self._lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        LLM_CACHE_REQUESTS.labels("miss" if response is None else "hit").inc()
+        return response
+
+    def save(self, key: str, response: str) -> None:
+        save_cached_response(key, response)
+        with self._lock:
+            self._saves += 1
+            should_evict = self._saves % EVICT_EVERY_N_SAVES == 0
+        if should_evict:
+            self.evict()
+
+    def evict(self) -> None:
+        deleted = evict_cached_responses(
+            datetime.utcnow() - self.ttl, self.max_entries
+        )
+        logging.info(
+            f"ChatGPT cache: {self.hits} hits, {self.misses} misses, evicted {deleted} responses"
+        )
@@ -1,118 +1,297 @@
-from typing import List, Tuple
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple, TypeVar
 
 import openai
 
-from internal.data_types import (EmailDetails, Project, ProjectType,
+from internal.cache import ResponseCache
+from internal.data_types import (CombinedEmailDetails, EmailDetails, Project,
                                  ReceiverEmail)
-from internal.utils import (comma_seperated_to_list, create_project_type_dict,
-                            get_project_based_on_details,
-                            get_reciever_email_by_name, is_prompt_long,
-                            remove_middle_words)
+from internal.metrics import LLM_REQUEST_SECONDS, LLM_TOKENS
+from internal.prompt_budget import PromptBudget, count_tokens
+from internal.ratelimit import openai_limiter
+from internal.utils import (ProjectMatcher, get_project_for_email_details,
+                            get_reciever_email_by_name)
+
+MODEL = "gpt-3.5-turbo"
+TEMPERATURE = 0
+# counted against the tokens per minute limit on top of the prompt
+COMPLETION_TOKENS_ESTIMATE = 500
+# prompt types, the prompt label of the chatgpt metrics
+EMAIL_DETAILS_PROMPT = "email_details"
+TOPIC_PROMPT = "topic"
+PROJECT_PROMPT = "project"
+COMBINED_PROMPT = "combined"
+# raised by the response parsers on invalid responses
+PARSE_ERRORS = (ValueError, KeyError, TypeError, AttributeError)
+
+T = TypeVar("T")
 
 
 class ChatGPT:
-    def __init__(self, api_key: str) -> None:
-        openai.api_key = api_key
+    def __init__(self, api_key: str, cache: ResponseCache | None = None) -> None:
+        # passed with every request rather than set on the module, as each mailbox
+        # can have its own key
+        self.api_key = api_key
+        self.cache = cache
 
-    def request(self, prompt: str) -> str:
+    def request(
+        self,
+        prompt: str,
+        prompt_type: str,
+        parse: Callable[[str], T] | None = None,
+    ) -> T | str:
         """
-        Make a request to chatgpt with given prompt
+        Make a request to chatgpt with given prompt, returning the response passed through
+        parse if given. Responses are served from the cache when available, as the same
+        prompt always gets the same answer at temperature 0. Only responses that parse are
+        cached, parse raises or returns None for invalid ones so they are asked again rather
+        than served from the cache. The prompt type labels the latency and token metrics
         """
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0,
-        )
+        if self.cache:
+            key = ResponseCache.make_key(MODEL, prompt, TEMPERATURE)
+            cached_response = self.parse_cached_response(self.cache.get(key), parse)
+            if cached_response is not None:
+                return cached_response
+
+        with LLM_REQUEST_SECONDS.labels(prompt_type).time():
+            response = openai_limiter.call(
+                openai.ChatCompletion.create,
+                cost=count_tokens(prompt) + COMPLETION_TOKENS_ESTIMATE,
+                model=MODEL,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=TEMPERATURE,
+                api_key=self.api_key,
+            )
+        record_token_usage(prompt_type, response)
+        content = response.choices[0].message["content"]
+        parsed_content = content if parse is None else parse(content)
 
-        return response.choices[0].message["content"]
+        if self.cache and parsed_content is not None:
+            self.cache.save(key, content)
+        return parsed_content
+
+    @staticmethod
+    def parse_cached_response(
+        response: str | None, parse: Callable[[str], T] | None
+    ) -> T | str | None:
+        """
+        Returns the parsed cached response, or None if there is none or it doesn't parse, e.g.
+        as it was cached before responses were validated
+        """
+        if response is None or parse is None:
+            return response
+        try:
+            return parse(response)
+        except PARSE_ERRORS:
+            return None
 
     def get_email_details(
-        self, email_message: str, prompt: str, project_types: List[ProjectType]
+        self, email_message: str, prompt: PromptBudget
     ) -> EmailDetails:
         """
         Request chatgpt to extract email details for the given email message
         """
-        project_type_dict = create_project_type_dict(project_types)
-        while True:
-            prompt = (
-                prompt.replace("{email_message}", email_message)
-                .replace(
-                    "{windows_hourly_rate}",
-                    str(project_type_dict["windows"]["hourly_rate"]),
-                )
-                .replace(
-                    "{windows_day_rate}", str(project_type_dict["windows"]["day_rate"])
-                )
-                .replace(
-                    "{carpentry_hourly_rate}",
-                    str(project_type_dict["carpentry"]["hourly_rate"]),
-                )
-                .replace(
-                    "{carpentry_day_rate}",
-                    str(project_type_dict["carpentry"]["day_rate"]),
-                )
-                .replace(
-                    "{windows_keywords}",
-                    str(
-                        comma_seperated_to_list(
-                            project_type_dict["windows"]["keywords"]
-                        )
-                    ),
-                )
-                .replace(
-                    "{carpentry_keywords}",
-                    str(
-                        comma_seperated_to_list(
-                            project_type_dict["carpentry"]["keywords"]
-                        )
-                    ),
-                )
+        return self.request(
+            prompt.render(email_message), EMAIL_DETAILS_PROMPT, EmailDetails.from_json
+        )
+
+    def get_email_details_and_reciever_email(
+        self,
+        email_message: str,
+        prompt_subject_line: PromptBudget,
+        topic_emails: List[ReceiverEmail],
+        prompt_forward_email: PromptBudget,
+    ) -> Tuple[EmailDetails, ReceiverEmail, str]:
+        """
+        Requests email details and the topic to forward to concurrently, as neither depends on the other
+        """
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            email_details = executor.submit(
+                self.get_email_details,
+                email_message,
+                prompt_subject_line,
+            )
+            reciever_email_and_topic = executor.submit(
+                self.get_reciever_email_and_topic_to_forward_to,
+                email_message,
+                topic_emails,
+                prompt_forward_email,
             )
-            if is_prompt_long(prompt):
-                email_message = remove_middle_words(email_message)
-            else:
-                return EmailDetails.from_json(self.request(prompt))
+            reciever_email, topic = reciever_email_and_topic.result()
+            return email_details.result(), reciever_email, topic
 
     def get_reciever_email_and_topic_to_forward_to(
-        self, email_message: str, topic_emails: List[ReceiverEmail], prompt: str
+        self,
+        email_message: str,
+        topic_emails: List[ReceiverEmail],
+        prompt: PromptBudget,
     ) -> Tuple[ReceiverEmail, str]:
         """
         Request chatgpt to find matching topic and email to forward to for the given email message
         """
-        topics = "\n".join(topic_email.name for topic_email in topic_emails)
-        while True:
-            prompt = prompt.replace("{topics}", topics).replace(
-                "{email_message}", email_message
-            )
-            if is_prompt_long(prompt):
-                email_message = remove_middle_words(email_message)
-            else:
-                topic = self.request(prompt)
-                return get_reciever_email_by_name(topic_emails, topic), topic
+        return self.request(
+            prompt.render(email_message),
+            TOPIC_PROMPT,
+            lambda topic: self.parse_topic(topic, topic_emails),
+        )
+
+    @staticmethod
+    def parse_topic(
+        topic: str, topic_emails: List[ReceiverEmail]
+    ) -> Tuple[ReceiverEmail, str]:
+        reciever_email = get_reciever_email_by_name(topic_emails, topic)
+        if reciever_email is None:
+            raise ValueError(f"No reciever email for topic {topic} from chatgpt")
+        return reciever_email, topic
 
     def get_project_to_add_to(
         self,
         email_message_text: str,
         email_details: EmailDetails,
-        projects: List[Project],
-        prompt: str,
+        project_matcher: ProjectMatcher,
+        prompt: PromptBudget,
     ) -> Project | None:
         """
         Request chatgpt to get matching project and its corresponding sheet url for the given email message. Will return None if no matching project
         """
+        project = self.request(prompt.render(email_message_text), PROJECT_PROMPT)
+        return get_project_for_email_details(
+            project_matcher, project, email_details, email_message_text
+        )
+
+    def get_combined_details(
+        self,
+        email_message: str,
+        prompt: PromptBudget,
+        topic_emails: List[ReceiverEmail],
+    ) -> Tuple[EmailDetails, ReceiverEmail, str, str] | None:
+        """
+        Request chatgpt to extract email details, topic and project name in a single completion.
+        Returns None if the response can't be parsed, so the caller can fall back to separate requests
+        """
+        return self.request(
+            prompt.render(email_message),
+            COMBINED_PROMPT,
+            lambda response: self.parse_combined_details(response, topic_emails),
+        )
+
+    @staticmethod
+    def parse_combined_details(
+        response: str, topic_emails: List[ReceiverEmail]
+    ) -> Tuple[EmailDetails, ReceiverEmail, str, str] | None:
+        try:
+            combined_details = CombinedEmailDetails.from_json(response)
+        except PARSE_ERRORS:
+            logging.warning("Couldn't parse combined response from chatgpt")
+            return None
+        if not isinstance(combined_details.email_details, EmailDetails):
+            logging.warning("Combined response from chatgpt is missing email details")
+            return None
+        reciever_email = get_reciever_email_by_name(
+            topic_emails, combined_details.topic
+        )
+        if reciever_email is None:
+            logging.warning(
+                f"Combined response from chatgpt has unknown topic {combined_details.topic}"
+            )
+            return None
+        return (
+            combined_details.email_details,
+            reciever_email,
+            combined_details.topic,
+            combined_details.project_name or "",
+        )
+
+
+class AsyncChatGPT(ChatGPT):
+    """
+    ChatGPT with coroutine versions of the requests, for the asyncio forwarder. The cache is
+    read and written in a thread, as it is backed by the database
+    """
 
-        project_names = "\n".join([project.name for project in projects])
-        while True:
-            prompt = prompt.replace("{projects}", project_names).replace(
-                "{email_message}", email_message_text
+    async def request_async(
+        self,
+        prompt: str,
+        prompt_type: str,
+        parse: Callable[[str], T] | None = None,
+    ) -> T | str:
+        if self.cache:
+            key = ResponseCache.make_key(MODEL, prompt, TEMPERATURE)
+            cached_response = self.parse_cached_response(
+                await asyncio.to_thread(self.cache.get, key), parse
+            )
+            if cached_response is not None:
+                return cached_response
+
+        with LLM_REQUEST_SECONDS.labels(prompt_type).time():
+            response = await openai_limiter.acall(
+                openai.ChatCompletion.acreate,
+                cost=count_tokens(prompt) + COMPLETION_TOKENS_ESTIMATE,
+                model=MODEL,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=TEMPERATURE,
+                api_key=self.api_key,
             )
-            if is_prompt_long(prompt):
-                email_message = remove_middle_words(email_message)
-            else:
-                project = self.request(prompt)
-                plot = None
-                if email_details.items:
-                    plot = email_details.items[0].plot_no
-                return get_project_based_on_details(
-                    projects, project, plot, email_message_text
-                )
+        record_token_usage(prompt_type, response)
+        content = response.choices[0].message["content"]
+        parsed_content = content if parse is None else parse(content)
+
+        if self.cache and parsed_content is not None:
+            await asyncio.to_thread(self.cache.save, key, content)
+        return parsed_content
+
+    async def get_email_details_async(
+        self, email_message: str, prompt: PromptBudget
+    ) -> EmailDetails:
+        return await self.request_async(
+            prompt.render(email_message), EMAIL_DETAILS_PROMPT, EmailDetails.from_json
+        )
+
+    async def get_email_details_and_reciever_email_async(
+        self,
+        email_message: str,
+        prompt_subject_line: PromptBudget,
+        topic_emails: List[ReceiverEmail],
+        prompt_forward_email: PromptBudget,
+    ) -> Tuple[EmailDetails, ReceiverEmail, str]:
+        email_details, (reciever_email, topic) = await asyncio.gather(
+            self.get_email_details_async(email_message, prompt_subject_line),
+            self.get_reciever_email_and_topic_to_forward_to_async(
+                email_message, topic_emails, prompt_forward_email
+            ),
+        )
+        return email_details, reciever_email, topic
+
+    async def get_reciever_email_and_topic_to_forward_to_async(
+        self,
+        email_message: str,
+        topic_emails: List[ReceiverEmail],
+        prompt: PromptBudget,
+    ) -> Tuple[ReceiverEmail, str]:
+        return await self.request_async(
+            prompt.render(email_message),
+            TOPIC_PROMPT,
+            lambda topic: self.parse_topic(topic, topic_emails),
+        )
+
+    async def get_combined_details_async(
+        self,
+        email_message: str,
+        prompt: PromptBudget,
+        topic_emails: List[ReceiverEmail],
+    ) -> Tuple[EmailDetails, ReceiverEmail, str, str] | None:
+        return await self.request_async(
+            prompt.render(email_message),
+            COMBINED_PROMPT,
+            lambda response: self.parse_combined_details(response, topic_emails),
+        )
+
+
+def record_token_usage(prompt_type: str, response) -> None:
+    usage = response.get("usage")
+    if not usage:
+        return
+    LLM_TOKENS.labels(prompt_type, "prompt").inc(usage.get("prompt_tokens", 0))
+    LLM_TOKENS.labels(prompt_type, "completion").inc(usage.get("completion_tokens", 0))
@@ -0,0 +1,159 @@
+import logging
+import re
+import threading
+from datetime import timedelta
+from email.message import Message
+from typing import List, Tuple
+
+from internal.data_types import ProjectType, ReceiverEmail
+from internal.db import get_thread_topic
+from internal.metrics import ROUTED_EMAILS
+from internal.utils import comma_seperated_to_list, get_reciever_email_by_name
+
+# topics whose emails are added to gsheets, only routed locally if they mention project type keywords
+SHEET_TOPICS = ["order", "variation"]
+SUBJECT_WEIGHT = 3
+BODY_WEIGHT = 1
+# a topic mentioned in the subject is enough, as long as no other topic scores close to it
+MIN_SCORE = SUBJECT_WEIGHT
+MIN_SCORE_RATIO = 2
+BULK_PRECEDENCES = ["bulk", "list", "junk", "auto_reply"]
+# topics of forwarded emails are kept this long to route replies to them
+EMAIL_TOPIC_RETENTION = timedelta(days=90)
+
+
+class PreClassifier:
+    """
+    Cheap local routing in front of chatgpt. Decides the topic of replies to already routed
+    emails, automated emails and emails clearly about one topic. Anything else returns None
+    """
+
+    def __init__(
+        self,
+        mailbox: str,
+        receiver_emails: List[ReceiverEmail],
+        project_types: List[ProjectType],
+        automated_email_topic: str | None,
+    ) -> None:
+        self.mailbox = mailbox
+        self.receiver_emails = receiver_emails
+        self.automated_email_topic = automated_email_topic
+        self.topic_regexes = [
+            (
+                receiver_email.name,
+                re.compile(rf"\b{re.escape(receiver_email.name)}\b", re.IGNORECASE),
+            )
+            for receiver_email in receiver_emails
+            if receiver_email.name.strip()
+        ]
+        keywords = [
+            re.escape(keyword)
+            for project_type in project_types
+            for keyword in comma_seperated_to_list(project_type.keywords)
+        ]
+        self.keywords_regex = None
+        if keywords:
+            self.keywords_regex = re.compile(
+                rf"\b(?:{'|'.join(keywords)})\b", re.IGNORECASE
+            )
+
+    def classify(
+        self, email_msg: Message, email_msg_text: str
+    ) -> Tuple[ReceiverEmail, str] | None:
+        for get_topic in [
+            self.get_thread_topic,
+            self.get_automated_email_topic,
+            self.get_keyword_topic,
+        ]:
+            topic = get_topic(email_msg, email_msg_text)
+            if topic is None:
+                continue
+            reciever_email = get_reciever_email_by_name(self.receiver_emails, topic)
+            if reciever_email is not None:
+                return reciever_email, topic
+        return None
+
+    def get_thread_topic(self, email_msg: Message, email_msg_text: str) -> str | None:
+        """
+        Returns the topic earlier emails of the thread were routed to by this mailbox
+        """
+        message_ids = re.findall(
+            r"<[^>]+>",
+            f"{email_msg.get('In-Reply-To', '')} {email_msg.get('References', '')}",
+        )
+        if not message_ids:
+            return None
+        return get_thread_topic(self.mailbox, message_ids)
+
+    def get_automated_email_topic(
+        self, email_msg: Message, email_msg_text: str
+    ) -> str | None:
+        """
+        Returns the configured topic for automated emails, like auto replies and newsletters
+        """
+        if self.automated_email_topic is None:
+            return None
+        auto_submitted = str(email_msg.get("Auto-Submitted", "no")).strip().lower()
+        precedence = str(email_msg.get("Precedence", "")).strip().lower()
+        if (
+            auto_submitted != "no"
+            or precedence in BULK_PRECEDENCES
+            or email_msg.get("List-Id") is not None
+            or email_msg.get("List-Unsubscribe") is not None
+            or email_msg.get("X-Autoreply") is not None
+            or email_msg.get("X-Autorespond") is not None
+        ):
+            return self.automated_email_topic
+        return None
+
+    def get_keyword_topic(self, email_msg: Message, email_msg_text: str) -> str | None:
+        """
+        Scores topics by mentions of their name in the subject and body. Returns the best topic
+        if it clearly beats the others
+        """
+        subject = str(email_msg.get("Subject", ""))
+        scores = sorted(
+            (
+                (
+                    SUBJECT_WEIGHT * len(regex.findall(subject))
+                    + BODY_WEIGHT * len(regex.findall(email_msg_text)),
+                    topic,
+                )
+                for topic, regex in self.topic_regexes
+            ),
+            reverse=True,
+        )
+        if not scores:
+            return None
+        best_score, topic = scores[0]
+        second_best_score = scores[1][0] if len(scores) > 1 else 0
+        if best_score < MIN_SCORE or best_score < MIN_SCORE_RATIO * second_best_score:
+            return None
+        if topic in SHEET_TOPICS and (
+            self.keywords_regex is None
+            or self.keywords_regex.search(email_msg_text) is None
+        ):
+            return None
+        return topic
+
+
+class RoutingStats:
+    """
+    Counts emails routed with and without chatgpt
+    """
+
+    def __init__(self) -> None:
+        self.routed = 0
+        self.routed_locally = 0
+        self._lock = threading.Lock()
+
+    def record(self, routed_locally: bool) -> None:
+        with self._lock:
+            self.routed += 1
+            if routed_locally:
+                self.routed_locally += 1
+            routed, routed_locally_count = self.routed, self.routed_locally
+        ROUTED_EMAILS.labels("local" if routed_locally else "chatgpt").inc()
+        logging.info(
+            f"Routed {routed_locally_count}/{routed} emails ({routed_locally_count / routed:.0%}) without chatgpt"
+        )
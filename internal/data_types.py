@@ -57,6 +57,8 @@ class Configuration:
     projects: List[Project]
     misc_sheet_url: str
     project_types: List[ProjectType]
+    prompt_combined: str | None = None
+    automated_email_topic: str | None = None
 
 
 @dataclass
@@ -72,6 +74,7 @@ class ProjectItemGSheet:
     item_type: str | None
 
     def __post_init__(self):
+        self.item_ref = None
         self.total = None
         if self.rate is None:
             return
@@ -112,3 +115,11 @@ class EmailDetails:
     project_name: str | None
     project_location: str | None
     items: List[EmailItem]
+
+
+@dataclass_json
+@dataclass
+class CombinedEmailDetails:
+    email_details: EmailDetails
+    topic: str
+    project_name: str | None
@@ -1,28 +1,632 @@
-from sqlalchemy import create_engine, select
+import hashlib
+import logging
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Set
+
+from sqlalchemy import (create_engine, delete, func, inspect, select, text,
+                        update)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session as DBSession
 from sqlalchemy.orm import sessionmaker
 
 from internal.env import Env
-from internal.models import Base, Config
+from internal.jobs import (DONE, EMAIL_RETRY_POLICY, FAILED, FINISHED_STAGES,
+                           get_backoff_delay)
+from internal.models import (Base, ChatGPTResponse, Config, DriveFolder,
+                             EmailJob, EmailTopic, MailboxEmail, MailboxState)
 
 db_url = Env.DATABASE_URL
 db_url = db_url.replace("postgres://", "postgresql+psycopg2://")
 engine = create_engine(db_url)
 Session = sessionmaker(bind=engine)
 
+# notified with the mailbox on every config update, only on postgres
+CONFIG_CHANNEL = "config_changed"
+# mailbox of the config managed without a mailbox, e.g. by the / endpoints
+DEFAULT_MAILBOX = "default"
+# folder id of a project folder claimed by a worker that hasn't created it yet
+PENDING_DRIVE_FOLDER_ID = ""
+
+
+def is_postgres() -> bool:
+    return engine.dialect.name == "postgresql"
+
+
+def add_missing_config_columns() -> None:
+    """
+    Adds the columns added to the config table after it was created, as create_all doesn't
+    alter existing tables
+    """
+    columns = [column["name"] for column in inspect(engine).get_columns("config")]
+    if_not_exists = "IF NOT EXISTS " if is_postgres() else ""
+    with engine.begin() as connection:
+        if "version" not in columns:
+            connection.execute(
+                text(
+                    f"ALTER TABLE config ADD COLUMN {if_not_exists}version INTEGER NOT NULL DEFAULT 1"
+                )
+            )
+        if "updated_at" not in columns:
+            connection.execute(
+                text(
+                    f"ALTER TABLE config ADD COLUMN {if_not_exists}updated_at TIMESTAMP"
+                )
+            )
+        if "mailbox" not in columns:
+            connection.execute(
+                text(
+                    f"ALTER TABLE config ADD COLUMN {if_not_exists}mailbox VARCHAR(320) NOT NULL DEFAULT '{DEFAULT_MAILBOX}'"
+                )
+            )
+            connection.execute(
+                text(
+                    "CREATE UNIQUE INDEX IF NOT EXISTS ix_config_mailbox ON config (mailbox)"
+                )
+            )
+
+
+def add_missing_email_job_columns() -> None:
+    """
+    Adds the columns added to the email_job table after it was created
+    """
+    columns = [column["name"] for column in inspect(engine).get_columns("email_job")]
+    if_not_exists = "IF NOT EXISTS " if is_postgres() else ""
+    with engine.begin() as connection:
+        if "claim_token" not in columns:
+            connection.execute(
+                text(
+                    f"ALTER TABLE email_job ADD COLUMN {if_not_exists}claim_token VARCHAR(32)"
+                )
+            )
+        if "seen" not in columns:
+            connection.execute(
+                text(
+                    f"ALTER TABLE email_job ADD COLUMN {if_not_exists}seen BOOLEAN NOT NULL DEFAULT FALSE"
+                )
+            )
+
+
+def add_missing_email_topic_columns() -> None:
+    """
+    Adds the mailbox column to email_topic tables created before topics were scoped to
+    their mailbox. Existing topics are kept for the default mailbox. On SQLite the primary
+    key stays the message id, as it can't be altered
+    """
+    columns = [column["name"] for column in inspect(engine).get_columns("email_topic")]
+    if "mailbox" in columns:
+        return
+    if_not_exists = "IF NOT EXISTS " if is_postgres() else ""
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                f"ALTER TABLE email_topic ADD COLUMN {if_not_exists}mailbox VARCHAR(320) NOT NULL DEFAULT '{DEFAULT_MAILBOX}'"
+            )
+        )
+        if is_postgres():
+            connection.execute(
+                text(
+                    "ALTER TABLE email_topic DROP CONSTRAINT IF EXISTS email_topic_pkey, "
+                    "ADD PRIMARY KEY (mailbox, message_id)"
+                )
+            )
+        connection.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS ix_email_topic_created_at ON email_topic (created_at)"
+            )
+        )
+
+
 Base.metadata.create_all(engine)
+add_missing_config_columns()
+add_missing_email_job_columns()
+add_missing_email_topic_columns()
+
+
+def get_config_from_db(mailbox: str = DEFAULT_MAILBOX) -> Config | None:
+    with Session() as session:
+        return session.scalar(select(Config).where(Config.mailbox == mailbox))
+
+
+def get_config_version(mailbox: str = DEFAULT_MAILBOX) -> int | None:
+    with Session() as session:
+        return session.scalar(select(Config.version).where(Config.mailbox == mailbox))
 
 
-def get_config_from_db() -> Config:
+def get_config_mailboxes() -> List[str]:
     with Session() as session:
-        return session.scalar(select(Config))
+        return list(session.scalars(select(Config.mailbox).order_by(Config.mailbox)))
 
 
-def update_or_create_config(config_json: dict) -> Config:
-    config = get_config_from_db()
+def update_or_create_config(config_json: dict, mailbox: str = DEFAULT_MAILBOX) -> None:
+    config = get_config_from_db(mailbox)
     if config:
         config.config_json = config_json
+        config.version = Config.version + 1
     else:
-        config = Config(config_json=config_json)
+        config = Config(config_json=config_json, mailbox=mailbox)
     with Session() as session:
         session.add(config)
+        notify_config_listeners(session, mailbox)
+        session.commit()
+
+
+def delete_config(mailbox: str) -> bool:
+    with Session() as session:
+        result = session.execute(delete(Config).where(Config.mailbox == mailbox))
+        notify_config_listeners(session, mailbox)
+        session.commit()
+        return result.rowcount > 0
+
+
+def notify_config_listeners(session: DBSession, mailbox: str) -> None:
+    if is_postgres():
+        # delivered to listeners when the transaction commits
+        session.execute(
+            text("SELECT pg_notify(:channel, :mailbox)"),
+            {"channel": CONFIG_CHANNEL, "mailbox": mailbox},
+        )
+
+
+class ConfigListener:
+    """
+    Postgres LISTEN connection for config updates, so checking for changes doesn't need a
+    query. Uses a connection of its own, outside the pool, shared by all mailboxes
+    """
+
+    def __init__(self) -> None:
+        self.connection = engine.raw_connection()
+        self.connection.detach()
+        self.connection.driver_connection.autocommit = True
+        cursor = self.connection.cursor()
+        cursor.execute(f"LISTEN {CONFIG_CHANNEL}")
+        cursor.close()
+        self.closed = False
+        self.updated_mailboxes: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def has_changed(self, mailbox: str) -> bool:
+        """
+        Returns whether the config of the mailbox was updated since the last call, without
+        blocking
+        """
+        with self._lock:
+            driver_connection = self.connection.driver_connection
+            driver_connection.poll()
+            for notify in driver_connection.notifies:
+                self.updated_mailboxes.add(notify.payload)
+            driver_connection.notifies.clear()
+            if mailbox in self.updated_mailboxes:
+                self.updated_mailboxes.remove(mailbox)
+                return True
+            return False
+
+    def close(self) -> None:
+        self.closed = True
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+
+
+_config_listener: ConfigListener | None = None
+_config_listener_lock = threading.Lock()
+
+
+def listen_for_config_updates() -> ConfigListener | None:
+    """
+    Returns the process-wide listener for config updates, or None if the database doesn't
+    support it
+    """
+    global _config_listener
+    if not is_postgres():
+        return None
+    with _config_listener_lock:
+        if _config_listener is None or _config_listener.closed:
+            try:
+                _config_listener = ConfigListener()
+            except Exception as e:
+                logging.warning(f"Couldn't listen for config updates: {e}")
+                _config_listener = None
+        return _config_listener
+
+
+@contextmanager
+def advisory_lock(name: str) -> Iterator[None]:
+    """
+    Holds a lock shared by every process using the database until the block exits, e.g.
+    by all email workers. Only on postgres, where it is held by a transaction of its own;
+    elsewhere the database isn't shared by processes and it does nothing
+    """
+    if not is_postgres():
+        yield
+        return
+    # advisory locks are keyed on a signed 64 bit integer
+    key = int.from_bytes(hashlib.sha256(name.encode()).digest()[:8], "big", signed=True)
+    with Session() as session, session.begin():
+        session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": key})
+        yield
+
+
+def get_mailbox_state(mailbox: str) -> MailboxState | None:
+    with Session() as session:
+        return session.get(MailboxState, mailbox)
+
+
+def get_mailbox_emails(mailbox: str, uidvalidity: int) -> Dict[int, MailboxEmail]:
+    """
+    Returns the processed and failed emails above the last_uid of the mailbox by uid
+    """
+    with Session() as session:
+        mailbox_emails = session.scalars(
+            select(MailboxEmail).where(
+                MailboxEmail.mailbox == mailbox,
+                MailboxEmail.uidvalidity == uidvalidity,
+            )
+        )
+        return {mailbox_email.uid: mailbox_email for mailbox_email in mailbox_emails}
+
+
+def save_mailbox_email_processed(mailbox: str, uidvalidity: int, uid: int) -> None:
+    with Session() as session:
+        mailbox_email = session.get(MailboxEmail, (mailbox, uidvalidity, uid))
+        if mailbox_email is None:
+            mailbox_email = MailboxEmail(
+                mailbox=mailbox, uidvalidity=uidvalidity, uid=uid, attempts=0
+            )
+            session.add(mailbox_email)
+        mailbox_email.processed = True
+        mailbox_email.next_attempt_at = None
+        session.commit()
+
+
+def fail_mailbox_email(
+    mailbox: str, uidvalidity: int, uid: int, error: str
+) -> MailboxEmail:
+    """
+    Counts a failed attempt at processing the email, scheduling a retry with exponential
+    backoff or, after the max attempts of EMAIL_RETRY_POLICY, setting it aside
+    """
+    with Session() as session:
+        mailbox_email = session.get(MailboxEmail, (mailbox, uidvalidity, uid))
+        if mailbox_email is None:
+            mailbox_email = MailboxEmail(
+                mailbox=mailbox, uidvalidity=uidvalidity, uid=uid, attempts=0
+            )
+            session.add(mailbox_email)
+        mailbox_email.processed = False
+        mailbox_email.attempts += 1
+        mailbox_email.last_error = error
+        retry_delay = get_backoff_delay(EMAIL_RETRY_POLICY, mailbox_email.attempts)
+        mailbox_email.next_attempt_at = (
+            None if retry_delay is None else datetime.utcnow() + retry_delay
+        )
+        session.commit()
+        session.refresh(mailbox_email)
+        session.expunge(mailbox_email)
+        return mailbox_email
+
+
+def advance_mailbox_state(mailbox: str, uidvalidity: int, last_uid: int) -> None:
+    """
+    Moves the last_uid of the mailbox, deleting the emails it moved past and those of an
+    older UIDVALIDITY
+    """
+    with Session() as session:
+        session.merge(
+            MailboxState(mailbox=mailbox, uidvalidity=uidvalidity, last_uid=last_uid)
+        )
+        session.execute(
+            delete(MailboxEmail).where(
+                MailboxEmail.mailbox == mailbox,
+                (MailboxEmail.uidvalidity != uidvalidity)
+                | (MailboxEmail.uid <= last_uid),
+            )
+        )
         session.commit()
+
+
+def get_drive_folder_id(project_name: str) -> str | None:
+    """
+    Returns the id of the project folder, PENDING_DRIVE_FOLDER_ID if a worker claimed the
+    folder and is still creating it, or None if no worker did
+    """
+    with Session() as session:
+        return session.scalar(
+            select(DriveFolder.folder_id).where(
+                DriveFolder.project_name == project_name
+            )
+        )
+
+
+def claim_drive_folder(project_name: str) -> bool:
+    """
+    Returns whether the caller claimed the folder of the project and must create it. Only
+    one worker can insert the row of a project, the others get a primary key conflict
+    """
+    with Session() as session:
+        session.add(
+            DriveFolder(project_name=project_name, folder_id=PENDING_DRIVE_FOLDER_ID)
+        )
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            return False
+        return True
+
+
+def save_drive_folder_id(project_name: str, folder_id: str) -> None:
+    with Session() as session:
+        session.execute(
+            update(DriveFolder)
+            .where(DriveFolder.project_name == project_name)
+            .values(folder_id=folder_id)
+        )
+        session.commit()
+
+
+def delete_drive_folder_id(project_name: str, folder_id: str) -> None:
+    """
+    Deletes the folder id of the project, or the claim with PENDING_DRIVE_FOLDER_ID, unless
+    another worker replaced it meanwhile
+    """
+    with Session() as session:
+        session.execute(
+            delete(DriveFolder).where(
+                DriveFolder.project_name == project_name,
+                DriveFolder.folder_id == folder_id,
+            )
+        )
+        session.commit()
+
+
+def get_thread_topic(mailbox: str, message_ids: List[str]) -> str | None:
+    """
+    Returns the topic of the most recently routed email of the mailbox among the given
+    message ids
+    """
+    with Session() as session:
+        return session.scalar(
+            select(EmailTopic.topic)
+            .where(
+                EmailTopic.mailbox == mailbox,
+                EmailTopic.message_id.in_(message_ids),
+            )
+            .order_by(EmailTopic.created_at.desc())
+            .limit(1)
+        )
+
+
+def save_email_topic(mailbox: str, message_id: str, topic: str) -> None:
+    with Session() as session:
+        session.merge(
+            EmailTopic(
+                mailbox=mailbox,
+                message_id=message_id,
+                topic=topic,
+                created_at=datetime.utcnow(),
+            )
+        )
+        session.commit()
+
+
+def delete_old_email_topics(mailbox: str, created_before: datetime) -> int:
+    with Session() as session:
+        result = session.execute(
+            delete(EmailTopic).where(
+                EmailTopic.mailbox == mailbox, EmailTopic.created_at < created_before
+            )
+        )
+        session.commit()
+        return result.rowcount
+
+
+def get_cached_response(prompt_hash: str, created_after: datetime) -> str | None:
+    with Session() as session:
+        return session.scalar(
+            select(ChatGPTResponse.response).where(
+                ChatGPTResponse.prompt_hash == prompt_hash,
+                ChatGPTResponse.created_at > created_after,
+            )
+        )
+
+
+def save_cached_response(prompt_hash: str, response: str) -> None:
+    with Session() as session:
+        session.merge(
+            ChatGPTResponse(
+                prompt_hash=prompt_hash, response=response, created_at=datetime.utcnow()
+            )
+        )
+        try:
+            session.commit()
+        except IntegrityError:
+            # saved concurrently by another worker for the same prompt
+            session.rollback()
+
+
+def evict_cached_responses(created_before: datetime, max_entries: int) -> int:
+    """
+    Deletes cached responses older than created_before, then the oldest ones beyond max_entries.
+    Returns the number of deleted responses
+    """
+    with Session() as session:
+        deleted = session.execute(
+            delete(ChatGPTResponse).where(ChatGPTResponse.created_at < created_before)
+        ).rowcount
+        cutoff = session.scalar(
+            select(ChatGPTResponse.created_at)
+            .order_by(ChatGPTResponse.created_at.desc())
+            .offset(max_entries)
+            .limit(1)
+        )
+        if cutoff is not None:
+            deleted += session.execute(
+                delete(ChatGPTResponse).where(ChatGPTResponse.created_at <= cutoff)
+            ).rowcount
+        session.commit()
+        return deleted
+
+
+def enqueue_email_job(
+    mailbox: str, uidvalidity: int, uid: int, raw_message: bytes, stage: str
+) -> None:
+    """
+    Queues the email for the job workers. Emails already queued are ignored
+    """
+    with Session() as session:
+        session.add(
+            EmailJob(
+                mailbox=mailbox,
+                uidvalidity=uidvalidity,
+                uid=uid,
+                raw_message=raw_message,
+                stage=stage,
+            )
+        )
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+
+
+def claim_email_job(lease: timedelta) -> EmailJob | None:
+    """
+    Claims the oldest due job, hiding it from other workers for the lease. Jobs being
+    claimed by other workers are skipped instead of waited on
+    """
+    now = datetime.utcnow()
+    with Session(expire_on_commit=False) as session:
+        job = session.scalar(
+            select(EmailJob)
+            .where(
+                EmailJob.stage.not_in(FINISHED_STAGES),
+                EmailJob.next_attempt_at <= now,
+            )
+            .order_by(EmailJob.next_attempt_at)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        if job is None:
+            return None
+        job.next_attempt_at = now + lease
+        job.claim_token = uuid.uuid4().hex
+        session.commit()
+        return job
+
+
+def update_claimed_email_job(job_id: int, claim_token: str, **values) -> bool:
+    """
+    Updates the job if it is still held by the given claim. Returns False if its lease ran
+    out and another worker claimed it since, in which case nothing is updated
+    """
+    with Session() as session:
+        result = session.execute(
+            update(EmailJob)
+            .where(EmailJob.id == job_id, EmailJob.claim_token == claim_token)
+            .values(**values)
+        )
+        session.commit()
+        return result.rowcount == 1
+
+
+def extend_email_job_lease(
+    job_id: int, claim_token: str, next_attempt_at: datetime
+) -> bool:
+    return update_claimed_email_job(
+        job_id, claim_token, next_attempt_at=next_attempt_at
+    )
+
+
+def save_email_job_stage(
+    job_id: int,
+    claim_token: str,
+    stage: str,
+    checkpoint: dict,
+    next_attempt_at: datetime,
+) -> bool:
+    """
+    Checkpoints a finished stage and moves the job on to the given stage
+    """
+    return update_claimed_email_job(
+        job_id,
+        claim_token,
+        stage=stage,
+        checkpoint=checkpoint,
+        attempts=0,
+        last_error=None,
+        next_attempt_at=next_attempt_at,
+    )
+
+
+def retry_email_job(
+    job_id: int,
+    claim_token: str,
+    attempts: int,
+    error: str,
+    next_attempt_at: datetime,
+) -> bool:
+    return update_claimed_email_job(
+        job_id,
+        claim_token,
+        attempts=attempts,
+        last_error=error,
+        next_attempt_at=next_attempt_at,
+    )
+
+
+def fail_email_job(job_id: int, claim_token: str, attempts: int, error: str) -> bool:
+    return update_claimed_email_job(
+        job_id, claim_token, stage=FAILED, attempts=attempts, last_error=error
+    )
+
+
+def delete_done_email_jobs(done_before: datetime) -> int:
+    with Session() as session:
+        result = session.execute(
+            delete(EmailJob).where(
+                EmailJob.stage == DONE, EmailJob.updated_at < done_before
+            )
+        )
+        session.commit()
+        return result.rowcount
+
+
+def get_unseen_done_email_job_uids(mailbox: str, uidvalidity: int) -> List[int]:
+    with Session() as session:
+        return list(
+            session.scalars(
+                select(EmailJob.uid).where(
+                    EmailJob.mailbox == mailbox,
+                    EmailJob.uidvalidity == uidvalidity,
+                    EmailJob.stage == DONE,
+                    EmailJob.seen.is_(False),
+                )
+            )
+        )
+
+
+def save_email_jobs_seen(mailbox: str, uidvalidity: int, uids: List[int]) -> None:
+    with Session() as session:
+        session.execute(
+            update(EmailJob)
+            .where(
+                EmailJob.mailbox == mailbox,
+                EmailJob.uidvalidity == uidvalidity,
+                EmailJob.uid.in_(uids),
+            )
+            .values(seen=True)
+        )
+        session.commit()
+
+
+def count_email_jobs_by_stage() -> Dict[str, int]:
+    with Session() as session:
+        return dict(
+            session.execute(
+                select(EmailJob.stage, func.count()).group_by(EmailJob.stage)
+            ).all()
+        )
@@ -20,6 +20,17 @@ def _parse_bool(val: Union[str, bool]) -> bool:  # pylint: disable=E1136
 class AppEnv:
     DATABASE_URL: str
     GOOGLE_SERVICE_ACCOUNT_KEY_JSON: str
+    EMAIL_WORKERS: int = 1
+    CHATGPT_CACHE_TTL_HOURS: int = 720
+    CHATGPT_CACHE_MAX_ENTRIES: int = 10000
+    DRIVE_UPLOAD_WORKERS: int = 4
+    SMTP_CONNECTIONS: int = 1
+    OPENAI_REQUESTS_PER_MINUTE: int = 3500
+    OPENAI_TOKENS_PER_MINUTE: int = 90000
+    SHEETS_REQUESTS_PER_MINUTE: int = 60
+    DRIVE_REQUESTS_PER_MINUTE: int = 600
+    API_MAX_RETRIES: int = 5
+    ASYNC_MAX_IN_FLIGHT: int = 100
 
     """
     Map environment variables to class fields according to these rules:
@@ -0,0 +1,80 @@
+import json
+import threading
+import time
+from functools import cache
+from typing import Dict, Tuple
+
+import gspread
+from google.oauth2 import service_account
+from googleapiclient.discovery import Resource, build
+
+from internal.env import Env
+from internal.ratelimit import sheets_limiter
+
+# opened spreadsheets not used for this long are dropped and reopened on next use
+SPREADSHEET_IDLE_TIMEOUT = 10 * 60
+
+_lock = threading.Lock()
+_gspread_client: gspread.Client | None = None
+_worksheets: Dict[str, Tuple[gspread.Worksheet, float]] = {}
+_thread_local = threading.local()
+
+
+@cache
+def get_service_account_info() -> dict:
+    return json.loads(Env.GOOGLE_SERVICE_ACCOUNT_KEY_JSON)
+
+
+@cache
+def get_drive_credentials() -> service_account.Credentials:
+    return service_account.Credentials.from_service_account_info(
+        get_service_account_info()
+    )
+
+
+def get_gspread_client() -> gspread.Client:
+    """
+    Returns the process-wide gspread client, authorizing it on first use
+    """
+    global _gspread_client
+    with _lock:
+        if _gspread_client is None:
+            _gspread_client = gspread.service_account_from_dict(
+                get_service_account_info()
+            )
+        return _gspread_client
+
+
+def open_worksheet(sheet_url: str) -> gspread.Worksheet:
+    """
+    Returns the first worksheet of the spreadsheet at the given url. Opened spreadsheets are
+    reused until unused for SPREADSHEET_IDLE_TIMEOUT
+    """
+    now = time.monotonic()
+    with _lock:
+        for url, (_, last_used) in list(_worksheets.items()):
+            if now - last_used > SPREADSHEET_IDLE_TIMEOUT:
+                del _worksheets[url]
+        if sheet_url in _worksheets:
+            worksheet, _ = _worksheets[sheet_url]
+            _worksheets[sheet_url] = (worksheet, now)
+            return worksheet
+
+    worksheet = sheets_limiter.call(
+        lambda: get_gspread_client().open_by_url(sheet_url).sheet1
+    )
+    with _lock:
+        _worksheets[sheet_url] = (worksheet, now)
+    return worksheet
+
+
+def get_drive_service() -> Resource:
+    """
+    Returns a drive service for the current thread. Services are built once per thread as
+    the underlying httplib2 connection isn't thread safe, credentials are shared
+    """
+    service = getattr(_thread_local, "drive_service", None)
+    if service is None:
+        service = build("drive", "v3", credentials=get_drive_credentials())
+        _thread_local.drive_service = service
+    return service
@@ -1,45 +1,165 @@
 import io
-import json
+import logging
 import mimetypes
-from email.message import EmailMessage
-from typing import List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage, Message
+from typing import IO, Dict, List
 
-from google.oauth2 import service_account
-from googleapiclient.discovery import Resource, build
+from googleapiclient.discovery import Resource
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseUpload
 
 from internal.data_types import Project, ProjectItemGSheet
+from internal.db import (PENDING_DRIVE_FOLDER_ID, claim_drive_folder,
+                         delete_drive_folder_id, get_drive_folder_id,
+                         save_drive_folder_id)
 from internal.env import Env
-from internal.utils import get_body_from_email_msg
+from internal.gclient import get_drive_service
+from internal.ratelimit import drive_limiter
+from internal.utils import get_body_from_email_msg, spool_attachment
 
 MAIN_FOLDER_ID = "1lK9BOZSbmp0D5uPjHlNPD-DBlQ9fsp7v"
+RESUMABLE_UPLOAD_THRESHOLD = 5 * 1024 * 1024
+# resumable upload chunks must be a multiple of 256 KB
+RESUMABLE_CHUNK_SIZE = 20 * 256 * 1024
+# how long to wait for another worker to create a project folder, after which its claim is
+# taken to be abandoned, e.g. by a crashed worker
+FOLDER_CLAIM_TIMEOUT = 120
+FOLDER_CLAIM_POLL_INTERVAL = 1
+
+
+# project name -> drive folder id, backed by the drive_folder table
+_project_folder_ids: Dict[str, str] = {}
+_project_folder_locks: Dict[str, threading.Lock] = {}
+_project_folder_locks_lock = threading.Lock()
+
+_upload_executor = ThreadPoolExecutor(
+    max_workers=Env.DRIVE_UPLOAD_WORKERS, thread_name_prefix="gdrive-upload"
+)
+
+
+def get_project_folder_lock(project_name: str) -> threading.Lock:
+    with _project_folder_locks_lock:
+        if project_name not in _project_folder_locks:
+            _project_folder_locks[project_name] = threading.Lock()
+        return _project_folder_locks[project_name]
+
+
+def upload_attachment(
+    part: Message, filename: str, mime_type: str, folder_id: str
+) -> None:
+    with spool_attachment(part) as attachment_file:
+        upload_file(attachment_file, filename, mime_type, folder_id)
+
+
+def upload_file(file: IO[bytes], filename: str, mime_type: str, folder_id: str) -> None:
+    """
+    Uploads the file to the given folder. Small files are sent in a single multipart request,
+    large ones with a chunked resumable upload
+    """
+    file.seek(0, io.SEEK_END)
+    size = file.tell()
+    resumable = size > RESUMABLE_UPLOAD_THRESHOLD
+    metadata = {"name": filename, "parents": [folder_id]}
+
+    def upload() -> dict:
+        # a retried upload starts over
+        file.seek(0)
+        media = MediaIoBaseUpload(
+            file,
+            mimetype=mime_type,
+            chunksize=RESUMABLE_CHUNK_SIZE,
+            resumable=resumable,
+        )
+        return (
+            get_drive_service()
+            .files()
+            .create(media_body=media, body=metadata, fields="id")
+            .execute()
+        )
+
+    drive_limiter.call(upload, retry_server_errors=False)
 
 
 class GoogleDrive:
     def __init__(self) -> None:
-        credentials = service_account.Credentials.from_service_account_info(
-            json.loads(Env.GOOGLE_SERVICE_ACCOUNT_KEY_JSON)
-        )
-        self.service: Resource = build("drive", "v3", credentials=credentials)
-
-    def add_email(
-        self,
-        email_message: EmailMessage,
-        project_items: List[ProjectItemGSheet],
-        project: Project,
-    ) -> str:
-        # Create a subfolder with the email subject as its title
-        subfolder = self.get_folder(project.name)
-        if subfolder is None:
-            subfolder = self.create_folder(project.name, MAIN_FOLDER_ID)
-
-        # create item folder
-        item_folder = self.create_folder(
-            f"Item {'+'.join([str(item.item_ref) for item in project_items])}",
-            subfolder["id"],
+        self.service: Resource = get_drive_service()
+
+    def create_item_folder(
+        self, project_items: List[ProjectItemGSheet], project: Project
+    ) -> dict:
+        item_folder_name = (
+            f"Item {'+'.join([str(item.item_ref) for item in project_items])}"
         )
+        project_folder_id = self.get_project_folder_id(project.name)
+        try:
+            return self.create_folder(item_folder_name, project_folder_id)
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            # the cached project folder was deleted, look it up again
+            logging.info(f"Gdrive folder for project {project.name} not found")
+            self.forget_project_folder_id(project.name, project_folder_id)
+            return self.create_folder(
+                item_folder_name, self.get_project_folder_id(project.name)
+            )
 
-        # Create a MediaIoBaseUpload object for the email HTML content
+    def get_project_folder_id(self, project_name: str) -> str:
+        """
+        Returns the id of the project folder, creating it if needed. Ids are cached in memory
+        and the db, and only one thread looks up or creates the folder of a project at a time
+        """
+        folder_id = _project_folder_ids.get(project_name)
+        if folder_id is not None:
+            return folder_id
+        with get_project_folder_lock(project_name):
+            folder_id = _project_folder_ids.get(project_name)
+            if folder_id is None:
+                folder_id = self.get_or_create_project_folder_id(project_name)
+            _project_folder_ids[project_name] = folder_id
+        return folder_id
+
+    def get_or_create_project_folder_id(self, project_name: str) -> str:
+        """
+        Returns the id of the project folder saved in the db, creating the folder if no other
+        worker has. The folder is claimed in the db first, so only the worker that inserted
+        the row creates it and the others wait for its id
+        """
+        waited = 0
+        while True:
+            folder_id = get_drive_folder_id(project_name)
+            if folder_id is not None and folder_id != PENDING_DRIVE_FOLDER_ID:
+                return folder_id
+            if folder_id is None and claim_drive_folder(project_name):
+                try:
+                    folder = self.get_folder(project_name)
+                    if folder is None:
+                        folder = self.create_folder(project_name, MAIN_FOLDER_ID)
+                except Exception:
+                    delete_drive_folder_id(project_name, PENDING_DRIVE_FOLDER_ID)
+                    raise
+                save_drive_folder_id(project_name, folder["id"])
+                return folder["id"]
+            if waited >= FOLDER_CLAIM_TIMEOUT:
+                logging.warning(
+                    f"Gdrive folder for project {project_name} wasn't created by the worker that claimed it, claiming it again"
+                )
+                delete_drive_folder_id(project_name, PENDING_DRIVE_FOLDER_ID)
+                waited = 0
+                continue
+            time.sleep(FOLDER_CLAIM_POLL_INTERVAL)
+            waited += FOLDER_CLAIM_POLL_INTERVAL
+
+    def forget_project_folder_id(self, project_name: str, folder_id: str) -> None:
+        with get_project_folder_lock(project_name):
+            if _project_folder_ids.get(project_name) == folder_id:
+                _project_folder_ids.pop(project_name)
+            # only if no other worker saved a new folder meanwhile
+            delete_drive_folder_id(project_name, folder_id)
+
+    def add_email(self, email_message: EmailMessage, item_folder: dict) -> None:
         # Create a simplified HTML content
         email_html_content = f"""
         <html>
@@ -52,49 +172,49 @@ class GoogleDrive:
         </body>
         </html>
         """
-        email_html_media = MediaIoBaseUpload(
-            io.BytesIO(email_html_content.encode("utf-8")),
-            mimetype="text/html",
-            resumable=True,
-        )
+        email_html = io.BytesIO(email_html_content.encode("utf-8"))
 
-        # Upload the email HTML content to the subfolder
-        email_html_metadata = {"name": "email.html", "parents": [item_folder["id"]]}
-        self.service.files().create(
-            media_body=email_html_media, body=email_html_metadata, fields="id"
-        ).execute()
-
-        # Save email attachments to the subfolder
+        # Upload the email HTML content and attachments to the subfolder concurrently.
+        # Only the email HTML is required, failed attachments are skipped
+        email_html_upload = _upload_executor.submit(
+            upload_file, email_html, "email.html", "text/html", item_folder["id"]
+        )
+        attachment_uploads = []
         for part in email_message.walk():
             if part.get_content_maintype() == "multipart":
                 continue
             filename = part.get_filename()
             if filename:
                 mime_type, _ = mimetypes.guess_type(filename)
-                attachment_data = part.get_payload(decode=True)
-                media = MediaIoBaseUpload(
-                    io.BytesIO(attachment_data), mimetype=mime_type, resumable=True
+                attachment_uploads.append(
+                    (
+                        filename,
+                        _upload_executor.submit(
+                            upload_attachment,
+                            part,
+                            filename,
+                            mime_type or "application/octet-stream",
+                            item_folder["id"],
+                        ),
+                    )
                 )
-                if media is None:
-                    continue
-                attachment_metadata = {"name": filename, "parents": [item_folder["id"]]}
-                try:
-                    self.service.files().create(
-                        media_body=media, body=attachment_metadata, fields="id"
-                    ).execute()
-                except:
-                    continue
 
-        return item_folder["webViewLink"]
+        email_html_upload.result()
+        for filename, attachment_upload in attachment_uploads:
+            try:
+                attachment_upload.result()
+            except Exception as e:
+                logging.error(f"Couldn't upload attachment {filename} to gdrive: {e}")
 
     def get_folder(self, folder_name: str) -> dict:
-        results = (
+        escaped_folder_name = folder_name.replace("\\", "\\\\").replace("'", "\\'")
+        results = drive_limiter.call(
             self.service.files()
             .list(
-                q=f"name='{folder_name}' and '{MAIN_FOLDER_ID}' in parents and mimeType='application/vnd.google-apps.folder'",
+                q=f"name='{escaped_folder_name}' and '{MAIN_FOLDER_ID}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false",
                 fields="files(id, name)",
             )
-            .execute()
+            .execute
         )
         folders = results.get("files", [])
         if folders:
@@ -107,8 +227,10 @@ class GoogleDrive:
             "mimeType": "application/vnd.google-apps.folder",
             "parents": [parent],
         }
-        return (
+        # not retried on server errors, the folder may have been created
+        return drive_limiter.call(
             self.service.files()
             .create(body=subfolder_metadata, fields="id,webViewLink")
-            .execute()
+            .execute,
+            retry_server_errors=False,
         )
@@ -1,71 +1,196 @@
-import json
+import threading
+from contextlib import contextmanager
 from datetime import date
-from typing import List
-
-import gspread
+from typing import Dict, Iterator, List, Tuple
 
 from internal.data_types import Project, ProjectItemGSheet
-from internal.env import Env
+from internal.db import advisory_lock
+from internal.gclient import open_worksheet
+from internal.ratelimit import drive_limiter, sheets_limiter
+
+LINK_TO_ATTACHMENTS = "\n\nLINK TO ATTACHMENTS:\n"
+
+_sheet_locks: Dict[str, threading.Lock] = {}
+_sheet_locks_lock = threading.Lock()
+# only read or written while holding the lock of the sheet
+_sheet_indexes: Dict[str, "SheetIndex"] = {}
+
+
+def get_sheet_lock(sheet_url: str) -> threading.Lock:
+    """
+    Returns the process-wide lock guarding writes to the given sheet
+    """
+    with _sheet_locks_lock:
+        if sheet_url not in _sheet_locks:
+            _sheet_locks[sheet_url] = threading.Lock()
+        return _sheet_locks[sheet_url]
+
+
+class SheetIndex:
+    """
+    In-memory index of a sheet's rows, used to assign item refs and detect duplicates
+    without reading the whole sheet. Valid as long as the spreadsheet revision is unchanged
+    """
+
+    def __init__(self, rows: List[list], revision: str) -> None:
+        self.revision = revision
+        self.refs_by_row_key: Dict[Tuple[str, ...], str] = {}
+        self.last_ref_row = 0
+        self.last_ref = ""
+        for i, row in enumerate(rows):
+            self.add_row(i + 1, row)
+
+    def add_row(self, row_number: int, row: list) -> None:
+        if not row:
+            return
+        item_ref = "" if row[0] is None else str(row[0])
+        self.refs_by_row_key[GoogleSheet.get_row_key(row)] = item_ref
+        if item_ref == "":
+            return
+        self.last_ref_row = max(self.last_ref_row, row_number)
+        self.last_ref = item_ref
+
+    def get_next_ref(self) -> int:
+        try:
+            return int(self.last_ref) + 1
+        except ValueError:
+            return 1
 
 
 class GoogleSheet:
     def __init__(self, sheet_url: str) -> None:
-        self.gc = gspread.service_account_from_dict(
-            json.loads(Env.GOOGLE_SERVICE_ACCOUNT_KEY_JSON)
+        self.sheet_url = sheet_url
+        self.sheet = open_worksheet(sheet_url)
+        # index the last refs were assigned from, rows are only inserted based on it
+        self.assigned_index: SheetIndex | None = None
+
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        """
+        Locks the sheet for the threads of this process and, on postgres, for all other
+        processes. item_ref is derived from the last row, so assigning refs and inserting
+        rows must happen under this lock
+        """
+        with get_sheet_lock(self.sheet_url), advisory_lock(f"sheet:{self.sheet_url}"):
+            yield
+
+    def get_index(self) -> SheetIndex:
+        """
+        Returns the row index of the sheet. It is only rebuilt, with a full read of the sheet,
+        if the spreadsheet changed since the index was last updated, e.g. by someone editing it
+        """
+        revision = drive_limiter.call(self.sheet.spreadsheet.get_lastUpdateTime)
+        index = _sheet_indexes.get(self.sheet_url)
+        if index is None or index.revision != revision:
+            index = SheetIndex(sheets_limiter.call(self.sheet.get_all_values), revision)
+            _sheet_indexes[self.sheet_url] = index
+        return index
+
+    def assign_item_refs(
+        self, project_items: List[ProjectItemGSheet]
+    ) -> List[ProjectItemGSheet]:
+        """
+        Sets item_ref on the given project items and returns the items that aren't in the
+        sheet yet. Items already in the sheet get the item_ref of the existing row
+        """
+        index = self.get_index()
+        self.assigned_index = index
+        next_ref = index.get_next_ref()
+        pending_refs: Dict[Tuple[str, ...], int] = {}
+        new_items = []
+        for project_item in project_items:
+            row_key = self.get_row_key(self.create_row(project_item))
+            if row_key in pending_refs:
+                project_item.item_ref = pending_refs[row_key]
+                continue
+            if row_key in index.refs_by_row_key:
+                try:
+                    project_item.item_ref = int(index.refs_by_row_key[row_key])
+                except ValueError:
+                    project_item.item_ref = None
+                continue
+            project_item.item_ref = next_ref
+            pending_refs[row_key] = next_ref
+            next_ref += 1
+            new_items.append(project_item)
+        return new_items
+
+    def insert_project_items(
+        self, project_items: List[ProjectItemGSheet], gdrive_link: str | None
+    ) -> None:
+        """
+        Inserts rows for the given project items, including the gdrive link, in one request,
+        and adds them to the index. Refs must have been assigned with assign_item_refs while
+        holding the lock, which checked the revision of the sheet, so it isn't read again
+        before the write
+        """
+        if not project_items:
+            return
+        index = _sheet_indexes.get(self.sheet_url)
+        if index is None or index is not self.assigned_index:
+            # refs and the insert row come from the index, so neither can be used anymore
+            raise RuntimeError(
+                f"Index of sheet {self.sheet_url} changed since item refs were assigned"
+            )
+        insert_index = index.last_ref_row + 1
+        rows = [
+            self.create_row(project_item, gdrive_link) for project_item in project_items
+        ]
+        # not retried on server errors, the rows may have been inserted
+        sheets_limiter.call(
+            self.sheet.insert_rows, rows, insert_index, retry_server_errors=False
         )
-        self.sh = self.gc.open_by_url(sheet_url)
-        self.sheet = self.sh.sheet1
+        for i, row in enumerate(rows):
+            index.add_row(insert_index + i, row)
+        # The new revision is taken to be ours, so the index isn't rebuilt on next use. An
+        # edit by someone else between assign_item_refs and this write goes unnoticed
+        index.revision = drive_limiter.call(self.sheet.spreadsheet.get_lastUpdateTime)
+        self.assigned_index = None
 
-    def insert_project_item(self, project_item: ProjectItemGSheet) -> None:
-        first_col_values = self.sheet.col_values(1)
-        try:
-            project_item.item_ref = int(first_col_values[-1]) + 1
-        except (ValueError, IndexError):
-            project_item.item_ref = 1
-        new_index = len(first_col_values) + 1
-        new_row = [
+    @staticmethod
+    def create_row(
+        project_item: ProjectItemGSheet, gdrive_link: str | None = None
+    ) -> list:
+        item_description = project_item.item_description
+        if gdrive_link:
+            item_description += LINK_TO_ATTACHMENTS + gdrive_link
+        return [
             project_item.item_ref,
             project_item.date_added.strftime("%d/%m/%Y"),
             project_item.plot_no,
-            project_item.item_description,
+            item_description,
             project_item.get_combined_quantity(),
             project_item.rate,
             project_item.total,
+            gdrive_link,
         ]
-        if not self.check_if_row_exists(new_row):
-            self.sheet.insert_row(new_row, new_index)
 
-    def insert_gdrive_link(
-        self, gdrive_link: str, project_item: ProjectItemGSheet
-    ) -> None:
-        first_col_values = self.sheet.col_values(1)
-        row_index = first_col_values.index(str(project_item.item_ref))
-        new_value = (
-            f"{project_item.item_description}\n\nLINK TO ATTACHMENTS:\n{gdrive_link}"
-        )
-        self.sheet.update_cell(row_index + 1, 4, new_value)
-        self.sheet.update_cell(row_index + 1, 8, gdrive_link)
-
-    def check_if_row_exists(self, row_to_check: List[str]) -> bool:
-        row_to_check = [str(x) for x in row_to_check]
-        rows = self.sheet.get_all_values()
-        for row in rows:
-            if row[1 : len(row_to_check)] == row_to_check[1:]:
-                return True
-        return False
+    @staticmethod
+    def get_row_key(row: list) -> Tuple[str, ...]:
+        """
+        Returns the content of a row used to detect duplicates: everything but the item ref
+        and the gdrive link
+        """
+        row_key = ["" if value is None else str(value) for value in row[1:7]]
+        if len(row_key) > 2:
+            row_key[2] = row_key[2].split(LINK_TO_ATTACHMENTS)[0]
+        return tuple(row_key)
 
 
 if __name__ == "__main__":
     gsheet = GoogleSheet(
         "https://docs.google.com/spreadsheets/d/1p-W6vbGU2312a1_T4xyqBWr7Pz8iwmE2EXa68ex690w/edit#gid=638267015",
     )
-    gsheet.insert_project_item(
-        ProjectItemGSheet(
-            date_added=date.today(),
-            plot_no=100,
-            item_description="Test item",
-            quantity=2,
-            rate=10.5,
-        )
+    project_item = ProjectItemGSheet(
+        date_added=date.today(),
+        plot_no=100,
+        item_description="Test item",
+        quantity=2,
+        rate=10.5,
+        no_of_days_or_hours=None,
+        item_type=None,
     )
-    print(gsheet.check_if_row_exists([14, "09/29/2023", 100, "Test item", 2, 10.50]))
+    with gsheet.lock():
+        new_items = gsheet.assign_item_refs([project_item])
+        gsheet.insert_project_items(new_items, None)
+    print(project_item.item_ref, len(new_items))
@@ -0,0 +1,376 @@
+import asyncio
+import imaplib
+import logging
+import re
+import select
+import ssl
+import time
+from typing import AsyncIterator, Awaitable, Callable, Iterator, List, Tuple
+
+import aioimaplib
+
+from internal.mail_server import MailServerLogin, needs_noop
+from internal.metrics import track_stage
+
+IDLE_TIMEOUT = 5 * 60
+POLL_INTERVAL = 5
+# how often IDLE checks whether it should end early, e.g. as the mailbox is stopped or its
+# config was updated
+IDLE_WAKE_CHECK_INTERVAL = 5
+MAX_BACKOFF = 5 * 60
+FETCH_BATCH_SIZE = 20
+# how long the server gets to end IDLE after DONE
+IDLE_DONE_TIMEOUT = 10
+
+
+class IMAPSession(MailServerLogin):
+    """
+    Long lived IMAP connection to a single mailbox. Waits for new emails with IDLE
+    when the server supports it, otherwise polls
+    """
+
+    def __init__(
+        self, host: str, port: int, email: str, password: str, mailbox: str = "Inbox"
+    ) -> None:
+        super().__init__(host, port, email, password)
+        self.mailbox = mailbox
+        self.mail: imaplib.IMAP4_SSL | None = None
+        self.uidvalidity: int | None = None
+        self.last_used = 0.0
+
+    @property
+    def name(self) -> str:
+        return f"{self.email}/{self.mailbox}"
+
+    def connect(self) -> None:
+        """
+        Connects, logs in and selects the mailbox. Retries with exponential backoff until connected
+        """
+        backoff = 1
+        while True:
+            try:
+                mail = imaplib.IMAP4_SSL(self.host, self.port)
+                mail.login(self.email, self.password)
+                mail.select(self.mailbox)
+                typ, data = mail.response("UIDVALIDITY")
+                self.uidvalidity = int(data[0])
+                self.mail = mail
+                return
+            except (OSError, imaplib.IMAP4.error) as e:
+                logging.error(
+                    f"Couldn't connect to IMAP server {self.host}: {e}. Retrying in {backoff}s"
+                )
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+
+    def reconnect(self) -> None:
+        self.close()
+        self.connect()
+
+    def get_connection(self) -> imaplib.IMAP4_SSL:
+        """
+        Returns the logged in connection, reconnecting if the server dropped it
+        """
+        if self.mail is None:
+            self.connect()
+        elif needs_noop(self.last_used):
+            try:
+                self.mail.noop()
+            except (OSError, imaplib.IMAP4.error):
+                logging.info("IMAP connection lost, reconnecting")
+                self.reconnect()
+        self.last_used = time.monotonic()
+        return self.mail
+
+    def close(self) -> None:
+        if self.mail is None:
+            return
+        try:
+            self.mail.logout()
+        except (OSError, imaplib.IMAP4.error):
+            pass
+        self.mail = None
+
+    def search_uids(self, criteria: str) -> List[int]:
+        typ, data = self.get_connection().uid("SEARCH", None, criteria)
+        return [int(uid) for uid in data[0].split()]
+
+    def get_uid_next(self) -> int:
+        typ, data = self.get_connection().status(self.mailbox, "(UIDNEXT)")
+        return int(re.search(rb"UIDNEXT (\d+)", data[0]).group(1))
+
+    def fetch_emails(self, uids: List[int]) -> Iterator[Tuple[int, bytes]]:
+        """
+        Yields the UID and raw content of the given emails, fetching them in batches with a
+        single UID FETCH each. Uses BODY.PEEK so emails aren't marked as seen until processed
+        """
+        mail = self.get_connection()
+        for i in range(0, len(uids), FETCH_BATCH_SIZE):
+            uid_set = ",".join(str(uid) for uid in uids[i : i + FETCH_BATCH_SIZE])
+            with track_stage("fetch"):
+                typ, data = mail.uid("FETCH", uid_set, "(UID BODY.PEEK[])")
+            emails = {}
+            for response in data:
+                if not isinstance(response, tuple):
+                    continue
+                uid = int(re.search(rb"UID (\d+)", response[0]).group(1))
+                emails[uid] = response[1]
+            for uid in sorted(emails):
+                yield uid, emails[uid]
+
+    def mark_seen(self, uid: int) -> None:
+        self.get_connection().uid("STORE", str(uid), "+FLAGS", "(\\Seen)")
+
+    def supports_idle(self) -> bool:
+        return "IDLE" in self.get_connection().capabilities
+
+    def wait_for_new_emails(
+        self, should_wake: Callable[[], bool] | None = None
+    ) -> None:
+        """
+        Blocks until the server reports new emails, should_wake returns True or IDLE_TIMEOUT
+        passes. Sleeps for POLL_INTERVAL instead if the server doesn't support IDLE
+        """
+        if not self.supports_idle():
+            time.sleep(POLL_INTERVAL)
+            return
+        try:
+            self.idle(IDLE_TIMEOUT, should_wake)
+        except (OSError, imaplib.IMAP4.error) as e:
+            logging.info(f"IMAP IDLE failed: {e}. Reconnecting")
+            self.reconnect()
+
+    def idle(
+        self, timeout: float, should_wake: Callable[[], bool] | None = None
+    ) -> bool:
+        """
+        Runs an IDLE command (RFC 2177) until the server reports a mailbox change, should_wake
+        returns True or the timeout passes. should_wake is checked every
+        IDLE_WAKE_CHECK_INTERVAL. Returns True if new emails arrived
+        """
+        mail = self.mail
+        tag = mail._new_tag()
+        mail.send(tag + b" IDLE\r\n")
+        response = mail.readline()
+        if not response.startswith(b"+"):
+            raise imaplib.IMAP4.error(f"IDLE rejected: {response!r}")
+
+        has_new_emails = False
+        deadline = time.monotonic() + timeout
+        while not has_new_emails:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not self._has_data_ready():
+                readable, _, _ = select.select(
+                    [mail.sock], [], [], min(remaining, IDLE_WAKE_CHECK_INTERVAL)
+                )
+                if not readable:
+                    if should_wake is not None and should_wake():
+                        break
+                    continue
+            line = mail.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("Connection closed during IDLE")
+            has_new_emails = self._is_new_email_response(line)
+
+        mail.send(b"DONE\r\n")
+        while True:
+            line = mail.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("Connection closed during IDLE")
+            if line.startswith(tag):
+                break
+            has_new_emails = has_new_emails or self._is_new_email_response(line)
+        self.last_used = time.monotonic()
+        return has_new_emails
+
+    def _has_data_ready(self) -> bool:
+        """
+        Returns whether a line can be read without waiting. Lines that imaplib already read
+        into mail.file, or that the SSL layer already decrypted, won't wake select, so this
+        peeks into the file without blocking
+        """
+        mail = self.mail
+        sock_timeout = mail.sock.gettimeout()
+        mail.sock.setblocking(False)
+        try:
+            return bool(mail.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            mail.sock.settimeout(sock_timeout)
+
+    @staticmethod
+    def _is_new_email_response(line: bytes) -> bool:
+        return line.startswith(b"*") and line.rstrip().endswith((b"EXISTS", b"RECENT"))
+
+
+class AsyncIMAPSession(MailServerLogin):
+    """
+    asyncio version of IMAPSession, on aioimaplib
+    """
+
+    def __init__(
+        self, host: str, port: int, email: str, password: str, mailbox: str = "Inbox"
+    ) -> None:
+        super().__init__(host, port, email, password)
+        self.mailbox = mailbox
+        self.imap: aioimaplib.IMAP4_SSL | None = None
+        self.uidvalidity: int | None = None
+        self.last_used = 0.0
+
+    @property
+    def name(self) -> str:
+        return f"{self.email}/{self.mailbox}"
+
+    async def connect(self) -> None:
+        """
+        Connects, logs in and selects the mailbox. Retries with exponential backoff until connected
+        """
+        backoff = 1
+        while True:
+            try:
+                imap = aioimaplib.IMAP4_SSL(self.host, self.port)
+                await imap.wait_hello_from_server()
+                check_response(await imap.login(self.email, self.password))
+                response = check_response(await imap.select(self.mailbox))
+                self.uidvalidity = int(
+                    re.search(rb"UIDVALIDITY (\d+)", b" ".join(response.lines)).group(1)
+                )
+                self.imap = imap
+                return
+            except (OSError, asyncio.TimeoutError, aioimaplib.AioImapException) as e:
+                logging.error(
+                    f"Couldn't connect to IMAP server {self.host}: {e}. Retrying in {backoff}s"
+                )
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+
+    async def reconnect(self) -> None:
+        await self.close()
+        await self.connect()
+
+    async def get_connection(self) -> aioimaplib.IMAP4_SSL:
+        """
+        Returns the logged in connection, reconnecting if the server dropped it
+        """
+        if self.imap is None:
+            await self.connect()
+        elif needs_noop(self.last_used):
+            try:
+                check_response(await self.imap.noop())
+            except (OSError, asyncio.TimeoutError, aioimaplib.AioImapException):
+                logging.info("IMAP connection lost, reconnecting")
+                await self.reconnect()
+        self.last_used = time.monotonic()
+        return self.imap
+
+    async def close(self) -> None:
+        if self.imap is None:
+            return
+        try:
+            await self.imap.logout()
+        except (OSError, asyncio.TimeoutError, aioimaplib.AioImapException):
+            pass
+        self.imap = None
+
+    async def search_uids(self, criteria: str) -> List[int]:
+        imap = await self.get_connection()
+        response = check_response(await imap.uid_search(criteria, charset=None))
+        return [int(uid) for uid in response.lines[0].split()]
+
+    async def get_uid_next(self) -> int:
+        imap = await self.get_connection()
+        response = check_response(await imap.status(self.mailbox, "(UIDNEXT)"))
+        return int(re.search(rb"UIDNEXT (\d+)", b" ".join(response.lines)).group(1))
+
+    async def fetch_emails(self, uids: List[int]) -> AsyncIterator[Tuple[int, bytes]]:
+        """
+        Yields the UID and raw content of the given emails, fetching them in batches with a
+        single UID FETCH each. Uses BODY.PEEK so emails aren't marked as seen until processed
+        """
+        imap = await self.get_connection()
+        for i in range(0, len(uids), FETCH_BATCH_SIZE):
+            uid_set = ",".join(str(uid) for uid in uids[i : i + FETCH_BATCH_SIZE])
+            with track_stage("fetch"):
+                response = check_response(
+                    await imap.uid("fetch", uid_set, "(UID BODY.PEEK[])")
+                )
+            emails = {}
+            # literals are returned as bytearrays after the line announcing them
+            for line, literal in zip(response.lines, response.lines[1:]):
+                if not isinstance(literal, bytearray):
+                    continue
+                match = re.search(rb"UID (\d+)", line)
+                if match is not None:
+                    emails[int(match.group(1))] = bytes(literal)
+            for uid in sorted(emails):
+                yield uid, emails[uid]
+
+    async def mark_seen(self, uid: int) -> None:
+        imap = await self.get_connection()
+        check_response(await imap.uid("store", str(uid), "+FLAGS", "(\\Seen)"))
+
+    async def wait_for_new_emails(
+        self, should_wake: Callable[[], Awaitable[bool]] | None = None
+    ) -> None:
+        """
+        Waits until the server reports new emails, should_wake returns True or IDLE_TIMEOUT
+        passes. Sleeps for POLL_INTERVAL instead if the server doesn't support IDLE
+        """
+        imap = await self.get_connection()
+        if not imap.has_capability("IDLE"):
+            await asyncio.sleep(POLL_INTERVAL)
+            return
+        try:
+            await self.idle(imap, IDLE_TIMEOUT, should_wake)
+        except (OSError, asyncio.TimeoutError, aioimaplib.AioImapException) as e:
+            logging.info(f"IMAP IDLE failed: {e}. Reconnecting")
+            await self.reconnect()
+
+    async def idle(
+        self,
+        imap: aioimaplib.IMAP4_SSL,
+        timeout: float,
+        should_wake: Callable[[], Awaitable[bool]] | None = None,
+    ) -> bool:
+        """
+        Runs an IDLE command until the server reports a mailbox change, should_wake returns
+        True or the timeout passes. Returns True if new emails arrived
+        """
+        idle = await imap.idle_start(timeout=timeout + IDLE_DONE_TIMEOUT)
+        has_new_emails = False
+        deadline = time.monotonic() + timeout
+        try:
+            while not has_new_emails:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    lines = await imap.wait_server_push(
+                        timeout=min(remaining, IDLE_WAKE_CHECK_INTERVAL)
+                    )
+                except asyncio.TimeoutError:
+                    if should_wake is not None and await should_wake():
+                        break
+                    continue
+                if lines == aioimaplib.STOP_WAIT_SERVER_PUSH:
+                    break
+                # aioimaplib strips the "* " of untagged responses
+                has_new_emails = any(
+                    line.rstrip().endswith((b"EXISTS", b"RECENT"))
+                    for line in lines
+                    if isinstance(line, bytes)
+                )
+        finally:
+            imap.idle_done()
+            await asyncio.wait_for(idle, IDLE_DONE_TIMEOUT)
+        self.last_used = time.monotonic()
+        return has_new_emails
+
+
+def check_response(response: aioimaplib.Response) -> aioimaplib.Response:
+    if response.result != "OK":
+        raise aioimaplib.Error(f"IMAP command failed: {response.lines}")
+    return response
@@ -0,0 +1,53 @@
+from datetime import timedelta
+from typing import Tuple
+
+# stages of an email job, run in this order. Sheet and drive only run for sheet topics
+CLASSIFY = "classify"
+SHEET = "sheet"
+DRIVE = "drive"
+FORWARD = "forward"
+DONE = "done"
+FAILED = "failed"
+FINISHED_STAGES = [DONE, FAILED]
+
+# a claimed job is hidden from other workers for this long, so a crashed worker's job is
+# picked up again once it runs out
+JOB_LEASE = timedelta(minutes=15)
+# the lease of a running job is renewed this often, so a slow stage doesn't lose it
+JOB_LEASE_RENEW_INTERVAL = JOB_LEASE / 3
+JOB_POLL_INTERVAL = 2
+# done jobs are deleted after this long, failed ones are kept for inspection
+JOB_RETENTION = timedelta(days=7)
+
+# stage -> (max attempts, delay before the first retry in seconds). The delay doubles on
+# every retry, up to MAX_RETRY_DELAY
+STAGE_RETRY_POLICIES = {
+    CLASSIFY: (5, 30),
+    SHEET: (5, 60),
+    DRIVE: (5, 60),
+    FORWARD: (10, 60),
+}
+MAX_RETRY_DELAY = 60 * 60
+# (max attempts, delay before the first retry in seconds) of emails processed as they are
+# fetched, without the job queue. An email that keeps failing is set aside, so the emails
+# after it aren't held up
+EMAIL_RETRY_POLICY = (5, 60)
+
+
+def get_retry_delay(stage: str, attempts: int) -> timedelta | None:
+    """
+    Returns how long to wait before retrying a stage that failed the given number of times,
+    None once the stage should be given up on
+    """
+    return get_backoff_delay(STAGE_RETRY_POLICIES[stage], attempts)
+
+
+def get_backoff_delay(retry_policy: Tuple[int, int], attempts: int) -> timedelta | None:
+    """
+    Returns the delay before the next attempt with the given retry policy, None once the
+    max attempts were made
+    """
+    max_attempts, initial_delay = retry_policy
+    if attempts >= max_attempts:
+        return None
+    return timedelta(seconds=min(initial_delay * 2 ** (attempts - 1), MAX_RETRY_DELAY))
@@ -0,0 +1,33 @@
+import time
+
+# connections used more recently than this are assumed to still be alive
+NOOP_AFTER = 60
+
+
+class MailServerLogin:
+    """
+    Server and login of the IMAP and SMTP connections, so they can tell whether an updated
+    config still uses the same server
+    """
+
+    def __init__(self, host: str, port: int, email: str, password: str) -> None:
+        self.host = host
+        self.port = port
+        self.email = email
+        self.password = password
+
+    def matches(self, host: str, port: int, email: str, password: str) -> bool:
+        return (self.host, self.port, self.email, self.password) == (
+            host,
+            port,
+            email,
+            password,
+        )
+
+
+def needs_noop(last_used: float) -> bool:
+    """
+    Returns whether a connection last used at the given time.monotonic() must be checked
+    with a NOOP before it is used again
+    """
+    return time.monotonic() - last_used > NOOP_AFTER
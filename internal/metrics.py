@@ -0,0 +1,180 @@
+import atexit
+import os
+import socket
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from dotenv import load_dotenv
+from prometheus_client import (REGISTRY, CollectorRegistry, Counter, Gauge,
+                               Histogram, multiprocess, values)
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+load_dotenv()
+
+# shared by the forwarder, worker and api processes when set. Every process writes its
+# metrics to files in the directory and /metrics sums them up. Read from the environment
+# like prometheus_client does rather than from Env, so the imap and smtp modules don't
+# need the app settings
+MULTIPROCESS_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+
+def get_process_id() -> str:
+    # containers have their own pid namespaces, so the pid alone could be taken by another
+    # container writing to the same directory
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def mark_process_dead() -> None:
+    multiprocess.mark_process_dead(get_process_id(), MULTIPROCESS_DIR)
+
+
+if MULTIPROCESS_DIR:
+    os.makedirs(MULTIPROCESS_DIR, exist_ok=True)
+    # set before any metric is created
+    values.ValueClass = values.MultiProcessValue(get_process_id)
+    # the live gauges of this process stop counting once it exits
+    atexit.register(mark_process_dead)
+
+# seconds, from cheap local steps up to slow upstream calls
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = Histogram(
+    "email_forwarder_stage_seconds",
+    "Time spent in each stage of processing emails: fetch (per IMAP fetch batch), parse, "
+    "classify, sheet, drive and forward",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+STAGE_FAILURES = Counter(
+    "email_forwarder_stage_failures_total",
+    "Email processing stages that raised an error",
+    ["stage"],
+)
+EMAILS_PROCESSED = Counter(
+    "email_forwarder_emails_processed_total", "Emails processed end to end"
+)
+EMAILS_PENDING = Gauge(
+    "email_forwarder_emails_pending",
+    "Fetched emails waiting for or being processed by a worker",
+    multiprocess_mode="livesum",
+)
+
+LLM_REQUEST_SECONDS = Histogram(
+    "email_forwarder_llm_request_seconds",
+    "Latency of chatgpt completions, including rate limit waits and retries",
+    ["prompt"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "email_forwarder_llm_tokens_total",
+    "Tokens used by chatgpt completions, as reported by the API",
+    ["prompt", "kind"],
+)
+LLM_CACHE_REQUESTS = Counter(
+    "email_forwarder_llm_cache_requests_total",
+    "Lookups of the chatgpt response cache",
+    ["result"],
+)
+ROUTED_EMAILS = Counter(
+    "email_forwarder_routed_emails_total",
+    "Emails routed to a topic locally or by chatgpt",
+    ["router"],
+)
+
+UPSTREAM_REQUEST_SECONDS = Histogram(
+    "email_forwarder_upstream_request_seconds",
+    "Latency of single requests to the upstream APIs, one per attempt",
+    ["api"],
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_REQUESTS = Counter(
+    "email_forwarder_upstream_requests_total",
+    "Requests to the upstream APIs by outcome: ok, throttled (429) or error",
+    ["api", "outcome"],
+)
+UPSTREAM_WAIT_SECONDS = Counter(
+    "email_forwarder_upstream_wait_seconds_total",
+    "Time requests waited for the client side rate limits",
+    ["api"],
+)
+
+
+@contextmanager
+def track_stage(stage: str) -> Iterator[None]:
+    """
+    Times the stage, counting it as failed if it raises
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_FAILURES.labels(stage).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+
+@contextmanager
+def track_request(api: str) -> Iterator[None]:
+    """
+    Times a request to an upstream API without a rate limiter, e.g. SMTP
+    """
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        record_request(api, time.perf_counter() - start, outcome)
+
+
+def record_request(api: str, seconds: float, outcome: str) -> None:
+    UPSTREAM_REQUEST_SECONDS.labels(api).observe(seconds)
+    UPSTREAM_REQUESTS.labels(api, outcome).inc()
+
+
+class EmailJobCollector(Collector):
+    """
+    Reports the email job queue depth by stage. Queried from the database on scrape, as
+    jobs are shared by all ingest and worker processes
+    """
+
+    def describe(self):
+        # keeps the registry from collecting, and querying the database, on register
+        yield self.create_metric()
+
+    def collect(self):
+        # imported here, so importing the metrics doesn't connect to the database
+        from internal.db import count_email_jobs_by_stage
+
+        jobs = self.create_metric()
+        for stage, count in sorted(count_email_jobs_by_stage().items()):
+            jobs.add_metric([stage], count)
+        yield jobs
+
+    @staticmethod
+    def create_metric() -> GaugeMetricFamily:
+        return GaugeMetricFamily(
+            "email_forwarder_email_jobs",
+            "Email jobs in the database by stage",
+            labels=["stage"],
+        )
+
+
+def get_metrics_registry() -> CollectorRegistry:
+    """
+    Returns the registry to export: the metrics of all processes in multiprocess mode,
+    otherwise those of this process. Both include the email job queue
+    """
+    if MULTIPROCESS_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, MULTIPROCESS_DIR)
+        registry.register(EmailJobCollector())
+        return registry
+    return REGISTRY
+
+
+if not MULTIPROCESS_DIR:
+    REGISTRY.register(EmailJobCollector())
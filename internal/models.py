@@ -1,4 +1,7 @@
-from sqlalchemy import JSON
+from datetime import datetime
+
+from sqlalchemy import (JSON, DateTime, LargeBinary, String, Text,
+                        UniqueConstraint)
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
 
@@ -10,4 +13,97 @@ class Config(Base):
     __tablename__ = "config"
 
     id: Mapped[int] = mapped_column(primary_key=True)
+    mailbox: Mapped[str] = mapped_column(
+        String(320),
+        unique=True,
+        index=True,
+        default="default",
+        server_default="default",
+    )
     config_json = mapped_column(JSON)
+    # bumped on every update, so readers can detect changes without loading the json
+    version: Mapped[int] = mapped_column(default=1, server_default="1")
+    updated_at = mapped_column(
+        DateTime, default=datetime.utcnow, onupdate=datetime.utcnow
+    )
+
+
+class ChatGPTResponse(Base):
+    __tablename__ = "chatgpt_response"
+
+    prompt_hash: Mapped[str] = mapped_column(String(64), primary_key=True)
+    response = mapped_column(Text)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime, index=True, default=datetime.utcnow
+    )
+
+
+class MailboxState(Base):
+    __tablename__ = "mailbox_state"
+
+    mailbox: Mapped[str] = mapped_column(String(320), primary_key=True)
+    uidvalidity: Mapped[int]
+    last_uid: Mapped[int]
+
+
+class MailboxEmail(Base):
+    # emails above the last_uid of the mailbox state that were processed or failed, as
+    # emails finish out of order. Deleted once last_uid moves past them
+    __tablename__ = "mailbox_email"
+
+    mailbox: Mapped[str] = mapped_column(String(320), primary_key=True)
+    uidvalidity: Mapped[int] = mapped_column(primary_key=True)
+    uid: Mapped[int] = mapped_column(primary_key=True)
+    processed: Mapped[bool] = mapped_column(default=False)
+    attempts: Mapped[int] = mapped_column(default=0)
+    last_error = mapped_column(Text)
+    # None once the email was processed or set aside after too many failed attempts
+    next_attempt_at = mapped_column(DateTime)
+
+
+class DriveFolder(Base):
+    __tablename__ = "drive_folder"
+
+    project_name: Mapped[str] = mapped_column(String(255), primary_key=True)
+    folder_id: Mapped[str] = mapped_column(String(255))
+
+
+class EmailTopic(Base):
+    __tablename__ = "email_topic"
+
+    mailbox: Mapped[str] = mapped_column(
+        String(320), primary_key=True, server_default="default"
+    )
+    message_id: Mapped[str] = mapped_column(String(998), primary_key=True)
+    topic = mapped_column(Text)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime, index=True, default=datetime.utcnow
+    )
+
+
+class EmailJob(Base):
+    __tablename__ = "email_job"
+    __table_args__ = (UniqueConstraint("mailbox", "uidvalidity", "uid"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    mailbox: Mapped[str] = mapped_column(String(320))
+    uidvalidity: Mapped[int]
+    uid: Mapped[int]
+    raw_message = mapped_column(LargeBinary)
+    stage: Mapped[str] = mapped_column(String(16))
+    # results of the finished stages, used by the later ones
+    checkpoint = mapped_column(JSON, default=dict)
+    # failed attempts at the current stage
+    attempts: Mapped[int] = mapped_column(default=0)
+    last_error = mapped_column(Text)
+    next_attempt_at: Mapped[datetime] = mapped_column(
+        DateTime, index=True, default=datetime.utcnow
+    )
+    # set on every claim, the job is only updated by the worker holding the latest claim
+    claim_token = mapped_column(String(32))
+    # whether the email was marked as seen in the mailbox, which happens once it is done
+    seen: Mapped[bool] = mapped_column(default=False, server_default="false")
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    updated_at = mapped_column(
+        DateTime, default=datetime.utcnow, onupdate=datetime.utcnow
+    )
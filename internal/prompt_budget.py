@@ -0,0 +1,67 @@
+import logging
+from functools import cache
+
+import tiktoken
+
+from internal.utils import strip_quoted_history
+
+# encoding used by gpt-3.5-turbo
+ENCODING_NAME = "cl100k_base"
+# gpt-3.5-turbo has a context of 4097 tokens, the rest is left for the completion
+MAX_PROMPT_TOKENS = 3000
+# cap of the cleaned email body, so one long email can't take the whole prompt budget
+MAX_EMAIL_BODY_TOKENS = 2000
+EMAIL_MESSAGE_PLACEHOLDER = "{email_message}"
+
+
+@cache
+def get_encoding() -> tiktoken.Encoding:
+    return tiktoken.get_encoding(ENCODING_NAME)
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+
+def fit_to_token_budget(text: str, max_tokens: int) -> str:
+    """
+    Trims the text to at most max_tokens tokens. Quoted lines of a reply chain are dropped
+    first, then the text is cut from the end, where older and forwarded messages are, so the
+    newest message is kept
+    """
+    encoding = get_encoding()
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    logging.info(
+        f"Email message has {len(tokens)} tokens, trimming it to {max_tokens} tokens"
+    )
+    text = strip_quoted_history(text)
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+class PromptBudget:
+    """
+    Token budget of a prompt template. The fixed cost of the template, everything but the
+    email message, is counted once, and the email message gets whatever is left
+    """
+
+    def __init__(self, prompt: str, max_tokens: int = MAX_PROMPT_TOKENS) -> None:
+        self.prompt = prompt
+        placeholder_count = max(prompt.count(EMAIL_MESSAGE_PLACEHOLDER), 1)
+        fixed_tokens = count_tokens(prompt.replace(EMAIL_MESSAGE_PLACEHOLDER, ""))
+        self.email_message_tokens = (
+            max(max_tokens - fixed_tokens, 0) // placeholder_count
+        )
+
+    def render(self, email_message: str) -> str:
+        """
+        Returns the prompt with the email message, trimmed to fit, filled in
+        """
+        return self.prompt.replace(
+            EMAIL_MESSAGE_PLACEHOLDER,
+            fit_to_token_budget(email_message, self.email_message_tokens),
+        )
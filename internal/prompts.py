@@ -0,0 +1,44 @@
+from typing import Dict
+
+from internal.data_types import Configuration
+from internal.prompt_budget import PromptBudget
+from internal.utils import (create_project_type_dict,
+                            render_project_type_placeholders)
+
+
+class PromptTemplates:
+    """
+    Prompts of a configuration compiled once per config load. Rates, keywords, topics and
+    projects are rendered in advance, so only {email_message} is filled in per email
+    """
+
+    def __init__(self, config: Configuration) -> None:
+        self.project_type_dict: Dict[str, Dict[str, str | float]] = (
+            create_project_type_dict(config.project_types)
+        )
+        topics = "\n".join(
+            receiver_email.name for receiver_email in config.receiver_emails
+        )
+        project_names = "\n".join(project.name for project in config.projects)
+
+        self.email_details = PromptBudget(
+            render_project_type_placeholders(
+                config.prompt_subject_line, self.project_type_dict
+            )
+        )
+        self.forward_email = PromptBudget(
+            config.prompt_forward_email.replace("{topics}", topics)
+        )
+        self.project = PromptBudget(
+            config.prompt_project.replace("{projects}", project_names)
+        )
+        self.combined = None
+        if config.prompt_combined:
+            self.combined = PromptBudget(
+                render_project_type_placeholders(
+                    config.prompt_combined.replace("{topics}", topics).replace(
+                        "{projects}", project_names
+                    ),
+                    self.project_type_dict,
+                )
+            )
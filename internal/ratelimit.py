@@ -0,0 +1,304 @@
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+from typing import Awaitable, Callable, List, Mapping, Set, Tuple, TypeVar
+
+import openai
+from googleapiclient.errors import HttpError
+from gspread.exceptions import APIError
+
+from internal.env import Env
+from internal.metrics import UPSTREAM_WAIT_SECONDS, record_request
+
+T = TypeVar("T")
+
+INITIAL_BACKOFF = 1
+MAX_BACKOFF = 60
+# statuses worth retrying. Server errors are only retried for idempotent calls
+TOO_MANY_REQUESTS = 429
+SERVER_ERRORS = [500, 502, 503, 504]
+# reasons of the 403 errors drive returns when rate limited
+DRIVE_RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+
+class TokenBucket:
+    """
+    Allows rate_per_minute tokens per minute, with bursts of up to capacity tokens.
+    A rate of 0 disables the limit
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: float | None = None) -> None:
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity or max(rate_per_minute / 10, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1) -> float:
+        """
+        Blocks until the bucket has the tokens and isn't paused, then takes them. Returns the
+        seconds waited
+        """
+        waited = 0.0
+        while True:
+            wait = self.take(amount)
+            if wait <= 0:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    async def acquire_async(self, amount: float = 1) -> float:
+        waited = 0.0
+        while True:
+            wait = self.take(amount)
+            if wait <= 0:
+                return waited
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def take(self, amount: float) -> float:
+        """
+        Takes the tokens if available. Returns 0 if they were taken, otherwise how long to
+        wait before trying again
+        """
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            if self.rate > 0:
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated_at) * self.rate
+                )
+            self.updated_at = now
+            wait = self.paused_until - now
+            if self.rate > 0 and self.tokens < amount:
+                wait = max(wait, (amount - self.tokens) / self.rate)
+            if wait > 0:
+                return wait
+            if self.rate > 0:
+                self.tokens -= amount
+            return 0
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    """
+    Rate limits and retries the calls to one upstream API. Calls wait for the request
+    bucket, and the cost bucket if given, e.g. for tokens per minute. Throttled calls are
+    retried with jittered exponential backoff, or after Retry-After when the API sends it,
+    and the buckets are paused meanwhile so concurrent calls slow down too
+    """
+
+    def __init__(
+        self,
+        name: str,
+        requests_per_minute: float,
+        cost_per_minute: float | None = None,
+        max_retries: int = 5,
+    ) -> None:
+        self.name = name
+        self.buckets: List[TokenBucket] = [TokenBucket(requests_per_minute)]
+        self.cost_bucket = None
+        if cost_per_minute is not None:
+            self.cost_bucket = TokenBucket(cost_per_minute)
+            self.buckets.append(self.cost_bucket)
+        self.max_retries = max_retries
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+        self.wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def call(
+        self,
+        func: Callable[..., T],
+        *args,
+        cost: float = 0,
+        retry_server_errors: bool = True,
+        **kwargs,
+    ) -> T:
+        """
+        Calls func once the rate limits allow it, retrying throttled calls and, if
+        retry_server_errors is set, server errors
+        """
+        attempt = 0
+        while True:
+            waited = self.buckets[0].acquire()
+            if self.cost_bucket is not None and cost:
+                waited += self.cost_bucket.acquire(cost)
+            self.record(waited=waited)
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                self.record_attempt(start, e)
+                self.handle_error(e, attempt, retry_server_errors)
+                attempt += 1
+                continue
+            self.record_attempt(start)
+            return result
+
+    async def acall(
+        self,
+        func: Callable[..., Awaitable[T]],
+        *args,
+        cost: float = 0,
+        retry_server_errors: bool = True,
+        **kwargs,
+    ) -> T:
+        """
+        Same as call, for coroutine functions. Waits without blocking the event loop
+        """
+        attempt = 0
+        while True:
+            waited = await self.buckets[0].acquire_async()
+            if self.cost_bucket is not None and cost:
+                waited += await self.cost_bucket.acquire_async(cost)
+            self.record(waited=waited)
+            start = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                self.record_attempt(start, e)
+                self.handle_error(e, attempt, retry_server_errors)
+                attempt += 1
+                continue
+            self.record_attempt(start)
+            return result
+
+    def handle_error(
+        self, e: Exception, attempt: int, retry_server_errors: bool
+    ) -> None:
+        """
+        Re-raises errors that shouldn't be retried. Otherwise pauses the buckets for the
+        backoff, so the retry and concurrent calls wait for it
+        """
+        status, retry_after = get_error_status(e)
+        throttled = status == TOO_MANY_REQUESTS
+        if not throttled and not (retry_server_errors and status in SERVER_ERRORS):
+            raise e
+        if attempt >= self.max_retries:
+            raise e
+        delay = get_backoff(attempt, retry_after)
+        self.record(throttled=throttled, retried=True)
+        logging.warning(
+            f"{self.name} returned {status}, retrying in {delay:.1f}s "
+            f"({self.throttled} throttled, {self.wait_seconds:.0f}s waited so far)"
+        )
+        for bucket in self.buckets:
+            bucket.pause(delay)
+
+    def record(
+        self, waited: float = 0, throttled: bool = False, retried: bool = False
+    ) -> None:
+        with self._lock:
+            if not retried:
+                self.requests += 1
+            self.wait_seconds += waited
+            self.throttled += throttled
+            self.retries += retried
+        if waited:
+            UPSTREAM_WAIT_SECONDS.labels(self.name).inc(waited)
+
+    def record_attempt(self, start: float, error: Exception | None = None) -> None:
+        """
+        Exports the latency and outcome of a single attempt at the call
+        """
+        outcome = "ok"
+        if error is not None:
+            status, _ = get_error_status(error)
+            outcome = "throttled" if status == TOO_MANY_REQUESTS else "error"
+        record_request(self.name, time.perf_counter() - start, outcome)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "retries": self.retries,
+                "wait_seconds": self.wait_seconds,
+            }
+
+
+def get_backoff(attempt: int, retry_after: float | None) -> float:
+    """
+    Returns Retry-After when the API sent it, otherwise exponential backoff with full jitter.
+    A little jitter is added to Retry-After too, so waiting calls don't retry all at once
+    """
+    if retry_after is not None:
+        return retry_after + random.uniform(0, INITIAL_BACKOFF)
+    return random.uniform(0, min(MAX_BACKOFF, INITIAL_BACKOFF * 2**attempt))
+
+
+def get_error_status(e: Exception) -> Tuple[int | None, float | None]:
+    """
+    Returns the HTTP status and Retry-After seconds of an OpenAI, gspread or google api
+    client error. Errors that aren't worth retrying have no status
+    """
+    if isinstance(e, openai.error.OpenAIError):
+        if isinstance(e, openai.error.RateLimitError):
+            # an exhausted quota doesn't recover by retrying
+            if e.code == "insufficient_quota":
+                return None, None
+            return TOO_MANY_REQUESTS, parse_retry_after(e.headers)
+        if isinstance(
+            e,
+            (
+                openai.error.ServiceUnavailableError,
+                openai.error.Timeout,
+                openai.error.TryAgain,
+                openai.error.APIConnectionError,
+            ),
+        ):
+            return 503, parse_retry_after(e.headers)
+        return e.http_status, parse_retry_after(e.headers)
+    if isinstance(e, APIError):
+        return e.response.status_code, parse_retry_after(e.response.headers)
+    if isinstance(e, HttpError):
+        status = e.resp.status
+        # drive reports rate limits as 403 rateLimitExceeded or userRateLimitExceeded
+        if status == 403 and get_error_reasons(e) & DRIVE_RATE_LIMIT_REASONS:
+            status = TOO_MANY_REQUESTS
+        return status, parse_retry_after(e.resp)
+    return None, None
+
+
+def get_error_reasons(e: HttpError) -> Set[str]:
+    """
+    Returns the reasons of the errors in the JSON body of a google api client error
+    """
+    try:
+        error = json.loads(e.content)["error"]
+        return {detail["reason"] for detail in error.get("errors", [])}
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return set()
+
+
+def parse_retry_after(headers: Mapping | None) -> float | None:
+    if not headers:
+        return None
+    retry_after = headers.get("retry-after") or headers.get("Retry-After")
+    try:
+        return max(float(retry_after), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+openai_limiter = RateLimiter(
+    "OpenAI",
+    Env.OPENAI_REQUESTS_PER_MINUTE,
+    Env.OPENAI_TOKENS_PER_MINUTE,
+    max_retries=Env.API_MAX_RETRIES,
+)
+sheets_limiter = RateLimiter(
+    "Google Sheets", Env.SHEETS_REQUESTS_PER_MINUTE, max_retries=Env.API_MAX_RETRIES
+)
+drive_limiter = RateLimiter(
+    "Google Drive", Env.DRIVE_REQUESTS_PER_MINUTE, max_retries=Env.API_MAX_RETRIES
+)
@@ -0,0 +1,247 @@
+import asyncio
+import copy
+import io
+import logging
+import queue
+import smtplib
+import ssl
+import threading
+import time
+from contextlib import contextmanager
+from email.message import Message
+from email.utils import getaddresses
+from typing import Iterator, List, Tuple
+
+import aiosmtplib
+
+from internal.mail_server import MailServerLogin, needs_noop
+from internal.metrics import track_request
+from internal.utils import RawBodyGenerator
+
+# created once per process, as creating a context loads the CA certificates
+SSL_CONTEXT = ssl.create_default_context()
+# reply code of servers closing the connection, e.g. after it idled for too long
+SERVICE_NOT_AVAILABLE = 421
+
+
+def flatten_email(email_message: Message) -> Tuple[str, List[str], bytes, List[str]]:
+    """
+    Returns the sender, recipients, bytes and mail options to send the email with, as
+    smtplib's send_message would. The body bytes of parsed emails are reused as they are
+    """
+    from_addr = getaddresses([email_message["From"]])[0][1]
+    address_fields = [
+        field
+        for field in (email_message["To"], email_message["Bcc"], email_message["Cc"])
+        if field is not None
+    ]
+    to_addrs = [address for _, address in getaddresses(address_fields)]
+    # a shallow copy, so the Bcc header can be dropped without changing the email
+    email_copy = copy.copy(email_message)
+    del email_copy["Bcc"]
+    email_policy = email_copy.policy
+    mail_options = []
+    if not "".join([from_addr, *to_addrs]).isascii():
+        email_policy = email_policy.clone(utf8=True)
+        mail_options = ["SMTPUTF8", "BODY=8BITMIME"]
+    with io.BytesIO() as email_bytes:
+        RawBodyGenerator(email_bytes, policy=email_policy).flatten(
+            email_copy, linesep="\r\n"
+        )
+        return from_addr, to_addrs, email_bytes.getvalue(), mail_options
+
+
+class SMTPSession:
+    """
+    Long lived, logged in SMTP connection. Reconnects when the server dropped it
+    """
+
+    def __init__(self, host: str, port: int, email: str, password: str) -> None:
+        self.host = host
+        self.port = port
+        self.email = email
+        self.password = password
+        self.server: smtplib.SMTP_SSL | None = None
+        self.last_used = 0.0
+
+    def connect(self) -> None:
+        self.close()
+        server = smtplib.SMTP_SSL(self.host, self.port, context=SSL_CONTEXT)
+        server.login(self.email, self.password)
+        self.server = server
+        self.last_used = time.monotonic()
+
+    def get_connection(self) -> smtplib.SMTP_SSL:
+        """
+        Returns the connection, checking with a NOOP that it is still alive if it has been idle
+        """
+        if self.server is not None and needs_noop(self.last_used):
+            try:
+                status, _ = self.server.noop()
+            except (smtplib.SMTPException, OSError):
+                status = None
+            if status != 250:
+                logging.info("SMTP connection went stale, reconnecting")
+                self.close()
+        if self.server is None:
+            self.connect()
+        return self.server
+
+    def send(self, email_message: Message) -> None:
+        """
+        Sends the email, reconnecting and retrying once if the server closed the connection
+        """
+        from_addr, to_addrs, email_bytes, mail_options = flatten_email(email_message)
+        for attempt in range(2):
+            try:
+                with track_request("SMTP"):
+                    self.get_connection().sendmail(
+                        from_addr, to_addrs, email_bytes, mail_options
+                    )
+                self.last_used = time.monotonic()
+                return
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException) as e:
+                if (
+                    isinstance(e, smtplib.SMTPResponseException)
+                    and e.smtp_code != SERVICE_NOT_AVAILABLE
+                ):
+                    raise
+                self.close()
+                if attempt > 0:
+                    raise
+                logging.info("SMTP server closed the connection, reconnecting")
+
+    def close(self) -> None:
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+        self.server = None
+
+
+class SMTPPool(MailServerLogin):
+    """
+    SMTP sessions shared by the email workers. Sessions are opened on demand, up to
+    max_connections, and kept open between emails
+    """
+
+    def __init__(
+        self, host: str, port: int, email: str, password: str, max_connections: int
+    ) -> None:
+        super().__init__(host, port, email, password)
+        # most recently used first, so idle sessions beyond what is needed go stale
+        self._sessions: queue.LifoQueue[SMTPSession] = queue.LifoQueue()
+        self._semaphore = threading.BoundedSemaphore(max(max_connections, 1))
+
+    @contextmanager
+    def get_session(self) -> Iterator[SMTPSession]:
+        with self._semaphore:
+            try:
+                session = self._sessions.get_nowait()
+            except queue.Empty:
+                session = SMTPSession(self.host, self.port, self.email, self.password)
+            try:
+                yield session
+            finally:
+                self._sessions.put(session)
+
+    def send(self, email_message: Message) -> None:
+        with self.get_session() as session:
+            session.send(email_message)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._sessions.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class AsyncSMTPPool(MailServerLogin):
+    """
+    asyncio version of SMTPPool, on aiosmtplib. Up to max_connections logged in clients are
+    shared by the emails in flight
+    """
+
+    def __init__(
+        self, host: str, port: int, email: str, password: str, max_connections: int
+    ) -> None:
+        super().__init__(host, port, email, password)
+        self._clients: List[aiosmtplib.SMTP] = []
+        self._semaphore = asyncio.Semaphore(max(max_connections, 1))
+        self._last_used: dict[int, float] = {}
+
+    async def connect(self) -> aiosmtplib.SMTP:
+        client = aiosmtplib.SMTP(
+            hostname=self.host, port=self.port, use_tls=True, tls_context=SSL_CONTEXT
+        )
+        await client.connect()
+        await client.login(self.email, self.password)
+        return client
+
+    async def get_client(self) -> aiosmtplib.SMTP:
+        """
+        Returns an idle client, checking with a NOOP that it is still alive if it has been
+        idle for a while, or a new one
+        """
+        while self._clients:
+            client = self._clients.pop()
+            if not needs_noop(self._last_used.get(id(client), 0)):
+                return client
+            try:
+                status, _ = await client.noop()
+                if status == 250:
+                    return client
+            except (aiosmtplib.SMTPException, OSError):
+                pass
+            logging.info("SMTP connection went stale, reconnecting")
+            await close_client(client)
+        return await self.connect()
+
+    def release(self, client: aiosmtplib.SMTP) -> None:
+        self._last_used[id(client)] = time.monotonic()
+        self._clients.append(client)
+
+    async def send(self, email_message: Message) -> None:
+        """
+        Sends the email, reconnecting and retrying once if the server closed the connection
+        """
+        from_addr, to_addrs, email_bytes, mail_options = flatten_email(email_message)
+        async with self._semaphore:
+            for attempt in range(2):
+                client = await self.get_client()
+                try:
+                    with track_request("SMTP"):
+                        await client.sendmail(
+                            from_addr, to_addrs, email_bytes, mail_options=mail_options
+                        )
+                    self.release(client)
+                    return
+                except (
+                    aiosmtplib.SMTPServerDisconnected,
+                    aiosmtplib.SMTPResponseException,
+                ) as e:
+                    await close_client(client)
+                    if (
+                        isinstance(e, aiosmtplib.SMTPResponseException)
+                        and e.code != SERVICE_NOT_AVAILABLE
+                    ) or attempt > 0:
+                        raise
+                    logging.info("SMTP server closed the connection, reconnecting")
+                except BaseException:
+                    await close_client(client)
+                    raise
+
+    async def close(self) -> None:
+        while self._clients:
+            await close_client(self._clients.pop())
+        self._last_used.clear()
+
+
+async def close_client(client: aiosmtplib.SMTP) -> None:
+    try:
+        await client.quit()
+    except (aiosmtplib.SMTPException, OSError):
+        client.close()
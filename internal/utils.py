@@ -1,18 +1,115 @@
+import base64
+import binascii
 import logging
+import re
+from collections import Counter
+from email import policy
+from email.generator import BytesGenerator
 from email.message import EmailMessage, Message
 from email.mime.message import MIMEMessage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from typing import Dict, List
+from email.parser import BytesFeedParser
+from html.parser import HTMLParser
+from tempfile import SpooledTemporaryFile
+from typing import Dict, List, Set, Tuple
 
 from bs4 import BeautifulSoup
 
 from internal.data_types import (EmailDetails, PlotRange, Project, ProjectType,
                                  ReceiverEmail)
 
+# attachments larger than this are spooled to disk instead of memory
+SPOOL_MAX_SIZE = 1024 * 1024
+# multiple of 4 so each chunk is whole base64 quanta
+BASE64_DECODE_CHUNK_SIZE = 64 * 1024
+# raw emails are fed to the parser in chunks, so they are never decoded in one piece
+PARSE_CHUNK_SIZE = 64 * 1024
+# introduces quoted lines in replies, e.g. "On <date>, <name> wrote:"
+QUOTE_ATTRIBUTION_REGEX = re.compile(r"^On\b.*\bwrote:$", re.IGNORECASE)
+# lines starting the history of a reply, everything after them is older messages
+REPLY_SEPARATOR_REGEX = re.compile(
+    r"^(-{2,}\s*Original Message\s*-{2,}|_{10,})$", re.IGNORECASE
+)
+# Outlook starts the history with a header block: a From: line, a Sent: or Date: line and
+# a To:, Cc: or Subject: line
+REPLY_HEADER_FROM_REGEX = re.compile(r"^\*?From:\*?\s", re.IGNORECASE)
+REPLY_HEADER_SENT_REGEX = re.compile(r"^\*?(Sent|Date):\*?\s", re.IGNORECASE)
+REPLY_HEADER_TO_REGEX = re.compile(r"^\*?(To|Cc|Subject):\*?\s", re.IGNORECASE)
+FORWARDED_MESSAGE_REGEX = re.compile(
+    r"^(-{2,}\s*Forwarded message\s*-{2,}|Begin forwarded message:)$", re.IGNORECASE
+)
+FORWARD_SUBJECT_REGEX = re.compile(r"^\s*(fw|fwd)\s*:", re.IGNORECASE)
+# "-- " starts a signature (RFC 3676), the sign offs of mobile apps are signatures on their
+# own. A bare "--" is often just a divider, so the trailing space is required
+SIGNATURE_SEPARATOR_REGEX = re.compile(r"^-- $")
+MOBILE_SIGNATURE_REGEX = re.compile(
+    r"^(Sent from my\b|Get Outlook for\b)", re.IGNORECASE
+)
+# sentences of legal disclaimers. A paragraph is only dropped if all of its sentences are
+# and it is short, so items written in the same paragraph are kept
+DISCLAIMER_REGEX = re.compile(
+    r"^disclaimer\b"
+    r"|\bintended (solely |only )?for the (use of the )?(individual|addressee|named recipient|recipient)"
+    r"|\breceived this (e-?mail|message|communication) in error"
+    r"|\b(this|the) (e-?mail|message)( and any (files|attachments)[^.]*)? (is|are|may be|may contain)"
+    r" (strictly )?(confidential|privileged)"
+    r"|\bnotify (the sender|us)\b"
+    r"|\b(unauthori[sz]ed|prohibited|strictly forbidden)\b"
+    r"|\b(views|opinions) (or opinions |or views )?(expressed|presented)\b"
+    r"|\b(accept|accepts) no (liability|responsibility)\b"
+    r"|\bviruse?s?\b"
+    r"|\bregistered (in England|office)\b",
+    re.IGNORECASE,
+)
+DISCLAIMER_MAX_LENGTH = 1500
+SENTENCE_END_REGEX = re.compile(r"(?<=[.!?])\s+(?=[A-Z])")
 
-def is_prompt_long(prompt: str) -> bool:
-    return len(prompt.split(" ")) > 1500
+# HTML elements that start a new line when converted to text, paragraphs are also
+# separated by a blank line
+HTML_BLOCK_TAGS = {
+    "address",
+    "article",
+    "br",
+    "div",
+    "footer",
+    "header",
+    "li",
+    "ol",
+    "section",
+    "tr",
+    "ul",
+}
+HTML_PARAGRAPH_TAGS = {
+    "blockquote",
+    "h1",
+    "h2",
+    "h3",
+    "h4",
+    "h5",
+    "h6",
+    "hr",
+    "p",
+    "pre",
+    "table",
+}
+# HTML elements whose content isn't part of the text
+HTML_SKIPPED_TAGS = {"head", "script", "style", "template", "title"}
+HTML_VOID_TAGS = {
+    "area",
+    "base",
+    "br",
+    "col",
+    "embed",
+    "hr",
+    "img",
+    "input",
+    "link",
+    "meta",
+    "source",
+    "wbr",
+}
+HIDDEN_STYLE_REGEX = re.compile(r"display\s*:\s*none", re.IGNORECASE)
 
 
 def get_reciever_email_by_name(
@@ -23,40 +120,139 @@ def get_reciever_email_by_name(
             return topic_email
 
 
+def get_project_for_email_details(
+    project_matcher: "ProjectMatcher",
+    name: str,
+    email_details: EmailDetails,
+    email_msg: str,
+) -> Project | None:
+    """
+    Returns project matching the given name, using the plot of the first item in email details
+    """
+    plot = None
+    if email_details.items:
+        plot = email_details.items[0].plot_no
+    return project_matcher.match(name, plot, email_msg)
+
+
 def get_project_based_on_details(
     projects: List[Project], name: str, plot: int, email_msg: str
 ) -> Project | None:
     """
     Returns project on email details. First match is done by project name and plot, if none matched, then match by contacts and plot
     """
-    # search by name and plot
-    for project in projects:
-        if project.name == name and check_if_plot_matches(plot, project.plot_range):
-            return project
+    return ProjectMatcher(projects).match(name, plot, email_msg)
 
-    # search by contacts and plot
-    for project in projects:
-        linked_contacts = [
-            contact.strip() for contact in project.linked_contacts.split(",")
-        ]
 
-        contacts_found = 0
-        for contact in linked_contacts:
-            if contact in email_msg:
-                contacts_found += 1
-                if contacts_found == 2:
-                    break
+class ProjectMatcher:
+    """
+    Matches emails to projects by name, or by linked contacts found in the email, and plot.
+    Built once per config so matching is a dict lookup plus a single pass over the email
+    """
+
+    def __init__(self, projects: List[Project]) -> None:
+        self.projects = projects
+        self.project_indexes_by_name: Dict[str, List[int]] = {}
+        # contact -> (project index, number of times the project lists the contact)
+        self.projects_by_contact: Dict[str, List[Tuple[int, int]]] = {}
+        # empty contacts are in every email
+        self.empty_contact_counts: Dict[int, int] = {}
 
-        if contacts_found == 2 and check_if_plot_matches(plot, project.plot_range):
-            return project
+        for i, project in enumerate(projects):
+            self.project_indexes_by_name.setdefault(project.name, []).append(i)
+            linked_contacts = []
+            if project.linked_contacts is not None:
+                linked_contacts = [
+                    contact.strip() for contact in project.linked_contacts.split(",")
+                ]
+            for contact, count in Counter(linked_contacts).items():
+                if contact == "":
+                    self.empty_contact_counts[i] = count
+                else:
+                    self.projects_by_contact.setdefault(contact, []).append((i, count))
+
+        # The regex is a trie of all contacts, so one scan finds the longest contact
+        # starting at each position. Shorter contacts that are prefixes of it are
+        # found through contact_prefixes.
+        self.contact_prefixes = {
+            contact: [
+                contact[:end]
+                for end in range(1, len(contact) + 1)
+                if contact[:end] in self.projects_by_contact
+            ]
+            for contact in self.projects_by_contact
+        }
+        self.contacts_regex = None
+        if self.projects_by_contact:
+            self.contacts_regex = re.compile(
+                f"(?=({create_trie_regex(list(self.projects_by_contact))}))"
+            )
+
+    def match(self, name: str, plot: int, email_msg: str) -> Project | None:
+        for i in self.project_indexes_by_name.get(name, []):
+            if check_if_plot_matches(plot, self.projects[i].plot_range):
+                return self.projects[i]
+
+        contacts_found = Counter(self.empty_contact_counts)
+        for contact in self.find_contacts(email_msg):
+            for i, count in self.projects_by_contact[contact]:
+                contacts_found[i] += count
+        for i in sorted(contacts_found):
+            if contacts_found[i] >= 2 and check_if_plot_matches(
+                plot, self.projects[i].plot_range
+            ):
+                return self.projects[i]
+
+        return None
+
+    def find_contacts(self, email_msg: str) -> Set[str]:
+        if self.contacts_regex is None:
+            return set()
+        contacts = set()
+        for longest_contact in {
+            match.group(1) for match in self.contacts_regex.finditer(email_msg)
+        }:
+            contacts.update(self.contact_prefixes[longest_contact])
+        return contacts
+
+
+def create_trie_regex(words: List[str]) -> str:
+    """
+    Returns a regex matching any of the given words, preferring the longest, structured as a
+    trie so the regex engine never backtracks over more than one character per alternative
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def node_to_regex(node: dict) -> str:
+        is_word_end = "" in node
+        alternatives = [
+            re.escape(char) + node_to_regex(child)
+            for char, child in sorted(node.items())
+            if char != ""
+        ]
+        if not alternatives:
+            return ""
+        regex = (
+            alternatives[0]
+            if len(alternatives) == 1
+            else f"(?:{'|'.join(alternatives)})"
+        )
+        if is_word_end:
+            regex = f"(?:{regex})?"
+        return regex
 
-    return None
+    return node_to_regex(trie)
 
 
 def check_if_plot_matches(plot: int, plot_range: PlotRange) -> bool:
     if not plot:
         return True
-    if plot_range and plot_range.start is not None:
+    if plot_range and plot_range.start is not None and plot_range.end is not None:
         if plot_range.start <= plot and plot_range.end >= plot:
             return True
     return False
@@ -69,39 +265,301 @@ def create_subject_line(email_details: EmailDetails) -> str:
     return f"***{email_details.topic}*** - {email_details.company} - {email_details.project_name} - {plots} - {email_details.project_location} - "
 
 
-def remove_middle_words(text):
-    logging.info(
-        "Prompt contains more than 4097 tokens, chopping off email from the middle"
+def strip_quoted_history(text: str) -> str:
+    """
+    Drops the quoted lines of a reply chain and the lines introducing them
+    """
+    return "\n".join(
+        line
+        for line in text.split("\n")
+        if not line.lstrip().startswith(">")
+        and QUOTE_ATTRIBUTION_REGEX.match(line.strip()) is None
+    )
+
+
+class HTMLTextExtractor(HTMLParser):
+    """
+    Converts HTML to plain text with a line per block element and " | " between table
+    cells. Scripts, styles and hidden elements are skipped, and blockquotes are prefixed
+    with "> " like quotes in plain text emails
+    """
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.lines: List[str] = []
+        self.line: List[str] = []
+        self.quote_depth = 0
+        self.pre_depth = 0
+        # the skipped element and how deeply it is nested in itself
+        self.skipped_tag: str | None = None
+        self.skipped_depth = 0
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, str | None]]) -> None:
+        if self.skipped_tag is not None:
+            if tag == self.skipped_tag:
+                self.skipped_depth += 1
+            return
+        if tag not in HTML_VOID_TAGS and (
+            tag in HTML_SKIPPED_TAGS
+            or HIDDEN_STYLE_REGEX.search(dict(attrs).get("style") or "")
+        ):
+            self.skipped_tag = tag
+            self.skipped_depth = 1
+            return
+        if tag in HTML_PARAGRAPH_TAGS:
+            self.end_paragraph()
+        elif tag in HTML_BLOCK_TAGS:
+            self.end_line()
+        if tag == "blockquote":
+            self.quote_depth += 1
+        elif tag == "pre":
+            self.pre_depth += 1
+        elif tag == "li":
+            self.line.append("- ")
+        elif tag in ("td", "th") and "".join(self.line).strip():
+            self.line.append(" | ")
+
+    def handle_endtag(self, tag: str) -> None:
+        if self.skipped_tag is not None:
+            if tag == self.skipped_tag:
+                self.skipped_depth -= 1
+                if self.skipped_depth == 0:
+                    self.skipped_tag = None
+            return
+        if tag in HTML_PARAGRAPH_TAGS:
+            self.end_paragraph()
+        elif tag in HTML_BLOCK_TAGS:
+            self.end_line()
+        if tag == "blockquote":
+            self.quote_depth = max(self.quote_depth - 1, 0)
+        elif tag == "pre":
+            self.pre_depth = max(self.pre_depth - 1, 0)
+
+    def handle_data(self, data: str) -> None:
+        if self.skipped_tag is not None:
+            return
+        data = data.replace("\xa0", " ")
+        if self.pre_depth:
+            lines = data.split("\n")
+            for line in lines[:-1]:
+                self.line.append(line)
+                self.end_line()
+            self.line.append(lines[-1])
+        else:
+            self.line.append(re.sub(r"\s+", " ", data))
+
+    def end_line(self) -> None:
+        text = "".join(self.line)
+        line = text.strip()
+        self.line = []
+        # the trailing space of a "-- " signature separator is kept, a bare "--" isn't one
+        if line == "--" and text.lstrip().startswith("-- "):
+            line = "-- "
+        if line:
+            self.lines.append("> " * self.quote_depth + line)
+
+    def end_paragraph(self) -> None:
+        self.end_line()
+        if self.lines and self.lines[-1] != "":
+            self.lines.append("")
+
+    def get_text(self) -> str:
+        self.close()
+        self.end_line()
+        return "\n".join(self.lines).strip()
+
+
+def html_to_text(html: str) -> str:
+    extractor = HTMLTextExtractor()
+    extractor.feed(html)
+    return extractor.get_text()
+
+
+def strip_reply_history(lines: List[str]) -> List[str]:
+    """
+    Cuts the lines at the start of the reply history, unless nothing would be left
+    """
+    for i, line in enumerate(lines):
+        line = line.strip()
+        is_separator = (
+            REPLY_SEPARATOR_REGEX.match(line) is not None
+            or QUOTE_ATTRIBUTION_REGEX.match(line) is not None
+            or (
+                REPLY_HEADER_FROM_REGEX.match(line) is not None
+                and i + 2 < len(lines)
+                and REPLY_HEADER_SENT_REGEX.match(lines[i + 1].strip()) is not None
+                and REPLY_HEADER_TO_REGEX.match(lines[i + 2].strip()) is not None
+            )
+        )
+        # long attributions are wrapped over two lines
+        if not is_separator and line.lower().endswith("wrote:") and i > 0:
+            if QUOTE_ATTRIBUTION_REGEX.match(f"{lines[i - 1].strip()} {line}"):
+                i -= 1
+                is_separator = True
+        if is_separator and any(previous.strip() for previous in lines[:i]):
+            return lines[:i]
+    return lines
+
+
+def strip_signatures(lines: List[str]) -> List[str]:
+    """
+    Drops signatures, from a "-- " line up to the next forwarded message, and the sign offs
+    of mobile apps
+    """
+    stripped_lines = []
+    in_signature = False
+    for line in lines:
+        if FORWARDED_MESSAGE_REGEX.match(line.strip()):
+            in_signature = False
+        elif SIGNATURE_SEPARATOR_REGEX.match(line):
+            in_signature = True
+        if not in_signature and not MOBILE_SIGNATURE_REGEX.match(line.strip()):
+            stripped_lines.append(line)
+    return stripped_lines
+
+
+def strip_disclaimers(text: str) -> str:
+    """
+    Drops the paragraphs of legal disclaimers, e.g. confidentiality notices
+    """
+    return "\n\n".join(
+        paragraph
+        for paragraph in re.split(r"\n\s*\n", text)
+        if not is_disclaimer(paragraph)
     )
-    # Split the text into words using whitespace as the delimiter
-    words = text.split(" ")
-    # Calculate the number of words to remove (1/4th of the total words)
-    n = len(words)
-    k = n // 4
-    # Calculate the start and end values for the middle range
-    start = (n - k) // 2 + 1
-    end = start + k - 1
-    # Check if the range is valid
-    if start < 1:
-        start = 1
-        end = k
-    if end > n:
-        end = n
-    # Remove the middle portion of words
-    del words[start : end + 1]
-    # Reconstruct the text with remaining words
-    result_text = " ".join(words)
-    return result_text
+
+
+def is_disclaimer(paragraph: str) -> bool:
+    """
+    Returns whether the paragraph is short and consists only of disclaimer sentences
+    """
+    paragraph = " ".join(paragraph.split())
+    if not paragraph or len(paragraph) > DISCLAIMER_MAX_LENGTH:
+        return False
+    return all(
+        DISCLAIMER_REGEX.search(sentence) is not None
+        for sentence in SENTENCE_END_REGEX.split(paragraph)
+    )
+
+
+def clean_email_text(text: str, keep_history: bool = False) -> str:
+    """
+    Reduces an email body to the newest message. The reply history, quoted lines,
+    signatures and disclaimers are dropped. With keep_history, e.g. for forwarded emails
+    where the older messages are the content, only signatures and disclaimers are dropped
+    """
+    lines = text.replace("\r\n", "\n").split("\n")
+    if not keep_history:
+        lines = strip_reply_history(lines)
+        lines = strip_quoted_history("\n".join(lines)).split("\n")
+    text = strip_disclaimers("\n".join(strip_signatures(lines)))
+    text = "\n".join(line.rstrip() for line in text.split("\n"))
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+def parse_email(raw_email: bytes) -> EmailMessage:
+    """
+    Parses a raw email with a feed parser. The original bytes of the body are kept on the
+    message as raw_body, so forwarding it doesn't serialize the whole tree again
+    """
+    parser = BytesFeedParser(policy=policy.SMTP)
+    raw_view = memoryview(raw_email)
+    for i in range(0, len(raw_view), PARSE_CHUNK_SIZE):
+        parser.feed(bytes(raw_view[i : i + PARSE_CHUNK_SIZE]))
+    email_msg = parser.close()
+    if raw_email.startswith(b"\r\n"):
+        email_msg.raw_body = raw_view[2:]
+    else:
+        header_end = raw_email.find(b"\r\n\r\n")
+        if header_end != -1:
+            email_msg.raw_body = raw_view[header_end + 4 :]
+    return email_msg
+
+
+class RawBodyGenerator(BytesGenerator):
+    """
+    Writes the original body bytes of parsed emails, including ones attached as
+    message/rfc822 parts, instead of generating them. Only the headers are generated, so
+    the body of a parsed email must not be modified
+    """
+
+    def _dispatch(self, msg: Message) -> None:
+        raw_body = getattr(msg, "raw_body", None)
+        if raw_body is None:
+            super()._dispatch(msg)
+        else:
+            self._fp.write(raw_body)
 
 
 def get_body_from_email_msg(email_msg: Message) -> str:
-    body = ""
-    for part in email_msg.walk():
-        if part.get_content_type() == "text/plain":
-            body += part.get_content() + "\n"
+    """
+    Returns the text/plain parts of the email, or the text of its HTML parts if it has no
+    plain text. The body is extracted once and cached on the message, as the classify, sheet
+    and drive stages all need it
+    """
+    body = getattr(email_msg, "text_body", None)
+    if body is None:
+        body = ""
+        html_parts = []
+        for part in email_msg.walk():
+            if part.get_content_type() == "text/plain":
+                body += part.get_content() + "\n"
+            elif part.get_content_type() == "text/html" and not part.is_attachment():
+                html_parts.append(part)
+        if not body.strip():
+            body = "".join(
+                html_to_text(part.get_content()) + "\n" for part in html_parts
+            )
+        email_msg.text_body = body
     return body
 
 
+def get_clean_body_from_email_msg(email_msg: Message) -> str:
+    """
+    Returns the body of the email reduced to the newest message with clean_email_text. The
+    history of forwarded emails is kept
+    """
+    clean_body = getattr(email_msg, "clean_text_body", None)
+    if clean_body is None:
+        is_forward = FORWARD_SUBJECT_REGEX.match(str(email_msg["Subject"] or ""))
+        clean_body = clean_email_text(
+            get_body_from_email_msg(email_msg), keep_history=is_forward is not None
+        )
+        email_msg.clean_text_body = clean_body
+    return clean_body
+
+
+def spool_attachment(part: Message) -> SpooledTemporaryFile:
+    """
+    Decodes the attachment payload into a temporary file. Base64 payloads are decoded in
+    chunks so the decoded attachment is never held in memory in full
+    """
+    spooled_file = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    if part.get("Content-Transfer-Encoding", "").strip().lower() == "base64":
+        try:
+            write_base64_decoded(part.get_payload(), spooled_file)
+            spooled_file.seek(0)
+            return spooled_file
+        except binascii.Error:
+            # malformed base64, let the email package decode it leniently
+            spooled_file.seek(0)
+            spooled_file.truncate()
+    spooled_file.write(part.get_payload(decode=True) or b"")
+    spooled_file.seek(0)
+    return spooled_file
+
+
+def write_base64_decoded(payload: str, file: SpooledTemporaryFile) -> None:
+    remainder = ""
+    for i in range(0, len(payload), BASE64_DECODE_CHUNK_SIZE):
+        chunk = remainder + "".join(payload[i : i + BASE64_DECODE_CHUNK_SIZE].split())
+        decodable_length = len(chunk) - len(chunk) % 4
+        file.write(base64.b64decode(chunk[:decodable_length]))
+        remainder = chunk[decodable_length:]
+    if remainder:
+        file.write(base64.b64decode(remainder + "=" * (-len(remainder) % 4)))
+
+
 def append_html_at_start_of_email(
     html_to_append: str, existing_email: EmailMessage
 ) -> MIMEMultipart:
@@ -126,6 +584,34 @@ def comma_seperated_to_list(text: str) -> List[str]:
     return [x.strip() for x in text.split(",") if x.strip()]
 
 
+def render_project_type_placeholders(
+    prompt: str, project_type_dict: Dict[str, Dict[str, str | float]]
+) -> str:
+    return (
+        prompt.replace(
+            "{windows_hourly_rate}",
+            str(project_type_dict["windows"]["hourly_rate"]),
+        )
+        .replace("{windows_day_rate}", str(project_type_dict["windows"]["day_rate"]))
+        .replace(
+            "{carpentry_hourly_rate}",
+            str(project_type_dict["carpentry"]["hourly_rate"]),
+        )
+        .replace(
+            "{carpentry_day_rate}",
+            str(project_type_dict["carpentry"]["day_rate"]),
+        )
+        .replace(
+            "{windows_keywords}",
+            str(comma_seperated_to_list(project_type_dict["windows"]["keywords"])),
+        )
+        .replace(
+            "{carpentry_keywords}",
+            str(comma_seperated_to_list(project_type_dict["carpentry"]["keywords"])),
+        )
+    )
+
+
 def create_project_type_dict(
     project_types: List[ProjectType],
 ) -> Dict[str, Dict[str, str | float]]:
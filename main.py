@@ -1,7 +1,10 @@
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
-from internal.db import get_config_from_db, update_or_create_config
+from internal.db import (DEFAULT_MAILBOX, delete_config, get_config_from_db,
+                         get_config_mailboxes, update_or_create_config)
+from internal.metrics import get_metrics_registry
 
 app = FastAPI()
 
@@ -16,19 +19,57 @@ app.add_middleware(
 
 @app.get("/")
 async def get_config():
-    config = get_config_from_db()
+    return get_mailbox_config(DEFAULT_MAILBOX)
+
+
+@app.post("/")
+async def update_config(request: Request):
+    update_or_create_config(await read_config_json(request))
+    return {"status": "ok"}
+
+
+@app.get("/mailboxes")
+async def get_mailboxes():
+    return get_config_mailboxes()
+
+
+@app.get("/mailboxes/{mailbox}")
+async def get_config_of_mailbox(mailbox: str):
+    return get_mailbox_config(mailbox)
+
+
+@app.post("/mailboxes/{mailbox}")
+async def update_config_of_mailbox(mailbox: str, request: Request):
+    update_or_create_config(await read_config_json(request), mailbox)
+    return {"status": "ok"}
+
+
+@app.delete("/mailboxes/{mailbox}")
+async def delete_config_of_mailbox(mailbox: str):
+    if not delete_config(mailbox):
+        raise HTTPException(status_code=404, detail="No config found")
+    return {"status": "ok"}
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(
+        generate_latest(get_metrics_registry()), media_type=CONTENT_TYPE_LATEST
+    )
+
+
+def get_mailbox_config(mailbox: str) -> dict:
+    config = get_config_from_db(mailbox)
     if not config:
         raise HTTPException(status_code=404, detail="No config found")
     return config.config_json
 
 
-@app.post("/")
-async def update_config(request: Request):
+async def read_config_json(request: Request) -> dict:
     try:
         config_json = await request.json()
     except:
         raise HTTPException(status_code=400, detail="Bad Request")
     if config_json == {}:
         raise HTTPException(status_code=400, detail="Bad Request")
-    update_or_create_config(config_json)
-    return {"status": "ok"}
+    return config_json
@@ -1,7 +1,10 @@
 import pickle
+from email import policy
 from unittest import TestCase
 
-from internal.utils import prepend_text_to_email
+from internal.smtp import flatten_email
+from internal.utils import (append_html_at_start_of_email, clean_email_text,
+                            get_clean_body_from_email_msg, parse_email)
 
 
 class TestEmailForwarder(TestCase):
@@ -9,8 +12,69 @@ class TestEmailForwarder(TestCase):
         with open("tests/email.pkl", "rb") as f:
             self.email_message = pickle.load(f)
 
-    def test_prepend_text_to_email(self):
-        new_email_message = prepend_text_to_email("New text", self.email_message)
+    def test_append_html_at_start_of_email(self):
+        new_email_message = append_html_at_start_of_email(
+            "New text", self.email_message
+        )
 
         print(new_email_message)
         assert "New text" in str(new_email_message)
+
+    def test_forward_reuses_original_body(self):
+        raw_email = self.email_message.as_bytes(policy=policy.SMTP)
+        email_message = parse_email(raw_email)
+        del email_message["To"]
+        email_message["To"] = "forward@example.com"
+
+        from_addr, to_addrs, email_bytes, _ = flatten_email(
+            append_html_at_start_of_email("New text", email_message)
+        )
+
+        assert to_addrs == ["forward@example.com"]
+        assert raw_email[raw_email.index(b"\r\n\r\n") + 4 :] in email_bytes
+
+    def test_clean_body_of_html_email(self):
+        email_message = parse_email(
+            b"Subject: RE: windows\r\nContent-Type: text/html\r\n\r\n"
+            b"<p>Please quote plot&nbsp;5</p><div>-- <br>Bob</div>"
+            b"<div>On Mon, 1 Jan 2024, Alice wrote:</div>"
+            b"<blockquote>Old message</blockquote>\r\n"
+        )
+
+        assert get_clean_body_from_email_msg(email_message) == "Please quote plot 5"
+
+    def test_clean_body_keeps_text_after_bare_dashes(self):
+        assert (
+            clean_email_text("Order below\n--\nItem A x 2")
+            == "Order below\n--\nItem A x 2"
+        )
+        assert clean_email_text("Order below\n-- \nBob\nACME Ltd") == "Order below"
+
+    def test_clean_body_keeps_items_in_disclaimer_paragraph(self):
+        text = (
+            "Please supply:\n\n"
+            "This email is confidential.\nItem A x 2 for plot 5\nItem B x 1 for plot 6"
+        )
+
+        assert clean_email_text(text) == text
+
+    def test_clean_body_drops_disclaimer_paragraph(self):
+        text = (
+            "Please supply Item A x 2\n\n"
+            "This email and any attachments are confidential and intended solely for the "
+            "addressee. If you have received this email in error please notify the sender "
+            "and delete it. ACME Ltd is registered in England No. 123456."
+        )
+
+        assert clean_email_text(text) == "Please supply Item A x 2"
+
+    def test_clean_body_keeps_from_and_date_lines_in_content(self):
+        text = "Delivery details:\nFrom: Leeds depot\nDate: 3 May\nPlease confirm"
+
+        assert clean_email_text(text) == text
+        assert (
+            clean_email_text(
+                "Thanks\n\nFrom: Bob\nSent: 3 May 2024\nTo: Alice\nSubject: RE: x\n\nOld"
+            )
+            == "Thanks"
+        )
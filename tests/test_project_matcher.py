@@ -0,0 +1,64 @@
+import random
+from typing import List
+from unittest import TestCase
+
+from internal.data_types import PlotRange, Project
+from internal.utils import ProjectMatcher, check_if_plot_matches
+
+NAMES = ["Oak Park", "Riverside", "Mill Lane", "Oak"]
+CONTACTS = ["bob", "bob@site.com", "alice@site.com", "al", "site.com", "carol", ""]
+
+
+def get_project_by_scanning(
+    projects: List[Project], name: str, plot: int, email_msg: str
+) -> Project | None:
+    """
+    The matching ProjectMatcher replaced: name and plot first, then two linked contacts
+    found in the email and plot
+    """
+    for project in projects:
+        if project.name == name and check_if_plot_matches(plot, project.plot_range):
+            return project
+
+    for project in projects:
+        linked_contacts = [
+            contact.strip() for contact in project.linked_contacts.split(",")
+        ]
+        contacts_found = 0
+        for contact in linked_contacts:
+            if contact in email_msg:
+                contacts_found += 1
+                if contacts_found == 2:
+                    break
+        if contacts_found == 2 and check_if_plot_matches(plot, project.plot_range):
+            return project
+
+    return None
+
+
+def create_project(rng: random.Random, i: int) -> Project:
+    start = rng.randint(1, 50)
+    return Project(
+        name=rng.choice(NAMES),
+        phase=i,
+        plot_range=rng.choice([None, PlotRange(start, start + rng.randint(0, 30))]),
+        linked_contacts=", ".join(rng.sample(CONTACTS, rng.randint(0, 3))),
+        google_sheet_url_windows=None,
+        google_sheet_url_carpentry=None,
+    )
+
+
+class TestProjectMatcher(TestCase):
+    def test_matches_scanning_projects(self):
+        rng = random.Random(0)
+        for _ in range(2000):
+            projects = [create_project(rng, i) for i in range(rng.randint(0, 6))]
+            project_matcher = ProjectMatcher(projects)
+            for _ in range(10):
+                name = rng.choice(NAMES + ["Unknown"])
+                plot = rng.choice([None, rng.randint(1, 90)])
+                email_msg = " ".join(rng.choices(CONTACTS + ["hi", "thanks"], k=4))
+
+                assert project_matcher.match(
+                    name, plot, email_msg
+                ) is get_project_by_scanning(projects, name, plot, email_msg)